@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Baseline classifier trained on the feature table, one chunk at a time, so the table is never
+    loaded into memory. Patient grouped cross validation folds are trained in parallel, giving
+    out of fold probabilities for each image and each breast.
+'''
+
+from argparse           import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from features           import FeatureTable
+from numpy              import arange, nan_to_num, sqrt, where
+from os.path            import join
+from pandas             import concat, read_parquet
+from sampler            import get_folds
+from time               import perf_counter
+from welford            import Moments
+
+PATH = r'D:\data\rsna-breast-cancer-detection'
+KEYS = ['image_id', 'version', 'size', 'mtime']
+
+def get_latest_version(directory):
+    '''Version of feature set most recently added to table'''
+    parts = FeatureTable(directory).get_parts()
+    return read_parquet(parts[-1],columns=['version'])['version'].iloc[-1] if len(parts)>0 else None
+
+def get_version_parts(directory,version):
+    '''Parts of feature table that contain rows for one version of feature set'''
+    return [part for part in FeatureTable(directory).get_parts()
+            if len(read_parquet(part,columns=['version'],filters=[('version','==',version)]))>0]
+
+def get_feature_columns(directory,version):
+    '''Names of feature columns present in every part that contains version'''
+    from pyarrow.parquet import read_schema
+    schemas = [read_schema(part).names for part in get_version_parts(directory,version)]
+    if len(schemas)==0: return []
+    return [name for name in schemas[0] if name not in KEYS and all(name in names for names in schemas[1:])]
+
+def get_chunks(directory,version,meta,columns,batch_size=10000):
+    '''
+    Read feature table one batch at a time, joined with metadata. Where an image appears in
+    more than one part, only the latest is used, as in FeatureTable.read.
+
+    Parameters:
+        directory    Location of feature table
+        version      Version of feature set
+        meta         Metadata, including image_id, and fold
+        columns      Feature columns
+        batch_size   Number of rows read at a time
+
+    Yields:
+        X, rows from meta
+    '''
+    from pyarrow.parquet import ParquetFile
+    parts  = get_version_parts(directory,version)
+    latest = {}
+    for i,part in enumerate(parts):
+        latest.update(dict.fromkeys(read_parquet(part,columns=['image_id'],filters=[('version','==',version)])['image_id'],i))
+    for i,part in enumerate(parts):
+        for batch in ParquetFile(part).iter_batches(batch_size=batch_size,columns=['image_id','version']+columns):
+            chunk = batch.to_pandas()
+            chunk = chunk[(chunk['version']==version) & (chunk['image_id'].map(latest)==i)]
+            chunk = chunk.merge(meta,on='image_id')
+            if len(chunk)>0:
+                yield nan_to_num(chunk[columns].to_numpy(dtype=float)), chunk[meta.columns]
+
+def get_scales(directory,version,meta,columns,n_folds):
+    '''
+    Mean and standard deviation of each feature, over training rows of each fold, in a single pass
+
+    Returns:
+        mean, sd: n_folds x number of columns
+    '''
+    moments = Moments(len(columns),replicates=n_folds)
+    for X,rows in get_chunks(directory,version,meta,columns):
+        fold = rows['fold'].to_numpy()
+        moments.update(X,weights=(fold[None,:]!=arange(n_folds)[:,None]).astype(float))
+    variance = moments.M2.diagonal(axis1=1,axis2=2)/where(moments.n>1,moments.n-1,1)[:,None]
+    return moments.mean, where(variance>0,sqrt(variance),1)
+
+def train_fold(fold,directory,version,meta,columns,mean,sd,
+               epochs = 5,
+               alpha  = 1e-4,
+               seed   = None):
+    '''
+    Train on all folds but one, then predict held out fold: executed in worker process
+
+    Parameters:
+        fold        Fold to be held out
+        directory   Location of feature table
+        version     Version of feature set
+        meta        Metadata, including image_id, patient_id, laterality, cancer, and fold
+        columns     Feature columns
+        mean, sd    Used to standardize features
+        epochs      Number of passes through training data
+        alpha       Regularization
+        seed        Used to initialize classifier
+
+    Returns:
+        Probability of cancer for each image in held out fold
+    '''
+    from sklearn.linear_model import SGDClassifier
+    classifier = SGDClassifier(loss='log_loss',alpha=alpha,random_state=seed)
+    training   = meta['fold']!=fold
+    n_positive = meta['cancer'][training].sum()
+    weight     = (training.sum()-n_positive)/max(n_positive,1)           # Balance classes
+    for _ in range(epochs):
+        for X,rows in get_chunks(directory,version,meta[training],columns):
+            y = rows['cancer'].to_numpy().astype(int)
+            classifier.partial_fit((X-mean)/sd,y,
+                                   classes       = [0,1],
+                                   sample_weight = where(y==1,weight,1.0))
+    predictions = []
+    for X,rows in get_chunks(directory,version,meta[~training],columns):
+        predictions.append(rows.assign(probability=classifier.predict_proba((X-mean)/sd)[:,1]))
+    return concat(predictions,ignore_index=True) if len(predictions)>0 else meta.iloc[:0].assign(probability=[])
+
+def cross_validate(directory,version,meta,
+                   n_folds   = 5,
+                   epochs    = 5,
+                   alpha     = 1e-4,
+                   seed      = None,
+                   processes = None):
+    '''
+    Train one classifier for each fold in a pool of processes
+
+    Returns:
+        image_probabilities    Out of fold probability for each image
+        breast_probabilities   Mean probability over images of each breast
+    '''
+    meta         = meta.assign(fold=get_folds(meta,n_folds=n_folds,seed=seed))
+    columns      = get_feature_columns(directory,version)
+    mean,sd      = get_scales(directory,version,meta,columns,n_folds)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(train_fold,fold,directory,version,meta,columns,mean[fold],sd[fold],
+                                   epochs = epochs,
+                                   alpha  = alpha,
+                                   seed   = seed)
+                   for fold in range(n_folds)]
+        image_probabilities = concat([future.result() for future in futures],ignore_index=True)
+    breast_probabilities = image_probabilities.groupby(['patient_id','laterality'],observed=True).agg(
+        cancer      = ('cancer','max'),
+        probability = ('probability','mean'),
+        fold        = ('fold','first')).reset_index()
+    return image_probabilities,breast_probabilities
+
+if __name__=='__main__':
+    from metadata        import read_metadata
+    from sklearn.metrics import roc_auc_score
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',       default=PATH,                   help='Location of data')
+    parser.add_argument('--features',   default=None,                   help='Directory for feature table (default: path/features)')
+    parser.add_argument('--version',    default=None,                   help='Version of feature set (default: latest)')
+    parser.add_argument('--folds',      default=5,     type=int,        help='Number of folds')
+    parser.add_argument('--epochs',     default=5,     type=int,        help='Number of passes through training data')
+    parser.add_argument('--alpha',      default=1e-4,  type=float,      help='Regularization')
+    parser.add_argument('--seed',       default=None,  type=int,        help='Used to assign folds and initialize classifiers')
+    parser.add_argument('--processes',  default=None,  type=int,        help='Number of worker processes')
+    parser.add_argument('--output',     default='.',                    help='Where probabilities are to be written')
+    args      = parser.parse_args()
+    directory = args.features if args.features!=None else join(args.path,'features')
+    version   = args.version if args.version!=None else get_latest_version(directory)
+    start     = perf_counter()
+    images,breasts = cross_validate(directory,version,
+                                    read_metadata(args.path,columns=['patient_id','image_id','laterality','cancer']),
+                                    n_folds   = args.folds,
+                                    epochs    = args.epochs,
+                                    alpha     = args.alpha,
+                                    seed      = args.seed,
+                                    processes = args.processes)
+    print (f'Version {version}: {len(images)} images, {len(breasts)} breasts in {perf_counter()-start:.1f} sec')
+    for name,df in [('image',images),('breast',breasts)]:
+        for fold,df_fold in df.groupby('fold'):
+            if df_fold['cancer'].nunique()>1:
+                print (f'Fold {fold}: {name} AUC={roc_auc_score(df_fold["cancer"],df_fold["probability"]):.3f}')
+        df.to_csv(join(args.output,f'{name}_probabilities.csv'),index=False)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Time critical functions on synthetic images, so we can see whether changes help'''
+
+from argparse     import ArgumentParser
+from time         import perf_counter
+from numpy        import all, histogram, ogrid, stack, uint16
+from numpy.random import default_rng
+
+Benchmarks = {}
+
+def benchmark(name):
+    '''Decorator used to register a benchmark so it can be selected from the command line'''
+    def register(function):
+        Benchmarks[name] = function
+        return function
+    return register
+
+def create_frame(m=5355,n=4915,seed=42,background=4095):
+    '''
+    Create a synthetic mammogram: a noisy half ellipse of tissue, surrounded by a uniform background.
+
+    Parameters:
+        m,n          Shape of image (default is the size of a typical full field image)
+        seed         Used to initialize random number generator
+        background   Pixel value for background
+    '''
+    x,y    = ogrid[0:m,0:n]
+    inside = ((x-0.45*m)/(0.35*m))**2 + (y/(0.45*n))**2 < 1
+    frame  = default_rng(seed).integers(0,background//2,size=(m,n),dtype=uint16)
+    frame[~inside] = background
+    return frame
+
+def get_bounds_iterative(pixel_array):
+    '''
+    The original implementation of visualize.get_bounds, retained as a baseline
+    '''
+    def is_background(strip):
+        if background_low:
+            return all(strip<=background)
+        else:
+            return all(strip>=background)
+
+    hist,bins    = histogram(pixel_array, density=True)
+
+    if hist[0]>hist[-1]:
+        background = bins[0]
+        background_low = True
+    else:
+        background = bins[-1]
+        background_low = False
+
+    xmin,ymin = 0,0
+    xmax,ymax = pixel_array.shape
+
+    while is_background(pixel_array[xmin,:]):
+        xmin+= 1
+    while is_background(pixel_array[:,ymin]):
+        ymin+= 1
+    while is_background(pixel_array[xmax-1,:]):
+        xmax-=1
+    while is_background(pixel_array[:,ymax-1]):
+        ymax-= 1
+
+    return xmin,ymin,xmax,ymax, background
+
+def time_it(function,*args,repeat=3):
+    '''Return best of several elapsed times for function, and the value it returned'''
+    best = float('inf')
+    for _ in range(repeat):
+        start  = perf_counter()
+        result = function(*args)
+        best   = min(best,perf_counter()-start)
+    return best,result
+
+@benchmark('bounds')
+def benchmark_bounds(args):
+    '''Compare iterative get_bounds with vectorized and batched versions'''
+    from visualize import get_bounds, get_bounds_batch
+    frames = stack([create_frame(m=args.m,n=args.n,seed=k) for k in range(args.N)])
+    t0,expected = time_it(lambda:[get_bounds_iterative(frame) for frame in frames],repeat=args.repeat)
+    t1,actual1  = time_it(lambda:[get_bounds(frame) for frame in frames],repeat=args.repeat)
+    t2,actual2  = time_it(get_bounds_batch,frames,repeat=args.repeat)
+    assert actual1==expected and actual2==expected
+    print (f'get_bounds, {args.N} frames {args.m}x{args.n}')
+    print (f'  iterative  {t0:8.3f} sec')
+    print (f'  vectorized {t1:8.3f} sec, speedup {t0/t1:.1f}')
+    print (f'  batch      {t2:8.3f} sec, speedup {t0/t2:.1f}')
+
+class Element:
+    '''Value of a data element, as returned by dicomsdl'''
+    def __init__(self,value):
+        self.value_ = value
+
+    def value(self):
+        return self.value_
+
+class DataSet:
+    '''Just enough of a dicomsdl DataSet to create a VOILUT'''
+    def __init__(self,**elements):
+        self.elements = elements
+
+    def getDataElement(self,name):
+        return Element(self.elements[name])
+
+def get_peak(function,*args):
+    '''Peak memory allocated by function, in MB'''
+    from tracemalloc import get_traced_memory, start, stop
+    start()
+    function(*args)
+    _,peak = get_traced_memory()
+    stop()
+    return peak/(1<<20)
+
+@benchmark('window')
+def benchmark_window(args):
+    '''Compare windowing in floating point with lookup table, with and without a buffer pool'''
+    from buffers import BufferPool
+    from loader  import Linear
+    window = Linear(DataSet(WindowCenter=2048,WindowWidth=4096,RescaleIntercept=0,RescaleSlope=1))
+    frames = [create_frame(m=args.m,n=args.n,seed=k) for k in range(args.N)]
+    pool   = BufferPool()
+
+    def window_float():
+        return [Loader.normalize(window.scale(frame.max()-frame)) for frame in frames]
+
+    def window_lut():
+        return [window.apply(frame,invert=True) for frame in frames]
+
+    def window_pool():
+        for frame in frames:
+            out = pool.acquire(frame.shape,'uint8')
+            window.apply(frame,invert=True,out=out)
+            pool.release(out)
+
+    from loader import Loader
+    t0,expected = time_it(window_float,repeat=args.repeat)
+    t1,actual   = time_it(window_lut,repeat=args.repeat)
+    t2,_        = time_it(window_pool,repeat=args.repeat)
+    assert all(all(a==b) for a,b in zip(actual,expected))
+    print (f'window, {args.N} frames {args.m}x{args.n}')
+    print (f'  float  {t0:8.3f} sec, peak {get_peak(window_float):8.1f} MB')
+    print (f'  lut    {t1:8.3f} sec, peak {get_peak(window_lut):8.1f} MB, speedup {t0/t1:.1f}')
+    print (f'  pool   {t2:8.3f} sec, peak {get_peak(window_pool):8.1f} MB, speedup {t0/t2:.1f}')
+
+LIBRARY   = ['welford', 'metadata', 'patients', 'expand', 'restructure', 'integrity', 'planner', 'loader', 'segment',
+             'dirichlet', 'visualize', 'contour', 'mosaic', 'export', 'dataset', 'exams', 'sampler', 'features',
+             'baseline', 'evaluate', 'infer', 'patches', 'profiling', 'buffers']
+HEAVY     = ['matplotlib', 'seaborn', 'dicomsdl', 'cv2', 'pandas', 'sklearn', 'pyarrow', 'torch']
+FORBIDDEN = ['matplotlib', 'seaborn', 'dicomsdl', 'sklearn', 'torch']
+
+def time_import(module):
+    '''
+    Import module in a fresh interpreter, so nothing has been cached
+
+    Returns:
+        elapsed time, and heavy dependencies that were imported with module
+    '''
+    from os.path    import dirname, abspath
+    from subprocess import run
+    from sys        import executable
+    code   = (f'from time import perf_counter\nstart = perf_counter()\nimport {module}\n'
+              f'import sys\nprint(perf_counter()-start)\nprint(" ".join(m for m in {HEAVY} if m in sys.modules))')
+    result = run([executable,'-c',code],cwd=dirname(abspath(__file__)),capture_output=True,text=True,check=True)
+    lines  = result.stdout.split('\n')
+    return float(lines[0]), lines[1].split()
+
+@benchmark('imports')
+def benchmark_imports(args):
+    '''
+    Time import of each library module, and verify that none of them pulls in plotting,
+    or dependencies that should only be imported when they are used
+    '''
+    failures = []
+    print (f'Import times, limit {args.max_import:.2f} sec')
+    for module in LIBRARY:
+        best      = float('inf')
+        for _ in range(args.repeat):
+            elapsed,imported = time_import(module)
+            best             = min(best,elapsed)
+        forbidden = [name for name in imported if name in FORBIDDEN]
+        print (f'  {module:12s} {best:8.3f} sec  {" ".join(imported)}')
+        if len(forbidden)>0:
+            failures.append(f'{module} imports {", ".join(forbidden)}')
+        if best>args.max_import:
+            failures.append(f'{module} takes {best:.3f} sec')
+    assert len(failures)==0, '; '.join(failures)
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('benchmarks', nargs='*', help=f'Benchmarks to run: {", ".join(Benchmarks.keys())} (omit for all)')
+    parser.add_argument('--N',      type=int, default=4,    help='Number of frames')
+    parser.add_argument('--m',      type=int, default=5355, help='Number of rows in each frame')
+    parser.add_argument('--n',      type=int, default=4915, help='Number of columns in each frame')
+    parser.add_argument('--repeat', type=int, default=3,    help='Number of times to repeat each timing')
+    parser.add_argument('--max-import', type=float, default=2.0, help='Maximum time to import any library module (sec)')
+    args = parser.parse_args()
+    for name in args.benchmarks if len(args.benchmarks)>0 else Benchmarks.keys():
+        Benchmarks[name](args)
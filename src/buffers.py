@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Reuse arrays for pixels, so a worker that loads many images stops allocating
+    once it has seen each size of image.
+'''
+
+from numpy import dtype as get_dtype, empty
+
+class BufferPool:
+    '''
+    Arrays that have been released, so they can be acquired again, keyed by shape and dtype.
+
+    Attributes:
+        free        For each key, arrays that are available
+        max_free    Maximum number of arrays kept for each key
+        allocated   Number of arrays that had to be created
+        reused      Number of times an array was reused
+    '''
+    def __init__(self,max_free=2):
+        self.free      = {}
+        self.max_free  = max_free
+        self.allocated = 0
+        self.reused    = 0
+
+    @staticmethod
+    def get_key(shape,dtype):
+        return tuple(shape),get_dtype(dtype).str
+
+    def acquire(self,shape,dtype):
+        '''
+        Get an array, reusing one that has been released if possible. The contents are undefined.
+        '''
+        free = self.free.get(BufferPool.get_key(shape,dtype))
+        if free:
+            self.reused += 1
+            return free.pop()
+        self.allocated += 1
+        return empty(shape,dtype=dtype)
+
+    def release(self,array):
+        '''
+        Return an array to the pool: the caller must not use it, or any view of it, again
+        '''
+        if array.base is not None or not array.flags.c_contiguous:    # Views are owned by some other array
+            return
+        free = self.free.setdefault(BufferPool.get_key(array.shape,array.dtype),[])
+        if len(free)<self.max_free and all(other is not array for other in free):
+            free.append(array)
+
+    def __len__(self):
+        return sum(len(free) for free in self.free.values())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Single entry point for all tools: the first argument selects a tool, and the rest are passed to it,
+    e.g. cli.py segment 797737008 --show. Only the selected tool is imported, so each command pays
+    only for the dependencies it needs.
+'''
+
+from argparse import ArgumentParser, REMAINDER, RawDescriptionHelpFormatter
+from runpy    import run_module
+from sys      import argv
+
+COMMANDS = {
+    'load'        : ('loader',         'Display an image before and after windowing'),
+    'segment'     : ('segment',        'Separate breast from the rest'),
+    'dirichlet'   : ('dirichlet',      'Segmentation using Dirichlet clustering'),
+    'visualize'   : ('visualize',      'Visualize data'),
+    'restructure' : ('restructure',    'Restructure downloaded training data'),
+    'expand'      : ('expand',         'Extract files from zip archive straight into patient directories'),
+    'covariance'  : ('covariance',     'Covariance of metadata fields, overall and by site and machine'),
+    'benchmark'   : ('benchmark',      'Time critical functions, and imports'),
+    'metadata'    : ('metadata',       'Convert train.csv and test.csv to Feather'),
+    'integrity'   : ('integrity',      'Check downloaded images for corrupt or truncated files'),
+    'export'      : ('export',         'Export training examples as tar shards'),
+    'features'    : ('features',       'Compute handcrafted features'),
+    'baseline'    : ('baseline',       'Baseline classifier with cross validation'),
+    'evaluate'    : ('evaluate',       'Probabilistic F1 with threshold sweep'),
+    'infer'       : ('infer',          'Predict test set for submission'),
+    'patches'     : ('patches',        'Extract overlapping patches'),
+    'profile'     : ('profiling',      'Merge profiles from all processes, and write collapsed stacks')
+}
+
+def run(command,args):
+    '''
+    Execute tool as if it had been run as a script
+
+    Parameters:
+        command   Key from COMMANDS
+        args      Command line arguments for tool
+    '''
+    module,_ = COMMANDS[command]
+    argv[:]  = [f'{module}.py'] + args
+    run_module(module,run_name='__main__',alter_sys=True)
+
+if __name__=='__main__':
+    parser = ArgumentParser(description     = __doc__,
+                            formatter_class = RawDescriptionHelpFormatter,
+                            epilog          = '\n'.join(f'  {command:12s} {description}' for command,(_,description) in COMMANDS.items()))
+    parser.add_argument('--profile', default=None,                             help='Profile stages, writing results to this folder (see profiling.py)')
+    parser.add_argument('command', choices=COMMANDS.keys(), metavar='command', help='Tool to be run: see below')
+    parser.add_argument('args',    nargs=REMAINDER,                            help='Passed to tool (use command -h for details)')
+    args = parser.parse_args()
+    if args.profile!=None:
+        from profiling import enable
+        enable(args.profile)
+    run(args.command,args.args)
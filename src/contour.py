@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Extract outline of breast by casting rays from centre of mass and looking for
+    the outermost transition from foreground to background along each ray.
+'''
+
+from numpy                      import add, arange, ceil, clip, concatenate, cos, cumsum, flatnonzero, floor, \
+                                       full, hypot, inf, interp, isnan, linspace, median, nan, ones, pi, repeat, rint, \
+                                       sin, stack, uint8, unique, zeros
+from numpy.lib.stride_tricks    import sliding_window_view
+from visualize                  import get_transitions_batch
+
+def get_centre(pixels,background,step=16):
+    '''
+    Calculate average of coordinates within image, weighted by distance of pixel intensity from background
+
+    Parameters:
+        pixels       Image, with background high
+        background   Pixel value of background
+        step         Only every step-th row and column is used
+
+    Returns:
+        x_c,y_c      Centre of mass, or centre of image if it is all background
+    '''
+    sample     = pixels[::step,::step]
+    mass       = clip(background - sample.astype(float),0,None)
+    mass_total = mass.sum()
+    m,n        = pixels.shape
+    if mass_total==0:
+        return m/2,n/2
+    xs         = arange(0,m,step)
+    ys         = arange(0,n,step)
+    return (xs @ mass.sum(axis=1))/mass_total, (mass.sum(axis=0) @ ys)/mass_total
+
+def get_rays(centre,shape,n_rays=360,n_samples=None):
+    '''
+    Create rays radiating from centre, long enough to reach every corner of image
+
+    Parameters:
+        centre      Origin of rays
+        shape       Shape of image
+        n_rays      Number of rays (angular resolution is 2*pi/n_rays)
+        n_samples   Number of points along each ray (default: one per pixel)
+
+    Returns:
+        angles      Direction of each ray
+        radii       Distance of each sample point from centre
+        xs,ys       n_rays x n_samples arrays giving coordinates of each sample point
+    '''
+    x_c,y_c   = centre
+    m,n       = shape
+    R         = max(hypot(x-x_c,y-y_c) for x in [0,m] for y in [0,n])
+    L         = n_samples if n_samples!=None else int(ceil(R))
+    angles    = arange(n_rays) * 2 * pi / n_rays
+    radii     = linspace(0,R,L)
+    xs        = x_c + cos(angles).reshape(-1,1) * radii
+    ys        = y_c + sin(angles).reshape(-1,1) * radii
+    return angles,radii,xs,ys
+
+def get_profiles(pixels,xs,ys,outside=inf):
+    '''
+    Sample pixel values at specified points, using nearest neighbour
+
+    Parameters:
+        pixels    Image
+        xs,ys     Coordinates of sample points
+        outside   Value used for points that lie outside image
+
+    Returns:
+        An array of pixel values, one for each sample point
+    '''
+    m,n            = pixels.shape
+    i              = rint(xs).astype(int)
+    j              = rint(ys).astype(int)
+    inside         = (i>=0) & (i<m) & (j>=0) & (j<n)
+    profiles       = full(xs.shape,outside,dtype=float)
+    profiles[inside] = pixels[i[inside],j[inside]]
+    return profiles
+
+def get_outermost(rows,transitions,runs,n_rays,min_run=10):
+    '''
+    Find outermost transition along each ray from foreground to background, ignoring
+    any that are bounded by runs that are too short (e.g. noise in background)
+
+    Parameters:
+        rows,transitions,runs    Output from visualize.get_transitions_batch
+        n_rays                   Number of rays
+        min_run                  Shortest acceptable run, inside and outside transition
+
+    Returns:
+        Index of outermost transition for each ray, or nan if there isn't one
+    '''
+    n               = len(rows)
+    first           = ones(n,dtype=bool)
+    first[1:]       = rows[1:]!=rows[:-1]
+    position        = arange(n) - flatnonzero(first)[cumsum(first)-1]    # Index of transition within its ray
+    inner           = transitions.copy()           # Last foreground run extends to centre
+    same_ray        = rows[1:]==rows[:-1]
+    inner[:-1][same_ray] = runs[1:][same_ray]
+    valid           = (position%2==0) & (runs>=min_run) & (inner>=min_run)
+    outermost       = full(n_rays,nan)
+    valid_rays,index = unique(rows[valid],return_index=True)
+    outermost[valid_rays] = transitions[valid][index]
+    return outermost
+
+def smooth(radii,window=5):
+    '''
+    Apply a running median around the circle, and fill in any missing radii by interpolation
+    '''
+    K      = len(radii)
+    angles = arange(K)
+    known  = ~isnan(radii)
+    if not known.any():
+        return zeros(K)
+    filled = interp(angles,angles[known],radii[known],period=K)
+    if window<2:
+        return filled
+    half   = window//2
+    padded = concatenate([filled[K-half:],filled,filled[:window-1-half]])
+    return median(sliding_window_view(padded,window),axis=1)
+
+def get_contour(pixels,
+                background,
+                n_rays    = 360,
+                n_samples = None,
+                epsilon   = 0.001,
+                min_run   = 10,
+                window    = 5,
+                step      = 16):
+    '''
+    Find outline of breast as a polygon
+
+    Parameters:
+        pixels      Image, with background high
+        background  Pixel value of background
+        n_rays      Number of rays, i.e. vertices of polygon
+        n_samples   Number of points along each ray (default: one per pixel)
+        epsilon     Tolerance for deciding that a pixel belongs to background
+        min_run     Shortest run of foreground or background that is treated as genuine
+        window      Size of window used to smooth radii
+        step        Used to subsample image when calculating centre of mass
+
+    Returns:
+        polygon     n_rays x 2 array of vertices
+        centre      Centre of mass, from which rays were cast
+    '''
+    m,n                    = pixels.shape
+    centre                 = get_centre(pixels,background,step=step)
+    angles,radii,xs,ys     = get_rays(centre,pixels.shape,n_rays=n_rays,n_samples=n_samples)
+    profiles               = get_profiles(pixels,xs,ys)
+    rows,transitions,runs  = get_transitions_batch(profiles,background,epsilon=epsilon)
+    outermost              = get_outermost(rows,transitions,runs,n_rays,min_run=min_run)
+    scale                  = radii[-1]/(len(radii)-1) if len(radii)>1 else 0
+    r                      = smooth(outermost*scale,window=window)
+    x_c,y_c                = centre
+    polygon                = stack([clip(x_c + r*cos(angles),0,m-1),
+                                    clip(y_c + r*sin(angles),0,n-1)],axis=1)
+    return polygon,centre
+
+def get_contour_bounds(polygon):
+    '''
+    Find smallest rectangle containing polygon, in the same form as visualize.get_bounds: xmin,ymin,xmax,ymax
+    '''
+    xmin,ymin = floor(polygon.min(axis=0)).astype(int)
+    xmax,ymax = ceil(polygon.max(axis=0)).astype(int) + 1
+    return xmin,ymin,xmax,ymax
+
+def get_mask(polygon,shape):
+    '''
+    Rasterize polygon using a scan line algorithm: a pixel is inside if a horizontal line from the
+    left edge to its centre crosses the polygon an odd number of times. Only the rows and columns
+    within the bounds of the polygon are visited.
+
+    Parameters:
+        polygon   K x 2 array of vertices
+        shape     Shape of image
+
+    Returns:
+        A boolean array, True for pixels inside polygon
+    '''
+    mask                = zeros(shape,dtype=bool)
+    xmin,ymin,xmax,ymax = get_contour_bounds(polygon)
+    x0,y0               = polygon[:,0],polygon[:,1]
+    x1,y1               = concatenate([x0[1:],x0[:1]]),concatenate([y0[1:],y0[:1]])
+    lo                  = ceil(clip(x0,None,x1)).astype(int)
+    hi                  = ceil(clip(x1,x0,None)).astype(int)        # Rows in [lo,hi) cross edge
+    counts              = hi - lo
+    edges               = repeat(arange(len(polygon)),counts)
+    rows                = repeat(lo,counts) + arange(counts.sum()) - repeat(cumsum(counts)-counts,counts)
+    if len(rows)==0:
+        return mask
+    t                   = (rows - x0[edges]) / (x1[edges] - x0[edges])
+    columns             = ceil(y0[edges] + t * (y1[edges] - y0[edges])).astype(int)
+    crossings           = zeros((xmax-xmin,ymax-ymin+1),dtype=uint8)
+    add.at(crossings,(rows-xmin,clip(columns,ymin,ymax)-ymin),1)
+    inside              = cumsum(crossings,axis=1,dtype=uint8)[:,:-1] & 1
+    mask[xmin:xmax,ymin:ymax] = inside
+    return mask
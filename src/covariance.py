@@ -26,19 +26,19 @@
     age, cancer, biopsy, invasive, BIRADS, density, and difficult_negative_case.
 '''
 
-from matplotlib.pyplot     import figure, show
+from argparse              import ArgumentParser
+from collections           import deque
+from concurrent.futures    import ProcessPoolExecutor
+from os                    import cpu_count
 from os.path               import exists, join
-from numpy                 import cov
-from pandas                import read_csv
-from scipy.stats           import linregress
-from seaborn               import heatmap, set
-from sklearn.preprocessing import StandardScaler
+from metadata              import get_csv_file_name, read_typed_csv
+from numpy                 import percentile
+from numpy.random          import default_rng
+from welford               import Moments
 
 
 DATA      = r'd:\data\rsna-breast-cancer-detection'
-TRAIN     = join(DATA,'train.csv')
 FIGS      = '../docs/figs'
-DENSITIES = {'A':0, 'B':1, 'C':2, 'D': 3}
 COLS      = ['age',
              'cancer',
              'biopsy',
@@ -48,37 +48,156 @@ COLS      = ['age',
              'density',
              'difficult_negative_case'
              ]
+GROUPS    = ['site_id', 'machine_id']
 
+def accumulate(chunk,by=GROUPS,bootstrap=0,seed=None):
+    '''
+    Accumulate Moments for one chunk of metadata, both overall and for each value of the grouping columns
 
-df                            = read_csv(TRAIN).dropna()
-df['density']                 = df['density'].apply(lambda x:DENSITIES[x])
-df['difficult_negative_case'] = df['difficult_negative_case'].apply(lambda x:1 if x else 0)
-mean                          = df['cancer'].mean()
-
-result = linregress(df['age'],df['cancer'])
-print(f'P(Cancer)={mean}, slope={result.slope}, intercept={result.intercept}, r value={result.rvalue}')
-
-stdsc   = StandardScaler()
-X_std   = stdsc.fit_transform(df[COLS].iloc[:,range(0,len(COLS))].values)
-cov_mat = cov(X_std.T)
-
-fig     = figure(figsize=(8,8))
-ax      = fig.add_subplot(1,1,1)
-set(font_scale=1.5)
-labels  = COLS[:-1] + ['difficult']
-heatmap(cov_mat,
-        vmin        = -1,
-        vmax        = +1,
-        cmap        = 'seismic',
-        ax          = ax,
-        cbar        = False,
-        annot       = True,
-        square      = True,
-        fmt         = '.2f',
-        annot_kws   = {'size': 12},
-        yticklabels = labels,
-        xticklabels = labels)
-
-fig.tight_layout()
-fig.savefig(join(FIGS,'covariance'))
-show()
+    Parameters:
+        chunk       Rows from train.csv
+        by          Columns used to group rows
+        bootstrap   Number of Poisson bootstrap replicates, accumulated after the actual data
+        seed        Used to initialize random number generator, so results are reproducible
+
+    Returns:
+        A dict mapping group, either ('all',) or (column,value), to Moments
+    '''
+    chunk    = chunk.dropna(subset=COLS+by)
+    X        = chunk[COLS].assign(density=chunk['density'].cat.codes).to_numpy(dtype=float)
+    weights  = default_rng(seed).poisson(1.0,size=(1+bootstrap,len(chunk))).astype(float)
+    weights[0,:] = 1
+    moments  = {('all',) : Moments(len(COLS),1+bootstrap).update(X,weights)}
+    for column in by:
+        values = chunk[column].to_numpy()
+        for value in chunk[column].unique():
+            selected = values==value
+            moments[(column,value)] = Moments(len(COLS),1+bootstrap).update(X[selected],weights[:,selected])
+    return moments
+
+def merge(total,moments):
+    '''
+    Merge Moments from one chunk into running totals
+    '''
+    for key,value in moments.items():
+        if key in total:
+            total[key].merge(value)
+        else:
+            total[key] = value
+    return total
+
+def get_moments(path       = DATA,
+                chunksize  = 100000,
+                by         = GROUPS,
+                bootstrap  = 0,
+                seed       = None,
+                processes  = None):
+    '''
+    Read train.csv in chunks, and accumulate Moments in a pool of processes. Chunks are
+    merged in the order they were read, so results don't depend on scheduling,
+    and only a few chunks are held in memory at once.
+
+    Parameters:
+        path        Location of train.csv
+        chunksize   Number of rows in each chunk
+        by          Columns used to group rows
+        bootstrap   Number of Poisson bootstrap replicates
+        seed        Used to initialize random number generator for each chunk
+        processes   Number of worker processes (default: one per CPU)
+
+    Returns:
+        A dict mapping group to Moments
+    '''
+    total       = {}
+    max_pending = 2*(processes if processes!=None else cpu_count())
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        for i,chunk in enumerate(read_typed_csv(get_csv_file_name(path),chunksize=chunksize)):
+            pending.append(executor.submit(accumulate,chunk,by,bootstrap,None if seed==None else (seed,i)))
+            if len(pending)>max_pending:
+                merge(total,pending.popleft().result())
+        while len(pending)>0:
+            merge(total,pending.popleft().result())
+    return total
+
+def get_confidence_interval(moments,confidence=95):
+    '''
+    Confidence interval for correlation matrix, from bootstrap replicates
+
+    Returns:
+        lower,upper   Bounds for each element of correlation matrix
+    '''
+    correlations = moments.get_correlation()[1:]
+    alpha        = (100 - confidence)/2
+    return percentile(correlations,alpha,axis=0),percentile(correlations,100-alpha,axis=0)
+
+def get_regression(moments,x='age',y='cancer'):
+    '''
+    Least squares regression of one column on another, calculated from Moments
+
+    Returns:
+        slope, intercept, r value
+    '''
+    i           = COLS.index(x)
+    j           = COLS.index(y)
+    covariance  = moments.get_covariance()[0]
+    slope       = covariance[i,j]/covariance[i,i]
+    intercept   = moments.mean[0,j] - slope*moments.mean[0,i]
+    return slope,intercept,moments.get_correlation()[0,i,j]
+
+if __name__=='__main__':
+    from matplotlib.pyplot import figure, show
+    from seaborn           import heatmap, set
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',       default=DATA,                   help='Location of train.csv')
+    parser.add_argument('--chunksize',  default=100000, type=int,       help='Number of rows to read at a time')
+    parser.add_argument('--by',         default=GROUPS, nargs='*',      help='Columns used to group rows')
+    parser.add_argument('--bootstrap',  default=0,      type=int,       help='Number of bootstrap replicates for confidence intervals')
+    parser.add_argument('--seed',       default=None,   type=int,       help='Used to initialize random number generator')
+    parser.add_argument('--processes',  default=None,   type=int,       help='Number of worker processes')
+    parser.add_argument('--show',       default=False,  action='store_true')
+    args = parser.parse_args()
+
+    moments = get_moments(path      = args.path,
+                          chunksize = args.chunksize,
+                          by        = args.by,
+                          bootstrap = args.bootstrap,
+                          seed      = args.seed,
+                          processes = args.processes)
+
+    overall                 = moments[('all',)]
+    mean                    = overall.mean[0,COLS.index('cancer')]
+    slope,intercept,r_value = get_regression(overall)
+    print(f'P(Cancer)={mean}, slope={slope}, intercept={intercept}, r value={r_value}')
+
+    for key,value in sorted(moments.items(),key=lambda item:str(item[0])):
+        print (key, f'n={int(value.n[0])}')
+        print (value.get_correlation()[0].round(2))
+        if args.bootstrap>0:
+            lower,upper = get_confidence_interval(value)
+            print ('95% confidence interval')
+            print (lower.round(2))
+            print (upper.round(2))
+
+    cov_mat = overall.get_correlation()[0]
+    fig     = figure(figsize=(8,8))
+    ax      = fig.add_subplot(1,1,1)
+    set(font_scale=1.5)
+    labels  = COLS[:-1] + ['difficult']
+    heatmap(cov_mat,
+            vmin        = -1,
+            vmax        = +1,
+            cmap        = 'seismic',
+            ax          = ax,
+            cbar        = False,
+            annot       = True,
+            square      = True,
+            fmt         = '.2f',
+            annot_kws   = {'size': 12},
+            yticklabels = labels,
+            xticklabels = labels)
+
+    fig.tight_layout()
+    fig.savefig(join(FIGS,'covariance'))
+    if args.show:
+        show()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Iterable dataset over Loader, for use with a multiprocess DataLoader: each worker
+    loads, crops, and resizes a disjoint share of the images.
+'''
+
+from argparse           import ArgumentParser
+from buffers            import BufferPool
+from concurrent.futures import ProcessPoolExecutor
+from export             import prepare
+from loader             import Loader
+from numpy              import empty, float16, uint8
+from numpy.random       import default_rng
+from time               import perf_counter
+
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset = object
+    def get_worker_info():
+        return None
+
+PATH   = r'D:\data\rsna-breast-cancer-detection'
+DTYPES = {'uint8':uint8, 'float16':float16}
+
+class MammogramDataset(IterableDataset):
+    '''
+    Yields (pixels,label) for each image, where pixels is a rows x columns array, and label is
+    1 for cancer, 0 for no cancer, or -1 if unknown (test data).
+
+    Images are partitioned across workers deterministically, so each image is seen exactly once
+    per epoch however many workers there are. Each worker creates its own Loader, and resizes
+    images straight into the samples that are yielded. If shuffle_buffer is nonzero, samples pass through a
+    buffer of that many samples, so memory is bounded however many images there are.
+    '''
+    def __init__(self,image_ids,
+                 path           = PATH,
+                 dataset        = 'train',
+                 archives       = None,
+                 rows           = 512,
+                 columns        = 256,
+                 dtype          = 'uint8',
+                 shuffle_buffer = 0,
+                 seed           = None):
+        '''
+        Parameters:
+            image_ids        Images to be loaded
+            path             Location of data
+            dataset          train or test
+            archives         Zip files from which images are to be read (default: read from {dataset}_images)
+            rows             Number of rows in each sample
+            columns          Number of columns in each sample
+            dtype            uint8 (0-255) or float16 (scaled to 0-1)
+            shuffle_buffer   Number of samples held for shuffling (0 to preserve order)
+            seed             Used with epoch to shuffle image_ids and samples
+        '''
+        self.image_ids      = list(image_ids)
+        self.path           = path
+        self.dataset        = dataset
+        self.archives       = archives
+        self.rows           = rows
+        self.columns        = columns
+        self.dtype          = DTYPES[dtype]
+        self.shuffle_buffer = shuffle_buffer
+        self.seed           = seed
+        self.epoch          = 0
+        self.loader         = None
+
+    def __getstate__(self):
+        '''Loader is not copied to workers, which create their own'''
+        state           = self.__dict__.copy()
+        state['loader'] = None
+        return state
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def set_epoch(self,epoch):
+        '''Change order of images for next epoch'''
+        self.epoch = epoch
+
+    def get_share(self,worker_id=0,n_workers=1):
+        '''
+        Images to be loaded by one worker: all workers shuffle image_ids identically, then take every n_workers-th
+        '''
+        image_ids = self.image_ids
+        if self.seed!=None:
+            image_ids = [image_ids[i] for i in default_rng((self.seed,self.epoch)).permutation(len(image_ids))]
+        return image_ids[worker_id::n_workers]
+
+    def __iter__(self):
+        info = get_worker_info()
+        if info==None:
+            return self.iterate()
+        return self.iterate(info.id,info.num_workers)
+
+    def iterate(self,worker_id=0,n_workers=1):
+        '''
+        Generate samples for one worker
+        '''
+        samples = self.generate(self.get_share(worker_id,n_workers))
+        if self.shuffle_buffer>0:
+            samples = self.shuffle(samples,default_rng(None if self.seed==None else (self.seed,self.epoch,worker_id)))
+        return samples
+
+    def generate(self,image_ids):
+        '''
+        Load, crop and resize images in order
+        '''
+        if self.loader==None:
+            self.loader = Loader(path=self.path,dataset=self.dataset,archives=self.archives,pool=BufferPool())
+        available = [image_id for image_id in image_ids
+                     if self.loader.has_image(int(self.loader.index.get_row(image_id)['patient_id']),image_id)]
+        for image_id,pixels,_,view,cancer in self.loader.get_images(available):
+            sample = prepare(pixels,view,self.rows,self.columns,out=empty((self.rows,self.columns),dtype=self.dtype))
+            if self.dtype!=uint8:
+                sample /= 255
+            yield sample, -1 if cancer==None else cancer
+
+    def shuffle(self,samples,rng):
+        '''
+        Shuffle samples using a bounded buffer: once buffer is full, each new sample replaces one chosen at random,
+        which is yielded.
+        '''
+        buffer = []
+        for sample in samples:
+            if len(buffer)<self.shuffle_buffer:
+                buffer.append(sample)
+            else:
+                i         = rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = sample
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+def count_samples(dataset,worker_id,n_workers):
+    '''Iterate through one worker's share, as a DataLoader worker would: used to measure throughput'''
+    return sum(1 for _ in dataset.iterate(worker_id,n_workers))
+
+if __name__=='__main__':
+    from metadata import read_metadata
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',       default=PATH,                        help='Location of data')
+    parser.add_argument('--dataset',    default='train',                     help='train or test')
+    parser.add_argument('--archives',   default=None,  nargs='+',            help='Read images from these zip files')
+    parser.add_argument('--rows',       default=512,   type=int,             help='Number of rows in each sample')
+    parser.add_argument('--columns',    default=256,   type=int,             help='Number of columns in each sample')
+    parser.add_argument('--dtype',      default='uint8', choices=DTYPES,     help='Type of samples')
+    parser.add_argument('--N',          default=None,  type=int,             help='Number of images (default: all)')
+    parser.add_argument('--workers',    default=[1,2,4], nargs='+', type=int, help='Numbers of workers whose throughput is to be measured')
+    args      = parser.parse_args()
+    image_ids = read_metadata(args.path,args.dataset)['image_id'].tolist()[:args.N]
+    dataset   = MammogramDataset(image_ids,
+                                 path     = args.path,
+                                 dataset  = args.dataset,
+                                 archives = args.archives,
+                                 rows     = args.rows,
+                                 columns  = args.columns,
+                                 dtype    = args.dtype)
+    for n_workers in args.workers:
+        start = perf_counter()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            n = sum(executor.map(count_samples,[dataset]*n_workers,range(n_workers),[n_workers]*n_workers))
+        elapsed = perf_counter() - start
+        print (f'{n_workers} workers: {n} samples in {elapsed:.1f} sec, {n/elapsed:.1f} samples/sec')
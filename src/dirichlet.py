@@ -25,15 +25,12 @@
 
 
 from argparse          import ArgumentParser
-from cv2               import resize, INTER_CUBIC
-from loader            import get_all_images,  Loader
-from matplotlib.pyplot import close, figure, show
-from numpy             import argmax, argmin, argsort, array, histogram, zeros
+from numpy             import argmax, argmin, argsort, argwhere, array, histogram, sqrt, zeros
 from numpy.linalg      import norm
 from numpy.random      import default_rng
 from os.path           import join
 from os                import walk
-from sys               import float_info
+from profiling         import stage
 
 class Component:
     '''
@@ -55,11 +52,8 @@ class Component:
         '''
         Find shortest distance between points in this Component and one other
         '''
-        distance = float_info.max
-        for pt1 in self.points:
-            for pt2 in component.points:
-                distance = min(distance,norm(pt1-pt2))
-        return distance
+        differences = array(self.points)[:,None,:] - array(component.points)[None,:,:]
+        return sqrt((differences**2).sum(axis=2)).min()
 
 class Segmenter:
     '''
@@ -97,11 +91,7 @@ class Segmenter:
         '''
         Find points that are in forground accouding to threshold
         '''
-        m,n = img.shape
-        for i in range(m):
-            for j in range(n):
-                if img[i,j]<threshold:
-                    self.points.append((i,j))
+        self.points.extend((i,j) for i,j in argwhere(img<threshold).tolist())
 
     def samples(self,size=1):
         '''
@@ -114,15 +104,16 @@ class Segmenter:
         '''
         Perform Dirichlet clustering
         '''
-        for sample in self.samples(size=N):
-            if len(self.components)==0:
-                self.components.append(Component(sample))
-            else:
-                nearest_component,distance = self.get_nearest_component(sample)
-                if distance<lambda_:
-                    nearest_component.add(sample)
-                else:
+        with stage('clustering'):
+            for sample in self.samples(size=N):
+                if len(self.components)==0:
                     self.components.append(Component(sample))
+                else:
+                    nearest_component,distance = self.get_nearest_component(sample)
+                    if distance<lambda_:
+                        nearest_component.add(sample)
+                    else:
+                        self.components.append(Component(sample))
 
     def get_nearest_component(self,sample):
         '''
@@ -175,21 +166,26 @@ class Segmenter:
             sizes = [len(c) for c in connected_components_unsorted]
             self.connected_components = [connected_components_unsorted[i] for i in argsort(sizes)[::-1]]
 
-        organize(connect())
+        with stage('merging'):
+            organize(connect())
 
     def create_distances(self):
         '''
         Create an array that holds distances between pairs of components
         '''
-        n       = len(self.components)
-        product = zeros((n,n))
-        for i in range(n):
-            for j in range(i,n):
-                product[i,j] = self.components[i].get_distance(self.components[j])
-                product[j,i] = product[i,j]
+        with stage('distances'):
+            n       = len(self.components)
+            product = zeros((n,n))
+            for i in range(n):
+                for j in range(i,n):
+                    product[i,j] = self.components[i].get_distance(self.components[j])
+                    product[j,i] = product[i,j]
         return product
 
 if __name__=='__main__':
+    from cv2               import resize, INTER_CUBIC
+    from loader            import get_all_images,  Loader
+    from matplotlib.pyplot import close, figure, show
     FIGS   = '../docs/figs'
     parser = ArgumentParser(__doc__)
     parser.add_argument('image_ids', nargs='*', type=int, default=[], help='Image-ids to be segmented (omit for all images)')
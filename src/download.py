@@ -22,16 +22,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-TYPE   = 'train_images'
+'''
+    Download selected data from kaggle: write batch file for all training images in listing
+'''
 
-def download(name,out):
-    parts = name.split('/')
-    if parts[0].startswith(TYPE):
-        out.write(f'kaggle competitions download -f {name} rsna-breast-cancer-detection\n')
-
-with open('download.bat','w') as out,open(r'D:\data\rsna-breast-cancer-detection/files.txt') as f:
-    for line in f:
-        name = line.split()[0]
-        if name.endswith('dcm'):
-            download(name,out)
+from os.path import join
+from planner import PATH, parse_listing, select, write_batch
 
+if __name__=='__main__':
+    write_batch([name for name,_,_ in select(parse_listing(join(PATH,'files.txt')),None)],'download.bat')
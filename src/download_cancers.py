@@ -27,38 +27,15 @@
 '''
 
 from argparse          import ArgumentParser
-from matplotlib.pyplot import figure, show
-from os.path           import exists, join
-from pandas            import read_csv
-from visualize         import get_bounds
+from metadata          import read_metadata
+from planner           import get_remote_from_master, select, write_batch
 
 DATA                = '../data'
-TRAIN               = join(DATA,'train.csv')
-FIGS                = '../docs/figs'
-
-
-parser = ArgumentParser('Visualize Data',__doc__)
-parser.add_argument('--show', default=False, action='store_true')
-args = parser.parse_args()
-
-with open('download_cancers.bat','w') as out:
-    for _,row in read_csv(TRAIN).iterrows():
-        site_id                 = row['site_id']
-        patient_id              = row['patient_id']
-        image_id                = row['image_id']
-        laterality              = row['laterality']
-        view                    = row['view']
-        age                     = row['age']
-        cancer                  = row['cancer']
-        biopsy                  = row['biopsy']
-        invasive                = row['invasive']
-        BIRADS                  = row['BIRADS']
-        implant                 = row['implant']
-        density                 = row['density']
-        machine_id              = row['machine_id']
-        difficult_negative_case = row['difficult_negative_case']
-        path                    = '../data'
-        if cancer==1:
-            out.write(f'kaggle competitions download -f train_images/{patient_id}/{image_id}.dcm  -p {path} rsna-breast-cancer-detection\n')
-
 
+if __name__=='__main__':
+    parser = ArgumentParser('Download cancers',__doc__)
+    parser.parse_args()
+    master = read_metadata(DATA)
+    write_batch([name for name,_,_ in select(get_remote_from_master(master),master,cancer=True)],
+                'download_cancers.bat',
+                path = DATA)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Evaluate predictions using the competition metric, probabilistic F1 for each breast,
+    sweeping all thresholds at once, with bootstrap confidence intervals.
+'''
+
+from argparse           import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from numpy              import append, arange, argsort, asarray, atleast_2d, concatenate, cumsum, full, nan, nanargmax, ones, \
+                               percentile, take_along_axis, where
+from numpy.random       import default_rng
+from os                 import cpu_count
+
+BREAST = ['patient_id', 'laterality']
+
+def aggregate(df,how='mean',by=BREAST):
+    '''
+    Combine predictions for images into predictions for breasts
+
+    Parameters:
+        df    Predictions for images: must include probability, cancer, and columns in by
+        how   Any aggregation understood by pandas, e.g. mean, max, median
+        by    Columns identifying breast
+
+    Returns:
+        One row for each breast, with probability and cancer
+    '''
+    return df.groupby(by,observed=True).agg(probability = ('probability',how),
+                                            cancer      = ('cancer','max')).reset_index()
+
+def pf1(labels,probabilities,weights=None):
+    '''
+    Probabilistic F1: each prediction counts as a fraction of a true or false positive
+    '''
+    labels        = asarray(labels,dtype=float)
+    probabilities = asarray(probabilities,dtype=float)
+    weights       = ones(len(labels)) if weights is None else asarray(weights,dtype=float)
+    ctp           = (weights*probabilities*labels).sum()
+    cfp           = (weights*probabilities*(1-labels)).sum()
+    denominator   = ctp + cfp + (weights*labels).sum()
+    return 2*ctp/denominator if denominator>0 else 0.0
+
+def sweep(labels,probabilities,weights=None,binary=True):
+    '''
+    Score every threshold at once: sort predictions in descending order, so the predictions at or above
+    each threshold form a prefix, whose true positives can be found from cumulative sums.
+
+    Parameters:
+        labels          1 for cancer, 0 for none
+        probabilities   Predictions, either a vector, or n_models x n_breasts
+        weights         Weight of each breast, either a vector, or n_replicates x n_breasts, e.g. for bootstrap
+        binary          If True, predictions at or above threshold count as 1 (F1 of thresholded predictions);
+                        if False, they keep their probabilities (pF1 after predictions below threshold are set to 0)
+
+    Returns:
+        thresholds   n_models x n_breasts: sorted probabilities
+        scores       n_replicates x n_models x n_breasts: score if each threshold is used,
+                     nan where threshold is tied with the next
+    '''
+    labels        = asarray(labels,dtype=float)
+    probabilities = atleast_2d(asarray(probabilities,dtype=float))
+    weights       = ones((1,len(labels))) if weights is None else atleast_2d(asarray(weights,dtype=float))
+    order         = argsort(-probabilities,axis=1,kind='stable')
+    thresholds    = take_along_axis(probabilities,order,axis=1)
+    y             = labels[order]
+    w             = weights[:,order]
+    value         = 1.0 if binary else thresholds
+    tp            = cumsum(w*y*value,axis=-1)
+    predicted     = cumsum(w*value,axis=-1)
+    denominator   = predicted + (w*y).sum(axis=-1,keepdims=True)
+    scores        = where(denominator>0,2*tp/where(denominator>0,denominator,1),0.0)
+    last          = append(thresholds[:,1:]!=thresholds[:,:-1],full((len(thresholds),1),True),axis=1)
+    return thresholds,where(last,scores,nan)
+
+def get_best(thresholds,scores):
+    '''
+    Best threshold and its score
+
+    Parameters:
+        thresholds, scores   From sweep
+
+    Returns:
+        threshold, score   n_replicates x n_models
+    '''
+    best = nanargmax(scores,axis=-1)
+    return thresholds[arange(len(thresholds)),best], take_along_axis(scores,best[...,None],axis=-1)[...,0]
+
+def compare(labels,probabilities,binary=True,chunk_size=256):
+    '''
+    Best threshold and score for many candidate models, a few at a time, so memory is bounded
+
+    Parameters:
+        labels          1 for cancer, 0 for none
+        probabilities   n_models x n_breasts
+        binary          Passed to sweep
+        chunk_size      Number of models scored at once
+
+    Returns:
+        threshold, score   For each model
+    '''
+    best = [get_best(*sweep(labels,probabilities[i:i+chunk_size],binary=binary))
+            for i in range(0,len(probabilities),chunk_size)]
+    return concatenate([threshold[0] for threshold,_ in best]), concatenate([score[0] for _,score in best])
+
+def bootstrap_chunk(labels,probabilities,replicates,seed,binary=True):
+    '''
+    Best score for some Poisson bootstrap replicates: executed in worker process
+    '''
+    weights  = default_rng(seed).poisson(1.0,size=(replicates,len(labels)))
+    _,scores = get_best(*sweep(labels,probabilities,weights=weights,binary=binary))
+    return scores
+
+def bootstrap(labels,probabilities,
+              replicates = 1000,
+              seed       = None,
+              binary     = True,
+              confidence = 95,
+              processes  = None):
+    '''
+    Confidence interval for best score, using Poisson bootstrap replicates, computed in parallel
+
+    Parameters:
+        labels          1 for cancer, 0 for none
+        probabilities   Predictions, either a vector, or n_models x n_breasts
+        replicates      Number of bootstrap replicates
+        seed            Used with chunk number to initialize random number generator in each process
+        binary          Passed to sweep
+        confidence      Width of interval (percent)
+        processes       Number of worker processes
+
+    Returns:
+        lower, upper   Bounds for each model
+    '''
+    processes = processes if processes!=None else cpu_count()
+    sizes     = [replicates//processes + (1 if i<replicates%processes else 0) for i in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(bootstrap_chunk,labels,probabilities,size,None if seed==None else (seed,i),binary)
+                   for i,size in enumerate(sizes) if size>0]
+        scores  = [future.result() for future in futures]
+    scores = concatenate(scores,axis=0)
+    alpha  = (100 - confidence)/2
+    return percentile(scores,alpha,axis=0),percentile(scores,100-alpha,axis=0)
+
+if __name__=='__main__':
+    from pandas import read_csv
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('predictions',  nargs='?', default='image_probabilities.csv', help='Predictions for images, e.g. from baseline.py')
+    parser.add_argument('--how',        default='mean',                             help='Aggregation used to combine images for each breast')
+    parser.add_argument('--replicates', default=1000, type=int,                     help='Number of bootstrap replicates')
+    parser.add_argument('--seed',       default=None, type=int,                     help='Used to initialize random number generator')
+    parser.add_argument('--processes',  default=None, type=int,                     help='Number of worker processes')
+    args     = parser.parse_args()
+    breasts  = aggregate(read_csv(args.predictions),how=args.how)
+    labels   = breasts['cancer'].to_numpy().astype(int)
+    print (f'{len(breasts)} breasts, {labels.sum()} with cancer: pF1={pf1(labels,breasts["probability"]):.4f}')
+    for binary in [True,False]:
+        threshold,score = get_best(*sweep(labels,breasts['probability'],binary=binary))
+        lower,upper     = bootstrap(labels,breasts['probability'],
+                                    replicates = args.replicates,
+                                    seed       = args.seed,
+                                    binary     = binary,
+                                    processes  = args.processes)
+        print (f'{"Binary" if binary else "Probabilistic"}: best threshold={threshold[0,0]:.4f}, score={score[0,0]:.4f}, '
+               f'95% confidence interval {lower[0]:.4f}-{upper[0]:.4f}')
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Build bilateral exams: all images for one patient, arranged in slots by laterality and view,
+    so a model can compare one breast with the other.
+'''
+
+from argparse           import ArgumentParser
+from buffers            import BufferPool
+from collections        import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from export             import prepare
+from loader             import Loader
+from metadata           import VIEWS
+from numpy              import add, arange, array, full, int64, repeat, uint8, unique, zeros
+from os                 import cpu_count
+from time               import perf_counter
+
+PATH        = r'D:\data\rsna-breast-cancer-detection'
+LATERALITY  = ['L', 'R']
+MAIN_VIEWS  = VIEWS[:2]
+EXTRA_VIEWS = VIEWS[2:]
+
+Exam = namedtuple('Exam',['patient_id','pixels','mask','image_ids','cancer'])
+Exam.__doc__ = '''
+    All images for one patient
+
+    Fields:
+        patient_id   Identifies patient
+        pixels       n_slots x rows x columns, with each image oriented, cropped, and resized
+        mask         For each slot, True if there is an image
+        image_ids    For each slot, image that was used, or -1
+        cancer       For each laterality, 1 if breast has cancer, 0 if not, -1 if unknown
+'''
+
+class ExamIndex:
+    '''
+    Assign each image to a slot, (laterality,view), once for all patients.
+
+    Attributes:
+        slots         (laterality,view) for each slot: L and R for CC and MLO, optionally followed by extra views
+        patient_ids   Each patient, in same order as PatientIndex
+        image_ids     n_patients x n_slots: image for each slot, or -1 if patient has no image for slot
+        counts        n_patients x n_slots: number of images available for each slot; if more than 1, first is used
+        extra         For each patient, number of images whose views have no slot
+        cancer        n_patients x 2, for each laterality
+    '''
+    def __init__(self,index,extra_views=False):
+        '''
+        Parameters:
+            index         PatientIndex for master file
+            extra_views   Include slots for AT, LM, ML, and LMO, as well as CC and MLO
+        '''
+        views            = MAIN_VIEWS + (EXTRA_VIEWS if extra_views else [])
+        self.slots       = [(laterality,view) for view in views for laterality in LATERALITY]
+        self.patient_ids = index.patient_ids
+        n_patients       = len(index.patient_ids)
+        df               = index.df
+        patient          = repeat(arange(n_patients),index.patient_ends-index.patient_starts)
+        lookup           = {slot:i for i,slot in enumerate(self.slots)}
+        slot             = array([lookup.get(key,-1) for key in zip(df['laterality'],df['view'])],dtype=int64)
+        has_slot         = slot>=0
+        self.image_ids   = full((n_patients,len(self.slots)),-1,dtype=int64)
+        _,first          = unique((patient*len(self.slots)+slot)[has_slot],return_index=True)  # First image for each patient and slot
+        first            = arange(len(df))[has_slot][first]
+        self.image_ids[patient[first],slot[first]] = df['image_id'].to_numpy()[first]
+        self.counts      = zeros((n_patients,len(self.slots)),dtype=int64)
+        add.at(self.counts,(patient[has_slot],slot[has_slot]),1)
+        self.extra       = zeros(n_patients,dtype=int64)
+        add.at(self.extra,patient[~has_slot],1)
+        self.cancer      = full((n_patients,len(LATERALITY)),-1,dtype=int64)
+        if 'cancer' in df.columns and len(df)>0:
+            side = array([LATERALITY.index(laterality) for _,laterality in index.breasts],dtype=int64)
+            self.cancer[patient[index.breast_starts],side] = index.cancer
+        self.position    = {patient_id:i for i,patient_id in enumerate(self.patient_ids)}
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+loader = None
+
+def initialize(path,dataset,archives):
+    '''Create a Loader for worker process'''
+    global loader
+    loader = Loader(path=path,dataset=dataset,archives=archives,pool=BufferPool())
+
+def build_exam(patient_id,image_ids,cancer,rows,columns):
+    '''
+    Load images for one patient into a single contiguous array: executed in worker process.
+    Images that cannot be loaded or prepared are reported, and their slots left empty.
+
+    Parameters:
+        patient_id   Identifies patient
+        image_ids    For each slot, image to be loaded, or -1
+        cancer       For each laterality
+        rows         Number of rows for each slot
+        columns      Number of columns for each slot
+    '''
+    pixels   = full((len(image_ids),rows,columns),255,dtype=uint8)
+    mask     = zeros(len(image_ids),dtype=bool)
+    slot     = {image_id:i for i,image_id in enumerate(image_ids) if image_id>=0 and loader.has_image(patient_id,image_id)}
+    for image_id,img,_,view,_ in loader.get_images(list(slot),skip_errors=True):
+        i = slot[image_id]
+        try:
+            prepare(img,view,rows,columns,out=pixels[i])
+        except Exception as e:
+            print (f'{image_id}: {e}')
+            pixels[i] = 255
+            continue
+        mask[i] = True
+    return Exam(patient_id = patient_id,
+                pixels     = pixels,
+                mask       = mask,
+                image_ids  = image_ids,
+                cancer     = cancer)
+
+def build_exams(exam_index,patient_ids,
+                path      = PATH,
+                dataset   = 'train',
+                archives  = None,
+                rows      = 512,
+                columns   = 256,
+                processes = None):
+    '''
+    Build exams in a pool of processes. Exams are yielded in the same order as patient_ids,
+    and only a few are held in memory at once.
+
+    Parameters:
+        exam_index    Assigns images to slots
+        patient_ids   Patients whose exams are to be built
+        path          Location of data
+        dataset       train or test
+        archives      Zip files from which images are to be read (default: read from {dataset}_images)
+        rows          Number of rows for each slot
+        columns       Number of columns for each slot
+        processes     Number of worker processes
+
+    Yields:
+        Exam for each patient
+    '''
+    max_pending = 2*(processes if processes!=None else cpu_count())
+    with ProcessPoolExecutor(max_workers = processes,
+                             initializer = initialize,
+                             initargs    = (path,dataset,archives)) as executor:
+        pending = deque()
+        for patient_id in patient_ids:
+            i = exam_index.position[patient_id]
+            pending.append(executor.submit(build_exam,patient_id,exam_index.image_ids[i],exam_index.cancer[i],rows,columns))
+            if len(pending)>max_pending:
+                yield pending.popleft().result()
+        while len(pending)>0:
+            yield pending.popleft().result()
+
+if __name__=='__main__':
+    from metadata import read_metadata
+    from patients import PatientIndex
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('patient_ids',  nargs='*', type=int,                  help='Patients whose exams are to be built (omit for patients with cancer on one side only)')
+    parser.add_argument('--path',       default=PATH,                         help='Location of data')
+    parser.add_argument('--dataset',    default='train',                      help='train or test')
+    parser.add_argument('--archives',   default=None,  nargs='+',             help='Read images from these zip files')
+    parser.add_argument('--rows',       default=512,   type=int,              help='Number of rows for each slot')
+    parser.add_argument('--columns',    default=256,   type=int,              help='Number of columns for each slot')
+    parser.add_argument('--extra',      default=False, action='store_true',   help='Include slots for AT, LM, ML, and LMO')
+    parser.add_argument('--processes',  default=None,  type=int,              help='Number of worker processes')
+    args       = parser.parse_args()
+    index      = PatientIndex(read_metadata(args.path,args.dataset))
+    exam_index = ExamIndex(index,extra_views=args.extra)
+    print (f'{len(exam_index)} patients, {(exam_index.counts>1).sum()} slots with more than one image, {(exam_index.extra>0).sum()} patients with extra views')
+    patient_ids = args.patient_ids if len(args.patient_ids)>0 else index.patient_ids[index.cancer_on_one_side_only]
+    start       = perf_counter()
+    n_exams     = 0
+    n_images    = 0
+    for exam in build_exams(exam_index,patient_ids,
+                            path      = args.path,
+                            dataset   = args.dataset,
+                            archives  = args.archives,
+                            rows      = args.rows,
+                            columns   = args.columns,
+                            processes = args.processes):
+        n_exams  += 1
+        n_images += exam.mask.sum()
+        print (exam.patient_id, ' '.join(f'{laterality}{view}' for (laterality,view),present in zip(exam_index.slots,exam.mask) if present), exam.cancer)
+    elapsed = perf_counter() - start
+    print (f'{n_exams} exams, {n_images} images in {elapsed:.1f} sec, {n_images/elapsed:.1f} images/sec')
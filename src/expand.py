@@ -23,22 +23,122 @@
 
 '''Extract files from zip archive downloaded from kaggle'''
 
-from os      import rename, walk
-from os.path import join
-from zipfile import ZipFile
+from argparse           import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os                 import makedirs, remove, replace
+from os.path            import basename, dirname, exists, getsize, join, splitext
+from threading          import local
+from zipfile            import BadZipFile, ZipFile
+from zlib               import crc32
 
-PATH = r'D:\data\rsna-breast-cancer-detection/'
+PATH  = r'D:\data\rsna-breast-cancer-detection/'
+BLOCK = 1<<20
 
-zipfile = ZipFile(join(PATH,'part.zip'))
+def parse_member_name(name):
+    '''
+    Extract patient_id and image_id from name of archive member, which may be
+    either patient_id_image_id.dcm, or patient_id/image_id.dcm
 
-for filename in zipfile.namelist():
-    print (filename)
-    parts = filename.split('_')
-    zipfile.extract(filename,path=join(PATH,'train_images',parts[0]))
+    Returns:
+        patient_id, image_id, extension
+    '''
+    stem,ext = splitext(basename(name))
+    parts    = stem.split('_')
+    if len(parts)>1:
+        return parts[0],parts[1],ext
+    else:
+        return basename(dirname(name)),stem,ext
 
-for  dirpath, _, filenames in walk(join(PATH,'train_images')):
-    for filename in filenames:
-        parts = filename.split('_')
-        if len(parts)>1:
-            print (dirpath, filename, parts[1])
-            rename(join(dirpath,filename),join(dirpath,parts[1]))
+def get_destination(images_path,name):
+    '''
+    Map name of archive member to its final location, train_images/patient_id/image_id.dcm.
+    '''
+    patient_id,image_id,ext = parse_member_name(name)
+    return join(images_path,patient_id,f'{image_id}{ext}')
+
+def get_crc(file_name):
+    '''Calculate CRC-32 for file, as used in zip archives'''
+    crc = 0
+    with open(file_name,'rb') as f:
+        while block:=f.read(BLOCK):
+            crc = crc32(block,crc)
+    return crc
+
+def is_current(info,destination):
+    '''Verify that member has already been extracted: size is checked first, as it is cheaper'''
+    return exists(destination) and getsize(destination)==info.file_size and get_crc(destination)==info.CRC
+
+class Extractor:
+    '''
+    Extract members of a zip archive in a pool of threads, each with its own handle to the archive.
+    Decompression releases the GIL, so threads can run in parallel.
+    '''
+    def __init__(self,zip_file,images_path):
+        self.zip_file    = zip_file
+        self.images_path = images_path
+        self.local       = local()
+
+    def get_archive(self):
+        if not hasattr(self.local,'archive'):
+            self.local.archive = ZipFile(self.zip_file)
+        return self.local.archive
+
+    def extract(self,info):
+        '''
+        Extract one member, unless it has already been extracted. The member is written to a
+        temporary file, and only moved into place if its CRC is correct.
+
+        Returns:
+            True if member was extracted, False if it was skipped
+        '''
+        destination = get_destination(self.images_path,info.filename)
+        if is_current(info,destination):
+            return False
+        makedirs(dirname(destination),exist_ok=True)
+        temp = f'{destination}.partial'
+        crc  = 0
+        try:
+            with self.get_archive().open(info) as source, open(temp,'wb') as out:
+                while block:=source.read(BLOCK):
+                    crc = crc32(block,crc)
+                    out.write(block)
+            if crc!=info.CRC:
+                raise BadZipFile(f'Bad CRC-32 for {info.filename}')
+            replace(temp,destination)
+        finally:
+            if exists(temp):
+                remove(temp)
+        return True
+
+    def extract_all(self,threads=8):
+        '''
+        Extract all images in archive
+
+        Returns:
+            Numbers of members extracted, skipped, and failed
+        '''
+        members   = [info for info in ZipFile(self.zip_file).infolist() if not info.is_dir()]
+        extracted = 0
+        skipped   = 0
+        failed    = 0
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for info,future in [(info,executor.submit(self.extract,info)) for info in members]:
+                try:
+                    if future.result():
+                        extracted += 1
+                    else:
+                        skipped += 1
+                except (BadZipFile,OSError) as e:
+                    print (info.filename,e)
+                    failed += 1
+        return extracted,skipped,failed
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('archives', nargs='*', default=['part.zip'], help='Archives to be extracted')
+    parser.add_argument('--path',    default=PATH,         help='Location of data')
+    parser.add_argument('--threads', default=8, type=int,  help='Number of threads')
+    args = parser.parse_args()
+    for archive in args.archives:
+        extracted,skipped,failed = Extractor(join(args.path,archive),join(args.path,'train_images')).extract_all(threads=args.threads)
+        print (f'{archive}: extracted {extracted}, skipped {skipped} already present, {failed} failed')
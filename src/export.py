@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Export training examples as WebDataset style tar shards: each image is oriented, cropped
+    by its segmenter, and resized, then stored with a json record of its metadata.
+    An index records where each sample is stored, so samples can be read in any order,
+    but shards can also be read sequentially.
+'''
+
+from argparse           import ArgumentParser
+from buffers            import BufferPool
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cv2                import IMREAD_UNCHANGED, imdecode, imencode
+from io                 import BytesIO
+from json               import dumps, loads
+from loader             import Loader
+from math               import ceil
+from mosaic             import fit
+from numpy              import frombuffer, full, uint8
+from os                 import makedirs, replace
+from os.path            import basename, join
+from planner            import balance
+from segment            import Segmenter
+from tarfile            import BLOCKSIZE, TarInfo, open as open_tar
+from time               import perf_counter
+
+PATH    = r'D:\data\rsna-breast-cancer-detection'
+OUTPUT  = join(PATH,'shards')
+FIELDS  = ['patient_id', 'image_id', 'laterality', 'view', 'cancer', 'density', 'site_id']
+FORMATS = ['png', 'raw']
+
+def letterbox(img,rows,columns,background=255,out=None):
+    '''
+    Shrink image, preserving aspect ratio, and place it at top left of a canvas of fixed size.
+    Orientation has been standardized, so the chest wall is at the left.
+
+    Parameters:
+        img          Image to be shrunk
+        rows         Number of rows in canvas
+        columns      Number of columns in canvas
+        background   Value for pixels that are not covered by image
+        out          Canvas to be reused (default: allocate a new one)
+    '''
+    if out is None:
+        out = full((rows,columns),background,dtype=uint8)
+    else:
+        out.fill(background)
+    tile       = fit(img,rows,columns)
+    p,q        = tile.shape
+    out[:p,:q] = tile
+    return out
+
+def prepare(pixels,view,rows,columns,out=None):
+    '''
+    Standardize orientation and crop using segmenter for view, then shrink to fixed size
+    '''
+    segmenter = Segmenter.Create(view)
+    if segmenter!=None:
+        cropped = segmenter.segment(pixels)
+        if cropped.size>0:
+            pixels = cropped
+    return letterbox(pixels,rows,columns,out=out)
+
+def get_record(row,rows,columns):
+    '''
+    Metadata for one sample, in a form that can be stored as json
+    '''
+    record = {}
+    for field in FIELDS:
+        value = row[field] if field in row else None
+        if value!=None and value==value:                   # Exclude NaN
+            value = value if field in ['laterality','view','density'] else int(value)
+        else:
+            value = None
+        record[field] = value
+    record['rows']    = rows
+    record['columns'] = columns
+    return record
+
+def encode(pixels,format='png'):
+    '''
+    Convert pixels to bytes: png is compressed, raw is a fixed size record
+    '''
+    if format=='raw':
+        return pixels.tobytes()
+    ok,buffer = imencode('.png',pixels)
+    if not ok:
+        raise RuntimeError('Could not encode image')
+    return buffer.tobytes()
+
+def decode(data,format,rows,columns):
+    '''
+    Convert bytes from encode back to pixels
+    '''
+    if format=='raw':
+        return frombuffer(data,dtype=uint8).reshape(rows,columns)
+    return imdecode(frombuffer(data,dtype=uint8),IMREAD_UNCHANGED)
+
+def add_member(tar,name,data):
+    '''
+    Add data to tar file
+
+    Returns:
+        Offset of data within tar file
+    '''
+    info      = TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info,BytesIO(data))
+    return tar.offset - BLOCKSIZE*ceil(len(data)/BLOCKSIZE)     # Data follows header, padded to whole blocks
+
+loader = None
+
+def initialize(path,dataset,archives):
+    '''Create a Loader for worker process'''
+    global loader
+    loader = Loader(path=path,dataset=dataset,archives=archives,pool=BufferPool())
+
+def write_shard(file_name,image_ids,rows=512,columns=256,format='png'):
+    '''
+    Prepare images and write them to one shard: executed in worker process.
+    The shard is written to a temporary file, which is renamed once it is complete.
+    Images that cannot be loaded or prepared are reported and left out.
+
+    Returns:
+        Index entries: image_id, shard, offset and size of image, offset and size of record
+    '''
+    entries = []
+    temp    = f'{file_name}.tmp'
+    with open_tar(temp,'w') as tar:
+        for image_id,pixels,laterality,view,_ in loader.get_images(image_ids,skip_errors=True):
+            try:
+                data = encode(prepare(pixels,view,rows,columns),format)
+            except Exception as e:
+                print (f'{image_id}: {e}')
+                continue
+            record = dumps(get_record(loader.index.get_row(image_id),rows,columns)).encode()
+            entries.append((image_id,
+                            basename(file_name),
+                            add_member(tar,f'{image_id}.{format}',data),
+                            len(data),
+                            add_member(tar,f'{image_id}.json',record),
+                            len(record)))
+    replace(temp,file_name)
+    return entries
+
+def export(image_ids,
+           path        = PATH,
+           dataset     = 'train',
+           output      = OUTPUT,
+           archives    = None,
+           rows        = 512,
+           columns     = 256,
+           format      = 'png',
+           shard_bytes = 1<<30,
+           processes   = None):
+    '''
+    Write shards in a pool of processes, then write index
+
+    Parameters:
+        image_ids     Images to be exported
+        path          Location of data
+        dataset       train or test
+        output        Where shards are to be written
+        archives      Zip files from which images are to be read (default: read from {dataset}_images)
+        rows          Number of rows in each sample
+        columns       Number of columns in each sample
+        format        png or raw
+        shard_bytes   Target for size of input images in each shard, used to balance shards
+        processes     Number of worker processes
+
+    Returns:
+        Names of shard files
+    '''
+    makedirs(output,exist_ok=True)
+    sizer   = Loader(path=path,dataset=dataset,archives=archives)
+    sizes   = []
+    for image_id in image_ids:
+        patient_id = int(sizer.index.get_row(image_id)['patient_id'])
+        if sizer.has_image(patient_id,image_id):
+            sizes.append((image_id,sizer.storage.get_size(patient_id,image_id)))
+    shards  = balance(sizes,max_bytes=shard_bytes)
+    names   = [join(output,f'shard-{i:06d}.tar') for i in range(len(shards))]
+    entries = []
+    start   = perf_counter()
+    with ProcessPoolExecutor(max_workers = processes,
+                             initializer = initialize,
+                             initargs    = (path,dataset,archives)) as executor:
+        futures = [executor.submit(write_shard,name,shard,rows,columns,format) for name,shard in zip(names,shards)]
+        for future in as_completed(futures):
+            entries.extend(future.result())
+    print (f'Exported {len(entries)} images to {len(names)} shards in {perf_counter()-start:.1f} sec')
+    write_index(entries,output,format)
+    return names
+
+def write_index(entries,output,format):
+    '''
+    Write index, so any sample can be read without scanning shards
+    '''
+    with open(join(output,'index.csv'),'w') as out:
+        out.write(f'# format={format}\n')
+        out.write('image_id,shard,offset,size,record_offset,record_size\n')
+        for entry in sorted(entries):
+            out.write(','.join(str(value) for value in entry) + '\n')
+
+class ShardReader:
+    '''
+    Read samples from shards in any order, using index
+    '''
+    def __init__(self,output=OUTPUT):
+        self.output  = output
+        self.entries = {}
+        with open(join(output,'index.csv')) as index:
+            self.format = index.readline().strip().split('=')[1]
+            index.readline()
+            for line in index:
+                image_id,shard,offset,size,record_offset,record_size = line.strip().split(',')
+                self.entries[int(image_id)] = (shard,int(offset),int(size),int(record_offset),int(record_size))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self,image_id):
+        '''
+        Returns:
+            pixels, metadata record
+        '''
+        shard,offset,size,record_offset,record_size = self.entries[image_id]
+        with open(join(self.output,shard),'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+            f.seek(record_offset)
+            record = loads(f.read(record_size))
+        return decode(data,self.format,record['rows'],record['columns']),record
+
+def iterate_shard(file_name):
+    '''
+    Read all samples from one shard sequentially, in a single pass
+
+    Yields:
+        pixels, metadata record
+    '''
+    pending = {}
+    with open_tar(file_name,'r|') as tar:
+        for info in tar:
+            key,ext       = info.name.rsplit('.',1)
+            pending.setdefault(key,{})[ext] = tar.extractfile(info).read()
+            if len(pending[key])==2:
+                sample = pending.pop(key)
+                record = loads(sample.pop('json'))
+                format,data = sample.popitem()
+                yield decode(data,format,record['rows'],record['columns']),record
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('image_ids',     nargs='*', type=int,                  help='Images to be exported (omit for all images)')
+    parser.add_argument('--path',        default=PATH,                         help='Location of data')
+    parser.add_argument('--dataset',     default='train',                      help='train or test')
+    parser.add_argument('--output',      default=OUTPUT,                       help='Where shards are to be written')
+    parser.add_argument('--archives',    default=None, nargs='+',              help='Read images from these zip files')
+    parser.add_argument('--rows',        default=512,  type=int,               help='Number of rows in each sample')
+    parser.add_argument('--columns',     default=256,  type=int,               help='Number of columns in each sample')
+    parser.add_argument('--format',      default='png', choices=FORMATS,       help='png, or raw for fixed size records')
+    parser.add_argument('--shard-size',  default=1024, type=float,             help='Target for size of input images in each shard (MB)')
+    parser.add_argument('--processes',   default=None, type=int,               help='Number of worker processes')
+    args = parser.parse_args()
+    if len(args.image_ids)>0:
+        image_ids = args.image_ids
+    else:
+        from metadata import read_metadata
+        image_ids = read_metadata(args.path,args.dataset)['image_id'].tolist()
+    export(image_ids,
+           path        = args.path,
+           dataset     = args.dataset,
+           output      = args.output,
+           archives    = args.archives,
+           rows        = args.rows,
+           columns     = args.columns,
+           format      = args.format,
+           shard_bytes = args.shard_size*(1<<20),
+           processes   = args.processes)
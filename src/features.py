@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Compute handcrafted features for batches of images in a pool of processes, and store them
+    in a table of Parquet files, keyed by image_id and version of feature set. Images whose
+    features are already in the table, and which have not changed, are skipped.
+'''
+
+from argparse           import ArgumentParser
+from buffers            import BufferPool
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contour            import get_contour, get_mask
+from cv2                import INTER_AREA, resize
+from dirichlet          import Segmenter
+from glob               import glob
+from loader             import DirectoryStorage, Loader
+from numpy              import arange, argmax, bincount, clip, empty, float32, hypot, int64, uint8, where, zeros
+from os                 import makedirs, remove, replace
+from os.path            import getmtime, join
+from pandas             import DataFrame, concat, read_parquet
+from time               import perf_counter
+from visualize          import get_background, get_bounds_batch
+from zlib               import crc32
+
+PATH     = r'D:\data\rsna-breast-cancer-detection'
+FEATURES = {}
+DEFAULTS = dict(dsize   = 128,
+                bins    = 64,
+                N       = 256,
+                lambda_ = 8,
+                min_gap = 8,
+                n_rays  = 90,
+                seed    = 0)
+
+def feature(name,version=1):
+    '''
+    Decorator for registering a function that computes a group of features for a batch of images.
+    The version must be incremented whenever the function changes, so stored values are recomputed.
+    '''
+    def register(compute):
+        FEATURES[name] = (compute,version)
+        return compute
+    return register
+
+def get_version(names,params):
+    '''
+    Identify feature set: changes whenever features, their versions, or parameters change
+    '''
+    key = ';'.join([f'{name}:{FEATURES[name][1]}' for name in sorted(names)] + [f'{k}={params[k]}' for k in sorted(params)])
+    return f'{crc32(key.encode()):08x}'
+
+def get_histograms(stack,bins):
+    '''
+    Histogram of each image, using same bins as dirichlet.Segmenter.get_threshold, i.e. bins equally spaced
+    between minimum and maximum of each image.
+
+    Returns:
+        counts      Number of pixels in each bin, for each image
+        low, width  Lower edge and width of bins, for each image
+    '''
+    B,m,n  = stack.shape
+    flat   = stack.reshape(B,-1).astype(float32)
+    low    = flat.min(axis=1)
+    high   = flat.max(axis=1)
+    width  = (high-low)/bins
+    safe   = where(width>0,width,1)
+    index  = clip(((flat-low[:,None])/safe[:,None]).astype(int64),0,bins-1)
+    index  = where(width[:,None]>0,index,bins//2)                            # As numpy.histogram does for constant image
+    counts = bincount((index + bins*arange(B)[:,None]).ravel(),minlength=B*bins).reshape(B,bins)
+    return counts,low,width
+
+@feature('histogram')
+def get_histogram_features(stack,shapes,bins=64,**params):
+    '''Fraction of pixels in each bin'''
+    counts,_,_ = get_histograms(stack,bins)
+    fractions  = counts/counts.sum(axis=1,keepdims=True)
+    return {f'hist_{k:02d}':fractions[:,k] for k in range(bins)}
+
+@feature('foreground')
+def get_foreground_features(stack,shapes,bins=64,**params):
+    '''Fraction of pixels below threshold from dirichlet.Segmenter.get_threshold'''
+    counts,low,width = get_histograms(stack,bins)
+    peak             = argmax(counts,axis=1)
+    threshold        = where(peak>0,low + (peak-1)*width,low + bins*width)   # get_threshold uses bins[peak-1]
+    B                = len(stack)
+    return {'foreground' : (stack.reshape(B,-1)<threshold[:,None]).mean(axis=1)}
+
+@feature('aspect')
+def get_aspect_features(stack,shapes,**params):
+    '''Aspect ratio of crop from get_bounds, in original pixels, and fraction of image that it covers'''
+    B,m,n  = stack.shape
+    aspect = empty(B)
+    area   = empty(B)
+    for k,((xmin,ymin,xmax,ymax,_),(M,N)) in enumerate(zip(get_bounds_batch(stack),shapes)):
+        height    = max(xmax-xmin,1)*M/m
+        width     = max(ymax-ymin,1)*N/n
+        aspect[k] = height/width
+        area[k]   = (xmax-xmin)*(ymax-ymin)/(m*n)
+    return {'aspect'    : aspect,
+            'crop_area' : area}
+
+@feature('dirichlet')
+def get_dirichlet_features(stack,shapes,bins=64,N=256,lambda_=8,min_gap=8,seed=None,**params):
+    '''Number of Dirichlet components, number of connected groups, and share of largest group'''
+    B           = len(stack)
+    components  = zeros(B)
+    connected   = zeros(B)
+    largest     = zeros(B)
+    for k,img in enumerate(stack):
+        segmenter = Segmenter(seed=seed)
+        segmenter.create_foreground(img,segmenter.get_threshold(img,bins=bins))
+        if len(segmenter.points)==0: continue
+        segmenter.create_components(N=N,lambda_=lambda_)
+        segmenter.connect_components(segmenter.create_distances(),min_gap=min_gap)
+        components[k] = len(segmenter.components)
+        connected[k]  = len(segmenter.connected_components)
+        largest[k]    = len(segmenter.connected_components[0])/len(segmenter.components)
+    return {'n_components' : components,
+            'n_connected'  : connected,
+            'largest'      : largest}
+
+@feature('rays')
+def get_ray_features(stack,shapes,n_rays=90,**params):
+    '''Statistics of distance from centre of mass to contour, along rays, relative to image size'''
+    B,m,n   = stack.shape
+    columns = {name:zeros(B) for name in ['ray_mean','ray_std','ray_min','ray_max','contour_area']}
+    for k,img in enumerate(stack):
+        background,_      = get_background(img)
+        polygon,(x_c,y_c) = get_contour(img,background,n_rays=n_rays,step=4)
+        radii             = hypot(polygon[:,0]-x_c,polygon[:,1]-y_c)/max(m,n)
+        columns['ray_mean'][k]     = radii.mean()
+        columns['ray_std'][k]      = radii.std()
+        columns['ray_min'][k]      = radii.min()
+        columns['ray_max'][k]      = radii.max()
+        columns['contour_area'][k] = get_mask(polygon,img.shape).mean()
+    return columns
+
+loader = None
+
+def initialize(path,dataset,archives):
+    '''Create a Loader for worker process'''
+    global loader
+    loader = Loader(path=path,dataset=dataset,archives=archives,pool=BufferPool())
+
+def compute_batch(image_ids,signatures,names,params,version):
+    '''
+    Load a batch of images, shrink them to a common size, and compute features: executed in worker process.
+    Images that cannot be loaded are reported and left out, so they are tried again next time.
+
+    Returns:
+        DataFrame with one row for each image
+    '''
+    dsize  = params['dsize']
+    stack  = empty((len(image_ids),dsize,dsize),dtype=uint8)
+    shapes = []
+    loaded = []
+    for image_id,img,_,_,_ in loader.get_images(image_ids,skip_errors=True):
+        try:
+            stack[len(loaded)] = resize(img,dsize=(dsize,dsize),interpolation=INTER_AREA)
+        except Exception as e:
+            print (f'{image_id}: {e}')
+            continue
+        shapes.append(img.shape)
+        loaded.append(image_id)
+    stack   = stack[:len(loaded)]
+    columns = {'image_id' : loaded,
+               'version'  : version,
+               'size'     : [signatures[image_id][0] for image_id in loaded],
+               'mtime'    : [signatures[image_id][1] for image_id in loaded]}
+    for name in names:
+        compute,_ = FEATURES[name]
+        if len(loaded)>0:
+            columns.update(compute(stack,shapes,**params))
+    return DataFrame(columns)
+
+class FeatureTable:
+    '''
+    Features stored as a sequence of Parquet parts in one directory. Parts are only ever added, so writing is cheap
+    and a crash cannot corrupt existing parts; when an image appears in more than one part, the latest is used.
+    '''
+    def __init__(self,directory):
+        self.directory = directory
+        makedirs(directory,exist_ok=True)
+
+    def get_parts(self):
+        return sorted(glob(join(self.directory,'part-*.parquet')))
+
+    def read(self,version,columns=None):
+        '''
+        Latest features for each image, for one version of feature set
+
+        Parameters:
+            version   Identifies feature set
+            columns   Columns to be read, in addition to image_id and version (default: all)
+        '''
+        keys  = ['image_id','version']
+        wanted = None if columns==None else keys + columns
+        parts = [read_parquet(part,columns=wanted,filters=[('version','==',version)]) for part in self.get_parts()]
+        parts = [part for part in parts if len(part)>0]
+        if len(parts)==0:
+            return DataFrame(columns=keys if columns==None else wanted)
+        return concat(parts,ignore_index=True).drop_duplicates('image_id',keep='last').reset_index(drop=True)
+
+    def get_signatures(self,version):
+        '''
+        Size and modification time of each image when its features were computed
+        '''
+        df = self.read(version,columns=['size','mtime'])
+        return dict(zip(df['image_id'],zip(df['size'],df['mtime'])))
+
+    def append(self,df):
+        '''Add a new part, written to a temporary file that is renamed once complete'''
+        parts     = self.get_parts()
+        number    = int(parts[-1].split('-')[-1].split('.')[0])+1 if len(parts)>0 else 0
+        file_name = join(self.directory,f'part-{number:06d}.parquet')
+        df.to_parquet(f'{file_name}.tmp',index=False)
+        replace(f'{file_name}.tmp',file_name)
+        return file_name
+
+    def compact(self):
+        '''
+        Replace all parts by a single part, keeping only latest row for each image and version.
+        If interrupted before old parts have been removed, the new part duplicates them, which is harmless.
+        '''
+        parts = self.get_parts()
+        if len(parts)<2: return
+        df = concat([read_parquet(part) for part in parts],ignore_index=True).drop_duplicates(['image_id','version'],keep='last')
+        self.append(df.reset_index(drop=True))
+        for part in parts:
+            remove(part)
+
+def get_signature(loader,image_id):
+    '''Size and modification time of stored image, used to decide whether features need to be recomputed'''
+    patient_id = int(loader.index.get_row(image_id)['patient_id'])
+    size       = loader.storage.get_size(patient_id,image_id)
+    mtime      = getmtime(loader.storage.get_file_name(patient_id,image_id)) if isinstance(loader.storage,DirectoryStorage) else 0.0
+    return size,mtime
+
+def extract(image_ids,
+            names         = list(FEATURES),
+            params        = DEFAULTS,
+            path          = PATH,
+            dataset       = 'train',
+            archives      = None,
+            output        = None,
+            batch_size    = 32,
+            rows_per_part = 10000,
+            processes     = None):
+    '''
+    Compute features for images that are new or have changed, and append them to feature table
+
+    Parameters:
+        image_ids       Images whose features are wanted
+        names           Features to be computed, e.g. histogram, foreground, aspect, dirichlet, rays
+        params          Parameters for features, e.g. dsize, bins
+        path            Location of data
+        dataset         train or test
+        archives        Zip files from which images are to be read (default: read from {dataset}_images)
+        output          Directory for feature table (default: path/features)
+        batch_size      Number of images sent to a worker at a time
+        rows_per_part   Number of rows accumulated before a part is written
+        processes       Number of worker processes
+
+    Returns:
+        version, number of images computed
+    '''
+    version  = get_version(names,params)
+    table    = FeatureTable(output if output!=None else join(path,'features'))
+    previous = table.get_signatures(version)
+    sizer    = Loader(path=path,dataset=dataset,archives=archives)
+    wanted   = {}
+    for image_id in image_ids:
+        patient_id = int(sizer.index.get_row(image_id)['patient_id'])
+        if sizer.has_image(patient_id,image_id):
+            signature = get_signature(sizer,image_id)
+            if previous.get(image_id)!=signature:
+                wanted[image_id] = signature
+    todo     = list(wanted)
+    batches  = [todo[i:i+batch_size] for i in range(0,len(todo),batch_size)]
+    pending  = []
+    n        = 0
+    start    = perf_counter()
+    with ProcessPoolExecutor(max_workers = processes,
+                             initializer = initialize,
+                             initargs    = (path,dataset,archives)) as executor:
+        futures = [executor.submit(compute_batch,batch,{image_id:wanted[image_id] for image_id in batch},names,params,version)
+                   for batch in batches]
+        for future in as_completed(futures):
+            df       = future.result()
+            n       += len(df)
+            pending.append(df)
+            if sum(len(df) for df in pending)>=rows_per_part:
+                table.append(concat(pending,ignore_index=True))
+                pending = []
+    if len(pending)>0:
+        table.append(concat(pending,ignore_index=True))
+    print (f'Version {version}: computed features for {n} images in {perf_counter()-start:.1f} sec, {len(image_ids)-len(todo)} up to date')
+    return version,n
+
+if __name__=='__main__':
+    from metadata import read_metadata
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('image_ids',     nargs='*', type=int,                          help='Images to be processed (omit for all images)')
+    parser.add_argument('--path',        default=PATH,                                 help='Location of data')
+    parser.add_argument('--dataset',     default='train',                              help='train or test')
+    parser.add_argument('--archives',    default=None, nargs='+',                      help='Read images from these zip files')
+    parser.add_argument('--output',      default=None,                                 help='Directory for feature table (default: path/features)')
+    parser.add_argument('--features',    default=list(FEATURES), nargs='+', choices=list(FEATURES), help='Features to be computed')
+    parser.add_argument('--batch-size',  default=32,   type=int,                       help='Number of images sent to a worker at a time')
+    parser.add_argument('--processes',   default=None, type=int,                       help='Number of worker processes')
+    parser.add_argument('--compact',     default=False, action='store_true',           help='Merge parts of feature table')
+    for key,value in DEFAULTS.items():
+        parser.add_argument(f'--{key}',  default=value, type=type(value),              help=f'Parameter for features (default {value})')
+    args      = parser.parse_args()
+    image_ids = args.image_ids if len(args.image_ids)>0 else read_metadata(args.path,args.dataset)['image_id'].tolist()
+    version,_ = extract(image_ids,
+                        names      = args.features,
+                        params     = {key:getattr(args,key) for key in DEFAULTS},
+                        path       = args.path,
+                        dataset    = args.dataset,
+                        archives   = args.archives,
+                        output     = args.output,
+                        batch_size = args.batch_size,
+                        processes  = args.processes)
+    if args.compact:
+        FeatureTable(args.output if args.output!=None else join(args.path,'features')).compact()
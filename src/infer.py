@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Predict test set for submission: images are streamed through decode, window, pyramid,
+    prepare (segment and resize), and model in a pool of processes, one breast at a time, and the prediction for each
+    breast is written as soon as it is available. If the time allowed is running out, less work is
+    done for each breast, by segmenting smaller images and using fewer views.
+'''
+
+from abc                import ABC, abstractmethod
+from argparse           import ArgumentParser
+from buffers            import BufferPool
+from collections        import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from cv2                import pyrDown
+from export             import prepare
+from loader             import Loader
+from numpy              import full, uint8
+from os                 import cpu_count
+from pickle             import load
+from time               import perf_counter
+
+PATH   = r'D:\data\rsna-breast-cancer-detection'
+STAGES = ['decode', 'window', 'pyramid', 'prepare', 'model']
+
+Setting = namedtuple('Setting',['level','views'])
+Setting.__doc__ = '''
+    How much work is done for each breast
+
+    Fields:
+        level   Number of times image is halved (pyramid level) before it is segmented
+        views   all: every image; main: first CC and first MLO; one: a single image, CC if there is one
+'''
+
+LADDER = [Setting(0,'all'),
+          Setting(1,'all'),
+          Setting(1,'main'),
+          Setting(2,'main'),
+          Setting(2,'one'),
+          Setting(3,'one')]
+
+class Model(ABC):
+    '''
+    Predict probability of cancer for a stack of images, each oriented, cropped, and resized
+    '''
+    @abstractmethod
+    def predict(self,stack):
+        '''
+        Parameters:
+            stack   n_images x rows x columns, uint8
+
+        Returns:
+            Probability of cancer for each image
+        '''
+        ...
+
+class ConstantModel(Model):
+    '''
+    Predict the same probability for every image: used when no model is supplied, so the rest of
+    the pipeline can be timed
+    '''
+    def __init__(self,probability):
+        self.probability = probability
+
+    def predict(self,stack):
+        return full(len(stack),self.probability)
+
+class PickledModel(Model):
+    '''
+    Classifier with a predict_proba method, such as those from sklearn, trained on pixels
+    scaled to 0-1, and flattened
+    '''
+    def __init__(self,file_name):
+        with open(file_name,'rb') as f:
+            self.classifier = load(f)
+
+    def predict(self,stack):
+        return self.classifier.predict_proba(stack.reshape(len(stack),-1)/255)[:,1]
+
+def get_breasts(df):
+    '''
+    Group images by breast
+
+    Returns:
+        prediction_id, patient_id, and list of (image_id,view) for each breast
+    '''
+    if 'prediction_id' not in df.columns:
+        df = df.assign(prediction_id=df['patient_id'].astype(str) + '_' + df['laterality'].astype(str))
+    return [(prediction_id,int(rows['patient_id'].iloc[0]),list(zip(rows['image_id'],rows['view'])))
+            for prediction_id,rows in df.groupby('prediction_id',sort=False)]
+
+def select_views(images,views='all'):
+    '''
+    Choose which images of a breast are to be used
+
+    Parameters:
+        images   List of (image_id,view)
+        views    all, main, or one: see Setting
+    '''
+    if views=='all':
+        return [image_id for image_id,_ in images]
+    selected = []
+    for wanted in ['CC', 'MLO']:
+        for image_id,view in images:
+            if view==wanted:
+                selected.append(image_id)
+                break
+        if views=='one' and len(selected)>0:
+            return selected
+    return selected if len(selected)>0 else [image_id for image_id,_ in images[:1]]
+
+class Budget:
+    '''
+    Decide how much work to do for each breast, so every breast is predicted in the time allowed.
+    The rate at which breasts have recently been completed is used to project the time needed
+    for the rest; if this exceeds the time available, work is reduced, and if there is plenty
+    of time to spare, work is increased again.
+    '''
+    def __init__(self,seconds,n_breasts,
+                 ladder = LADDER,
+                 window = 32,
+                 margin = 0.9):
+        '''
+        Parameters:
+            seconds     Time allowed
+            n_breasts   Number of breasts to be predicted
+            ladder      Settings, from most work to least
+            window      Number of recently completed breasts used to estimate rate
+            margin      Fraction of time allowed that may be used
+        '''
+        self.start     = perf_counter()
+        self.seconds   = seconds
+        self.remaining = n_breasts
+        self.ladder    = ladder
+        self.step      = 0
+        self.completed = deque(maxlen=window)
+        self.margin    = margin
+        self.changes   = []
+
+    def get_available(self):
+        '''Number of seconds left'''
+        return self.margin*self.seconds - (perf_counter()-self.start)
+
+    def is_exhausted(self):
+        return self.get_available()<=0
+
+    def get_setting(self):
+        return self.ladder[self.step]
+
+    def update(self):
+        '''
+        Record completion of one breast, and change setting if necessary
+        '''
+        self.remaining -= 1
+        self.completed.append(perf_counter())
+        if len(self.completed)<self.completed.maxlen:
+            return
+        projected = self.remaining*(self.completed[-1]-self.completed[0])/(len(self.completed)-1)
+        available = self.get_available()
+        if projected>available and self.step<len(self.ladder)-1:
+            self.step += 1
+        elif projected<0.5*available and self.step>0:
+            self.step -= 1
+        else:
+            return
+        self.completed.clear()
+        self.changes.append((perf_counter()-self.start,self.remaining,self.get_setting()))
+
+loader = None
+model  = None
+
+def initialize(path,dataset,archives,model_file,prior):
+    '''Create a Loader and a Model for worker process'''
+    global loader, model
+    loader = Loader(path=path,dataset=dataset,archives=archives,pool=BufferPool())
+    model  = PickledModel(model_file) if model_file!=None else ConstantModel(prior)
+
+def predict_breast(prediction_id,patient_id,image_ids,setting,rows,columns,how='mean'):
+    '''
+    Predict one breast: executed in worker process
+
+    Parameters:
+        prediction_id   Identifies breast
+        patient_id      Identifies patient
+        image_ids       Images to be used
+        setting         Pyramid level and views
+        rows, columns   Size of images expected by model
+        how             mean or max: used to combine predictions for images
+
+    Returns:
+        prediction_id, probability (None if no image could be loaded), number of images, time spent in each stage
+    '''
+    timings  = {}
+    stack    = full((len(image_ids),rows,columns),255,dtype=uint8)
+    n_images = 0
+    for _,pixels,_,view,_ in loader.get_images([image_id for image_id in image_ids if loader.has_image(patient_id,image_id)],timings=timings):
+        start = perf_counter()
+        for _ in range(setting.level):
+            pixels = pyrDown(pixels)
+        timings['pyramid'] = timings.get('pyramid',0) + perf_counter() - start
+        start = perf_counter()
+        prepare(pixels,view,rows,columns,out=stack[n_images])
+        timings['prepare'] = timings.get('prepare',0) + perf_counter() - start
+        n_images += 1
+    if n_images==0:
+        return prediction_id,None,0,timings
+    start         = perf_counter()
+    probabilities = model.predict(stack[:n_images])
+    timings['model'] = perf_counter() - start
+    return prediction_id, float(probabilities.max() if how=='max' else probabilities.mean()), n_images, timings
+
+def infer(breasts,
+          path       = PATH,
+          dataset    = 'test',
+          archives   = None,
+          output     = 'submission.csv',
+          model_file = None,
+          prior      = 0.02,
+          rows       = 512,
+          columns    = 256,
+          how        = 'mean',
+          seconds    = 9*60*60,
+          processes  = None):
+    '''
+    Predict breasts in a pool of processes, writing each prediction as soon as it is available.
+    Only a few breasts are in progress at once; breasts that cannot be predicted, or that would
+    exceed the time allowed, are assigned the prior probability.
+
+    Parameters:
+        breasts      prediction_id, patient_id, and list of (image_id,view) for each breast, from get_breasts
+        path         Location of data
+        dataset      train or test
+        archives     Zip files from which images are to be read (default: read from {dataset}_images)
+        output       Submission file
+        model_file   Pickled classifier (default: predict prior for every image)
+        prior        Probability used for breasts that are not predicted
+        rows         Number of rows expected by model
+        columns      Number of columns expected by model
+        how          mean or max: used to combine predictions for images
+        seconds      Time allowed
+        processes    Number of worker processes
+
+    Returns:
+        Statistics: number of breasts and images at each setting, time spent in each stage, budget
+    '''
+    budget      = Budget(seconds,len(breasts))
+    max_pending = 2*(processes if processes!=None else cpu_count())
+    timings     = {stage:0.0 for stage in STAGES}
+    counts      = {}
+    n_images    = 0
+    n_fallback  = 0
+    with open(output,'w') as out, \
+         ProcessPoolExecutor(max_workers = processes,
+                             initializer = initialize,
+                             initargs    = (path,dataset,archives,model_file,prior)) as executor:
+        out.write('prediction_id,cancer\n')
+
+        def write(result):
+            nonlocal n_images, n_fallback
+            prediction_id,probability,n,stage_timings = result
+            if probability==None:
+                n_fallback += 1
+                probability = prior
+            out.write(f'{prediction_id},{probability}\n')
+            out.flush()
+            n_images += n
+            for stage,elapsed in stage_timings.items():
+                timings[stage] += elapsed
+            budget.update()
+
+        def get_result(prediction_id,future):
+            try:
+                return future.result()
+            except Exception as e:                     # e.g. corrupt file: fall back to prior rather than abandoning run
+                print (prediction_id,e)
+                return prediction_id,None,0,{}
+
+        pending = deque()
+        for prediction_id,patient_id,images in breasts:
+            if budget.is_exhausted():
+                write((prediction_id,None,0,{}))
+                continue
+            setting         = budget.get_setting()
+            counts[setting] = counts.get(setting,0) + 1
+            pending.append((prediction_id,executor.submit(predict_breast,prediction_id,patient_id,select_views(images,setting.views),setting,rows,columns,how)))
+            if len(pending)>max_pending:
+                write(get_result(*pending.popleft()))
+        while len(pending)>0:
+            write(get_result(*pending.popleft()))
+    return dict(n_breasts  = len(breasts),
+                n_images   = n_images,
+                n_fallback = n_fallback,
+                counts     = counts,
+                timings    = timings,
+                elapsed    = perf_counter() - budget.start,
+                changes    = budget.changes)
+
+if __name__=='__main__':
+    from metadata import read_metadata
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',       default=PATH,                         help='Location of data')
+    parser.add_argument('--dataset',    default='test',                       help='train or test')
+    parser.add_argument('--archives',   default=None,  nargs='+',             help='Read images from these zip files')
+    parser.add_argument('--output',     default='submission.csv',             help='Submission file')
+    parser.add_argument('--model',      default=None,                         help='Pickled classifier (default: predict prior)')
+    parser.add_argument('--prior',      default=0.02,  type=float,            help='Probability for breasts that are not predicted')
+    parser.add_argument('--rows',       default=512,   type=int,              help='Number of rows expected by model')
+    parser.add_argument('--columns',    default=256,   type=int,              help='Number of columns expected by model')
+    parser.add_argument('--how',        default='mean', choices=['mean','max'], help='Used to combine predictions for images of one breast')
+    parser.add_argument('--budget',     default=9*60,  type=float,            help='Time allowed (minutes)')
+    parser.add_argument('--processes',  default=None,  type=int,              help='Number of worker processes')
+    args       = parser.parse_args()
+    statistics = infer(get_breasts(read_metadata(args.path,args.dataset)),
+                       path       = args.path,
+                       dataset    = args.dataset,
+                       archives   = args.archives,
+                       output     = args.output,
+                       model_file = args.model,
+                       prior      = args.prior,
+                       rows       = args.rows,
+                       columns    = args.columns,
+                       how        = args.how,
+                       seconds    = 60*args.budget,
+                       processes  = args.processes)
+    elapsed = statistics['elapsed']
+    n       = statistics['n_images']
+    print (f'{statistics["n_breasts"]} breasts, {n} images in {elapsed:.1f} sec: '
+           f'{n/elapsed:.1f} images/sec, {statistics["n_fallback"]} breasts assigned prior')
+    for setting,count in statistics['counts'].items():
+        print (f'Pyramid level {setting.level}, {setting.views} views: {count} breasts')
+    for t,remaining,setting in statistics['changes']:
+        print (f'{t:.1f} sec, {remaining} breasts remaining: changed to pyramid level {setting.level}, {setting.views} views')
+    total = sum(statistics['timings'].values())
+    for stage in STAGES:
+        seconds = statistics['timings'][stage]
+        print (f'{stage:8s} {seconds:9.2f} sec {100*seconds/total if total>0 else 0:5.1f}% '
+               f'{n/seconds if seconds>0 else float("inf"):9.1f} images/sec per process')
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Check downloaded images for corrupt or truncated files before they are used, recording
+    the results in an index so Loader can skip bad images. Files that have not changed since
+    the previous scan are not checked again.
+'''
+
+from argparse           import ArgumentParser
+from collections        import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from os                 import makedirs, replace, stat
+from os.path            import dirname, exists, join, relpath
+from restructure        import scan
+from shutil             import move
+from struct             import error as StructError, unpack
+from time               import perf_counter
+from zlib               import crc32
+
+PATH               = r'D:\data\rsna-breast-cancer-detection'
+OK                 = 'ok'
+ERROR              = 'error'                   # File could not be checked, so it will be checked again next time
+PREFIX             = b'DICM'
+TRANSFER_SYNTAX    = b'\x02\x00\x10\x00'      # (0002,0010), little endian
+PIXEL_DATA         = b'\xe0\x7f\x10\x00'      # (7FE0,0010)
+ITEM               = b'\xfe\xff\x00\xe0'      # (FFFE,E000)
+ITEM_DELIMITER     = b'\xfe\xff\x0d\xe0'      # (FFFE,E00D)
+SEQUENCE_DELIMITER = b'\xfe\xff\xdd\xe0'      # (FFFE,E0DD)
+UNDEFINED_LENGTH   = 0xFFFFFFFF
+IMPLICIT_VR        = b'1.2.840.10008.1.2'
+LONG_VRS           = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+Record = namedtuple('Record',['image_id','patient_id','file','size','mtime','crc','status','message','quarantined'])
+Record.__doc__ = '''
+    Result of checking one image
+
+    Fields:
+        image_id      Identifies image
+        patient_id    Name of directory containing image, or -1 if image has not been restructured
+        file          Path relative to images directory (or to quarantine, if file has been quarantined)
+        size          Size of file when it was checked
+        mtime         Modification time of file when it was checked, in nanoseconds, so it can be compared exactly
+        crc           CRC-32 of file
+        status        ok, header, truncated, corrupt, decode, or error (e.g. file could not be read)
+        message       Explains status
+        quarantined   Indicates that file has been moved out of images directory
+'''
+
+def get_index_file_name(path=PATH,images='train_images'):
+    return join(path,f'{images}_integrity.csv')
+
+def get_quarantine_path(path=PATH,images='train_images'):
+    return join(path,'quarantine',images)
+
+def get_element(data,offset,implicit):
+    '''
+    Parse header of element starting at offset
+
+    Returns:
+        tag, length of value, offset of value
+    '''
+    tag = data[offset:offset+4]
+    if implicit or tag[:2]==b'\xfe\xff':                       # Items and delimiters have no VR
+        length, = unpack('<L',data[offset+4:offset+8])
+        return tag,length,offset+8
+    if data[offset+4:offset+6] in LONG_VRS:
+        length, = unpack('<L',data[offset+8:offset+12])
+        return tag,length,offset+12
+    length, = unpack('<H',data[offset+6:offset+8])
+    return tag,length,offset+8
+
+def skip_undefined(data,offset,implicit):
+    '''
+    Find end of a sequence or item of undefined length, including any nested sequences
+
+    Parameters:
+        offset   Start of value
+
+    Returns:
+        Offset following delimiter, or length of data if there is no delimiter
+    '''
+    while offset+8<=len(data):
+        tag,length,offset = get_element(data,offset,implicit)
+        if tag in (ITEM_DELIMITER,SEQUENCE_DELIMITER):
+            return offset
+        offset = skip_undefined(data,offset,implicit) if length==UNDEFINED_LENGTH else offset + length
+    return len(data)
+
+def find_pixel_data(data):
+    '''
+    Walk top level elements to find pixel data, so that pixel data in a nested sequence,
+    such as an icon image, is not mistaken for the image itself
+
+    Returns:
+        offset of value and its length, or None if there is no pixel data
+    '''
+    offset   = 132
+    implicit = False
+    while offset+8<=len(data):
+        tag                  = data[offset:offset+4]
+        tag,length,value     = get_element(data,offset,implicit and tag[:2]!=b'\x02\x00')     # File meta is always explicit
+        if tag==TRANSFER_SYNTAX:
+            implicit = data[value:value+length].rstrip(b'\x00 ')==IMPLICIT_VR
+        if tag==PIXEL_DATA:
+            return value,length
+        offset = skip_undefined(data,value,implicit) if length==UNDEFINED_LENGTH else value + length
+    return None
+
+def check_structure(data):
+    '''
+    Verify that data is a DICOM file whose pixel data is complete, without decoding it
+
+    Returns:
+        status, message
+    '''
+    if len(data)<132 or data[128:132]!=PREFIX:
+        return 'header','No DICM prefix'
+    try:
+        found = find_pixel_data(data)
+    except StructError:
+        return 'truncated','Incomplete element header'
+    if found==None:
+        return 'truncated','No pixel data'
+    offset,length = found
+    if length!=UNDEFINED_LENGTH:
+        if offset+length>len(data):
+            return 'truncated',f'Pixel data has {len(data)-offset} of {length} bytes'
+        return OK,''
+    while offset+8<=len(data):                                 # Encapsulated: walk fragments
+        tag            = data[offset:offset+4]
+        item_length,   = unpack('<L',data[offset+4:offset+8])
+        if tag==SEQUENCE_DELIMITER:
+            return OK,''
+        if tag!=ITEM:
+            return 'corrupt',f'Unexpected tag in pixel data at {offset}'
+        offset += 8 + item_length
+    return 'truncated','Pixel data has no sequence delimiter'
+
+def check_decode(data):
+    '''
+    Decode pixel data, and verify that it matches Rows and Columns
+
+    Returns:
+        status, message
+    '''
+    from dicomsdl import open_memory
+    try:
+        ds     = open_memory(data)
+        pixels = ds.pixelData()
+        if pixels.shape!=(ds.getDataElement('Rows').value(),ds.getDataElement('Columns').value()):
+            return 'decode',f'Pixel data has shape {pixels.shape}'
+    except Exception as e:                          # Decoder may raise anything for a bad file
+        return 'decode',str(e)
+    return OK,''
+
+def check(image_id,patient_id,file_name,images_path,decode=False):
+    '''
+    Check one image: executed in worker process
+
+    Parameters:
+        image_id      Identifies image
+        patient_id    Name of directory containing image, or -1
+        file_name     Full path to image
+        images_path   Location of images, used to make file name relative
+        decode        Decode pixel data, which is slow, as well as checking structure
+    '''
+    record = Record(image_id    = image_id,
+                    patient_id  = patient_id,
+                    file        = relpath(file_name,images_path),
+                    size        = -1,
+                    mtime       = -1,
+                    crc         = -1,
+                    status      = ERROR,
+                    message     = '',
+                    quarantined = False)
+    try:
+        info = stat(file_name)
+        with open(file_name,'rb') as f:
+            data = f.read()
+        status,message = check_structure(data)
+        if status==OK and decode:
+            status,message = check_decode(data)
+        return record._replace(size    = info.st_size,
+                               mtime   = info.st_mtime_ns,
+                               crc     = crc32(data),
+                               status  = status,
+                               message = message)
+    except Exception as e:                          # Record failure, rather than abandoning whole scan
+        return record._replace(message=str(e))
+
+def read_index(path=PATH,images='train_images'):
+    '''
+    Read results of previous scan
+
+    Returns:
+        A list of Records
+    '''
+    from pandas import read_csv
+    file_name = get_index_file_name(path,images)
+    if not exists(file_name): return []
+    df = read_csv(file_name,keep_default_na=False)
+    return [Record(*row) for row in df[list(Record._fields)].itertuples(index=False)]
+
+def write_index(records,path=PATH,images='train_images'):
+    '''
+    Write results of scan, replacing index atomically
+    '''
+    from pandas import DataFrame
+    file_name = get_index_file_name(path,images)
+    temp      = f'{file_name}.tmp'
+    DataFrame(sorted(records,key=lambda record:record.image_id),columns=Record._fields).to_csv(temp,index=False)
+    replace(temp,file_name)
+
+def get_bad_images(path=PATH,images='train_images'):
+    '''
+    Find images that failed the most recent scan
+
+    Returns:
+        Set of image_ids
+    '''
+    return {record.image_id for record in read_index(path,images) if record.status!=OK}
+
+def quarantine(record,path=PATH,images='train_images'):
+    '''
+    Move a bad file out of the images directory, keeping its relative path
+
+    Returns:
+        Updated record
+    '''
+    destination = join(get_quarantine_path(path,images),record.file)
+    makedirs(dirname(destination),exist_ok=True)
+    move(join(path,images,record.file),destination)
+    return record._replace(quarantined=True)
+
+def scan_images(path           = PATH,
+                images         = 'train_images',
+                decode         = False,
+                processes      = None,
+                chunksize      = 16,
+                quarantine_bad = False):
+    '''
+    Check every image whose size or modification time has changed since previous scan
+
+    Parameters:
+        path             Location of data
+        images           Name of directory containing images
+        decode           Decode pixel data as well as checking structure
+        processes        Number of worker processes
+        chunksize        Number of images sent to a worker at a time
+        quarantine_bad   Move bad files into quarantine
+
+    Returns:
+        Records for all images, including those that have been quarantined
+    '''
+    images_path = join(path,images)
+    previous    = read_index(path,images)
+    found,_,_   = scan(images_path)
+    unchanged   = {record.file:record for record in previous if not record.quarantined}
+    records     = [record for record in previous if record.quarantined and record.image_id not in found]
+    to_check    = []
+    for image_id,locations in found.items():
+        for directory,file_name in locations:
+            record = unchanged.get(relpath(file_name,images_path))
+            info   = stat(file_name)
+            if record!=None and record.size==info.st_size and record.mtime==info.st_mtime_ns:
+                records.append(record)
+            else:
+                to_check.append((image_id,int(directory) if directory!=None else -1,file_name))
+
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        checked = list(executor.map(check,
+                                    [image_id for image_id,_,_ in to_check],
+                                    [patient_id for _,patient_id,_ in to_check],
+                                    [file_name for _,_,file_name in to_check],
+                                    [images_path]*len(to_check),
+                                    [decode]*len(to_check),
+                                    chunksize = chunksize))
+    print (f'Checked {len(checked)} images in {perf_counter()-start:.1f} sec, {len(records)} unchanged')
+
+    for record in checked:
+        if record.status!=OK:
+            print (f'{record.file}: {record.status} {record.message}')
+        records.append(record)
+    if quarantine_bad:                  # Includes files found to be bad by a previous scan
+        records = [quarantine(record,path,images) if record.status not in (OK,ERROR) and not record.quarantined else record
+                   for record in records]
+    write_index(records,path,images)
+    return records
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',       default=PATH,                        help='Location of data')
+    parser.add_argument('--images',     default='train_images',              help='Directory containing images')
+    parser.add_argument('--decode',     default=False, action='store_true',  help='Decode pixel data as well as checking structure')
+    parser.add_argument('--processes',  default=None,  type=int,             help='Number of worker processes')
+    parser.add_argument('--quarantine', default=False, action='store_true',  help='Move bad files into quarantine')
+    args    = parser.parse_args()
+    records = scan_images(path           = args.path,
+                          images         = args.images,
+                          decode         = args.decode,
+                          processes      = args.processes,
+                          quarantine_bad = args.quarantine)
+    bad     = [record for record in records if record.status!=OK]
+    print (f'{len(records)} images, {len(bad)} bad, {sum(record.quarantined for record in bad)} quarantined')
@@ -23,14 +23,23 @@
 
 '''Read image from restructured data on drive D'''
 
-from abc               import ABC,abstractmethod
-from dicomsdl          import open
-from matplotlib.pyplot import figure, show
-from numpy             import exp, uint8
-from os                import walk
-from os.path           import exists, join
-from pandas            import read_csv
-from warnings          import warn
+from abc                import ABC,abstractmethod
+from collections        import deque
+from concurrent.futures import ThreadPoolExecutor
+from expand             import parse_member_name
+from integrity          import get_bad_images
+from metadata           import read_metadata
+from mmap               import mmap, ACCESS_READ
+from numpy              import arange, empty, exp, subtract, take, uint8
+from os                 import walk
+from os.path            import exists, getsize, join
+from patients           import PatientIndex
+from profiling          import stage
+from struct             import unpack
+from threading          import Lock, local
+from time               import perf_counter
+from warnings           import warn
+from zipfile            import ZipFile, ZIP_STORED
 
 class VOILUT(ABC):
     '''
@@ -62,6 +71,35 @@ class VOILUT(ABC):
     def scale(self,img):
         ...
 
+    def apply(self,img,invert=False,out=None):
+        '''
+        Window 8 or 16 bit unsigned integer pixels and force them into 0-255 using a lookup table, so the work
+        is done once for each possible value, rather than for each pixel, and no floating point image is created.
+        The result matches Loader.normalize(scale(img)), after any inversion, except for floating point rounding,
+        which occasionally moves a pixel by one grey level: scale is monotonic, so the maximum over the image
+        is the value for the largest (or, if inverted, smallest) pixel.
+
+        Parameters:
+            img      Stored pixel values
+            invert   Invert values first, e.g. to force MONOCHROME2 to MONOCHROME1
+            out      Array for result, uint8 (default: allocate one)
+        '''
+        low,high = int(img.min()),int(img.max())
+        values   = arange(low,high+1,dtype=img.dtype)                # Only values from smallest to largest pixel, so all scale to 0-1
+        if invert:
+            values = img.dtype.type(high) - values
+        scaled   = self.scale(values)
+        largest  = scaled.max()
+        if largest!=0:
+            scaled = scaled/largest
+        lut      = (scaled*255).astype(uint8)
+        if out is None:
+            out = empty(img.shape,dtype=uint8)
+        step     = max(1,(1<<20)//max(1,img.shape[-1]))           # take converts indices to intp, so do a strip at a time
+        for i in range(0,len(img),step):
+            take(lut,img[i:i+step]-img.dtype.type(low),out=out[i:i+step],mode='clip')
+        return out
+
 
 class Linear(VOILUT):
     '''
@@ -124,31 +162,220 @@ class LinearExact(Linear):
         super().__init__(ds)
         warn('LINEAR_EXACT not implemented: using LINEAR_instead.')
 
+class Storage(ABC):
+    '''
+    This class represents the location where images are stored
+    '''
+    @abstractmethod
+    def has_image(self,patient_id,image_id):
+        ...
+
+    @abstractmethod
+    def get_size(self,patient_id,image_id):
+        '''Number of bytes used to store image'''
+        ...
+
+    @abstractmethod
+    def open(self,patient_id,image_id,data=None):
+        '''
+        Open image as a dicomsdl DataSet
+
+        Parameters:
+            patient_id   Identifies patient
+            image_id     Identifies image
+            data         Contents of image, if it has already been read by prefetch
+        '''
+        ...
+
+    def prefetch(self,image_ids,depth=4):
+        '''
+        A generator for iterating through images, reading ahead where storage supports it
+
+        Yields:
+            image_id, data (to be passed to open)
+        '''
+        for image_id in image_ids:
+            yield image_id,None
+
+class DirectoryStorage(Storage):
+    '''
+    Images are stored in files: images_path/patient_id/image_id.dcm
+    '''
+    def __init__(self,images_path):
+        self.images_path = images_path
+
+    def get_file_name(self,patient_id,image_id):
+        return join(self.images_path,str(patient_id),f'{image_id}.dcm')
+
+    def has_image(self,patient_id,image_id):
+        return exists(self.get_file_name(patient_id,image_id))
+
+    def get_size(self,patient_id,image_id):
+        return getsize(self.get_file_name(patient_id,image_id))
+
+    def open(self,patient_id,image_id,data=None):
+        from dicomsdl import open as open_dicom
+        return open_dicom(self.get_file_name(patient_id,image_id))
+
+class ZipStorage(Storage):
+    '''
+    Images are read directly from one or more zip archives, such as those downloaded from Kaggle,
+    without being extracted. Stored (uncompressed) members are read from a memory map without copying;
+    compressed members are decompressed into memory.
+    '''
+    LOCAL_HEADER = '<4s2B4HL2L2H'
+    LOCAL_HEADER_SIZE = 30
+
+    def __init__(self,archives):
+        '''
+        Index the central directory of each archive, so each image can be located
+
+        Parameters:
+            archives   Zip files containing images
+        '''
+        self.index  = {}
+        self.local  = local()
+        self.maps   = {}
+        self.lock   = Lock()
+        for archive in archives:
+            with ZipFile(archive) as zip_file:
+                for info in zip_file.infolist():
+                    _,image_id,ext = parse_member_name(info.filename)
+                    if ext=='.dcm':
+                        self.index[int(image_id)] = (archive,info)
+
+    def has_image(self,patient_id,image_id):
+        return image_id in self.index
+
+    def get_size(self,patient_id,image_id):
+        _,info = self.index[image_id]
+        return info.compress_size
+
+    def get_archive(self,archive):
+        '''Each thread has its own handle for each archive, as ZipFile is not safe to share'''
+        if not hasattr(self.local,'archives'):
+            self.local.archives = {}
+        if archive not in self.local.archives:
+            self.local.archives[archive] = ZipFile(archive)
+        return self.local.archives[archive]
+
+    def get_map(self,archive):
+        '''Memory map for archive, shared between threads'''
+        with self.lock:
+            if archive not in self.maps:
+                with open(archive,'rb') as f:
+                    self.maps[archive] = mmap(f.fileno(),0,access=ACCESS_READ)
+            return self.maps[archive]
+
+    def read(self,image_id):
+        '''
+        Read contents of image
+
+        Returns:
+            A memoryview into the archive for stored members, or bytes for compressed members
+        '''
+        archive,info = self.index[image_id]
+        if info.compress_type==ZIP_STORED:
+            mapped   = self.get_map(archive)
+            start    = info.header_offset
+            fields   = unpack(ZipStorage.LOCAL_HEADER,mapped[start:start+ZipStorage.LOCAL_HEADER_SIZE])
+            offset   = start + ZipStorage.LOCAL_HEADER_SIZE + fields[-2] + fields[-1]   # Skip file name and extra field
+            return memoryview(mapped)[offset:offset+info.file_size]
+        else:
+            return self.get_archive(archive).read(info)
+
+    def open(self,patient_id,image_id,data=None):
+        from dicomsdl import open_memory
+        self.local.data = data if data is not None else self.read(image_id)   # Keep data alive while DataSet is in use
+        return open_memory(self.local.data)
+
+    def prefetch(self,image_ids,depth=4):
+        '''
+        Read ahead in a pool of threads while caller decodes images
+        '''
+        def get_data(future):
+            try:
+                return future.result()
+            except Exception:                # Read again when image is opened, so error is raised for this image only
+                return None
+
+        with ThreadPoolExecutor(max_workers=depth) as executor:
+            pending = deque()
+            for image_id in image_ids:
+                pending.append((image_id,executor.submit(self.read,image_id)))
+                if len(pending)>depth:
+                    image_id,future = pending.popleft()
+                    yield image_id,get_data(future)
+            while len(pending)>0:
+                image_id,future = pending.popleft()
+                yield image_id,get_data(future)
+
 class Loader:
     '''
     This class loads images and metadata
     '''
     def __init__(self,
-                 path    = r'D:\data\rsna-breast-cancer-detection',
-                 dataset = 'train'):
+                 path     = r'D:\data\rsna-breast-cancer-detection',
+                 dataset  = 'train',
+                 archives = None,
+                 pool     = None):
         '''
         Configure loader
 
         Parameters:
             path       To all data, train or test
             dataset    train or test
+            archives   Zip files from which images are to be read (default: read images from {dataset}_images)
+            pool       BufferPool: if supplied, images are decoded into arrays that are reused, so get_images
+                       stops allocating once it has seen each size of image
         '''
         self.images_path = join(path,f'{dataset}_images')
-        self.master      = read_csv(join(path,f'{dataset}.csv'))
+        self.master      = read_metadata(path,dataset)
+        self.index       = PatientIndex(self.master)
+        self.storage     = ZipStorage(archives) if archives!=None else DirectoryStorage(self.images_path)
+        self.bad         = get_bad_images(path,f'{dataset}_images')
+        self.pool        = pool
 
     def get_image_file_name(self,patient_id,image_id):
         return join(self.images_path,str(patient_id),f'{image_id}.dcm')
 
+    def has_image(self,patient_id,image_id):
+        '''Verify that image is available, and did not fail integrity check'''
+        return image_id not in self.bad and self.storage.has_image(patient_id,image_id)
+
+    def get_images(self,image_ids,depth=4,skip_errors=False,**kwargs):
+        '''
+        A generator for iterating through images, reading ahead where storage allows.
+        Images that failed integrity check are skipped. If loader has a pool, each image is
+        returned to the pool when the next one is requested, so it must not be kept.
+
+        Parameters:
+            image_ids     Images to be loaded
+            depth         Number of images to read ahead
+            skip_errors   Report images that cannot be loaded, and carry on with the rest, instead of raising
+            kwargs        Passed to get_image
+
+        Yields:
+            image_id, followed by values returned from get_image
+        '''
+        for image_id,data in self.storage.prefetch((image_id for image_id in image_ids if image_id not in self.bad),depth=depth):
+            try:
+                result = self.get_image(image_id=image_id,data=data,**kwargs)
+            except Exception as e:
+                if not skip_errors: raise
+                print (f'{image_id}: {e}')
+                continue
+            yield (image_id,) + result
+            if self.pool!=None:
+                self.pool.release(result[0])
+
     def get_image(self,
                   image_id               = None,
                   patient_id             = None,
                   should_apply_windowing = True,
-                  show_pixel_data_info   = False):
+                  show_pixel_data_info   = False,
+                  data                   = None,
+                  timings                = None):
         '''
         Load specified image.
         Invert if necessary so PhotometricInterpretation is MONOCHROME1 (i.e. background is white)
@@ -158,25 +385,29 @@ class Loader:
             patient_id               May be omitted
             should_apply_windowing   Controls whether image should be windows
             show_pixel_data_info     For exploration
+            data                     Contents of image, if already read by storage
+            timings                  Optional dictionary: time spent decoding and windowing is added to it
 
         Returns:
              img         The pixels representing  the image
              laterality  L or R
              view        CC or MLO
         '''
+        row = self.index.get_row(image_id)
         if patient_id==None:
-            row        = self.master[self.master['image_id']==image_id]
             patient_id = int(row['patient_id'])
 
-        ds  = open(self.get_image_file_name(patient_id,image_id))
+        start = perf_counter()
+        with stage('decode'):
+            ds  = self.storage.open(patient_id,image_id,data=data)
 
-        if show_pixel_data_info:
-            dump = ds.dump()
-            print (dump)
-            for key,value in ds.getPixelDataInfo().items():
-                print (key,value)
+            if show_pixel_data_info:
+                dump = ds.dump()
+                print (dump)
+                for key,value in ds.getPixelDataInfo().items():
+                    print (key,value)
 
-        img                       = ds.pixelData()
+            img = self.decode(ds)
 
         PhotometricInterpretation = ds.getDataElement('PhotometricInterpretation').value()
         SamplesPerPixel           = ds.getDataElement('SamplesPerPixel').value()
@@ -184,26 +415,60 @@ class Loader:
         m,n                       = img.shape
         assert m==ds.getDataElement('Rows').value() and n==ds.getDataElement('Columns').value()
 
-        view        = row['view'].values[0]
+        view        = row['view']
         ImageLaterality  = ds.getDataElement('ImageLaterality').value(),
-        RowLaterality = row['laterality'].values[0]
+        RowLaterality = row['laterality']
         assert ImageLaterality == (RowLaterality,)
-        cancer = row['cancer']
-        img = self.force_monochrome1(PhotometricInterpretation,img)
-        return self.normalize(window.scale(img)) if should_apply_windowing else img,RowLaterality,view,int(cancer)
+        cancer = int(row['cancer']) if 'cancer' in row else None
+        assert PhotometricInterpretation=='MONOCHROME2' or PhotometricInterpretation=='MONOCHROME1'
+        if timings!=None:
+            timings['decode'] = timings.get('decode',0) + perf_counter() - start
+            start             = perf_counter()
+        if should_apply_windowing:
+            with stage('window'):
+                if img.dtype.kind=='u' and img.dtype.itemsize<=2:          # Lookup table has an entry for each value
+                    stored = img
+                    img    = window.apply(stored,
+                                          invert = PhotometricInterpretation=='MONOCHROME2',
+                                          out    = None if self.pool==None else self.pool.acquire(stored.shape,uint8))
+                    if self.pool!=None:
+                        self.pool.release(stored)
+                else:
+                    stored = img
+                    img    = self.normalize(window.scale(self.force_monochrome1(PhotometricInterpretation,stored)))
+                    if self.pool!=None:
+                        self.pool.release(stored)
+            if timings!=None:
+                timings['window'] = timings.get('window',0) + perf_counter() - start
+        else:
+            img = self.force_monochrome1(PhotometricInterpretation,img)
+        return img,RowLaterality,view,cancer
+
+    def decode(self,ds):
+        '''
+        Decode pixels: directly into an array from the pool, if there is one, and dicomsdl supports it
+        '''
+        if self.pool!=None and hasattr(ds,'copyFrameData'):
+            info = ds.getPixelDataInfo()
+            img  = self.pool.acquire((info['Rows'],info['Cols']),info['dtype'])
+            ds.copyFrameData(0,img)
+            return img
+        return ds.pixelData()
 
 
     def force_monochrome1(self,photometricInterpretation,img):
         '''
-        Ensure image is PhotometricInterpretation is MONOCHROME1 by forcing MONOCHROME2 to MONOCHROME1
+        Ensure image is PhotometricInterpretation is MONOCHROME1 by forcing MONOCHROME2 to MONOCHROME1.
+        The image is inverted in place.
         '''
         assert photometricInterpretation=='MONOCHROME2' or photometricInterpretation=='MONOCHROME1'
         if photometricInterpretation=='MONOCHROME2':
-            return img.max() - img
+            return subtract(img.max(),img,out=img)
         else:
             return img
 
-    def normalize(self,img):
+    @staticmethod
+    def normalize(img):
         '''
         Force image pixels into 0-255
         '''
@@ -213,15 +478,27 @@ class Loader:
         return (img * 255).astype(uint8)
 
 
-def get_all_images(path = r'D:\data\rsna-breast-cancer-detection',
-                   dataset = 'train_images'):
-    '''A generator for iterating through all images'''
+def get_all_images(path     = r'D:\data\rsna-breast-cancer-detection',
+                   dataset  = 'train_images',
+                   skip_bad = True):
+    '''
+    A generator for iterating through all images
+
+    Parameters:
+        path       Location of data
+        dataset    Directory containing images
+        skip_bad   Skip images that failed integrity check
+    '''
+    bad = get_bad_images(path,dataset) if skip_bad else set()
     for dirpath, dirnames, filenames in walk(join(path,dataset)):
         for filename in filenames:
             parts = filename.split('.')
-            yield int(parts[0])
+            image_id = int(parts[0])
+            if image_id not in bad:
+                yield image_id
 
 if __name__=='__main__':
+    from matplotlib.pyplot import figure, show
     loader   = Loader()
     img,laterality,view,cancer = loader.get_image(image_id=797737008)
     img0,_,_,_ = loader.get_image(image_id               = 797737008,
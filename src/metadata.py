@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Read train.csv or test.csv with compact types, caching the result as a Feather file
+    so later reads are fast.
+'''
+
+from argparse import ArgumentParser
+from os.path  import exists, getmtime, join
+from pandas   import CategoricalDtype, read_csv
+from warnings import warn
+
+DENSITIES = ['A', 'B', 'C', 'D']
+
+VIEWS     = ['CC', 'MLO', 'AT', 'LM', 'ML', 'LMO']
+
+SCHEMA    = {
+    'site_id'                 : 'int16',
+    'patient_id'              : 'int32',
+    'image_id'                : 'int32',
+    'laterality'              : CategoricalDtype(['L', 'R']),
+    'view'                    : CategoricalDtype(VIEWS),
+    'age'                     : 'float32',
+    'cancer'                  : 'bool',
+    'biopsy'                  : 'bool',
+    'invasive'                : 'bool',
+    'BIRADS'                  : 'float32',
+    'implant'                 : 'bool',
+    'density'                 : CategoricalDtype(DENSITIES),
+    'machine_id'              : 'int16',
+    'difficult_negative_case' : 'bool',
+    'prediction_id'           : 'string'
+}
+
+CATEGORIES = ['site_id', 'machine_id']      # Read as integers, then converted, so categories are numbers, not strings
+
+_cache = {}
+
+def get_csv_file_name(path,dataset='train'):
+    return join(path,f'{dataset}.csv')
+
+def get_feather_file_name(path,dataset='train'):
+    return join(path,f'{dataset}.feather')
+
+def categorize(df):
+    '''
+    Convert CATEGORIES to categories of integers: also corrects Feather files written
+    when they were categories of strings
+    '''
+    for column in CATEGORIES:
+        if column in df.columns:
+            df[column] = df[column].astype('int16').astype('category')
+    return df
+
+def read_typed_csv(csv_file,**kwargs):
+    '''
+    Read csv file, using SCHEMA for any columns that it recognizes
+
+    Parameters:
+        csv_file   File to be read
+        kwargs     Passed to read_csv, e.g. chunksize, in which case chunks are yielded
+    '''
+    columns = read_csv(csv_file,nrows=0).columns
+    result  = read_csv(csv_file,
+                       dtype = {column:SCHEMA[column] for column in columns if column in SCHEMA},
+                       **kwargs)
+    if 'chunksize' in kwargs or kwargs.get('iterator',False):
+        return (categorize(chunk) for chunk in result)
+    return categorize(result)
+
+def convert(path,dataset='train'):
+    '''
+    Convert csv file to Feather, applying SCHEMA
+
+    Returns:
+        Converted data
+    '''
+    df = read_typed_csv(get_csv_file_name(path,dataset))
+    try:
+        df.to_feather(get_feather_file_name(path,dataset))
+    except ImportError as e:
+        warn(f'Could not create Feather file: {e}')
+    return df
+
+def read_metadata(path    = r'D:\data\rsna-breast-cancer-detection',
+                  dataset = 'train',
+                  columns = None):
+    '''
+    Read metadata for train or test. The Feather file is recreated whenever the csv file is newer,
+    and the result is cached in memory for as long as the csv file is unchanged. Each caller
+    gets its own copy, so changes made by one caller are not seen by others.
+
+    Parameters:
+        path      Location of csv file
+        dataset   train or test
+        columns   Used to select columns (default: all)
+    '''
+    csv_file     = get_csv_file_name(path,dataset)
+    feather_file = get_feather_file_name(path,dataset)
+    modified     = getmtime(csv_file)
+    key          = (csv_file,modified)
+    if key not in _cache:
+        if exists(feather_file) and getmtime(feather_file)>=modified:
+            try:
+                from pyarrow.feather import read_table
+                _cache[key] = categorize(read_table(feather_file,memory_map=True).to_pandas())
+            except ImportError:
+                _cache[key] = read_typed_csv(csv_file)
+        else:
+            _cache[key] = convert(path,dataset)
+    df = _cache[key]
+    return df.copy() if columns==None else df[columns].copy()
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path', default=r'D:\data\rsna-breast-cancer-detection')
+    parser.add_argument('--datasets', nargs='+', default=['train','test'])
+    args = parser.parse_args()
+    for dataset in args.datasets:
+        df = convert(args.path,dataset)
+        print (f'{dataset}: {len(df)} rows, {df.memory_usage(deep=True).sum()/1024/1024:.1f} MB')
+        print (df.dtypes)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Tile images into a single labelled picture, without going through matplotlib'''
+
+from cv2     import FONT_HERSHEY_PLAIN, IMWRITE_JPEG_QUALITY, INTER_AREA, imwrite, putText, resize
+from numpy   import full, uint8
+from os      import remove, replace
+from os.path import exists, splitext
+
+def fit(img,rows,columns):
+    '''
+    Shrink image, preserving aspect ratio, so it fits in a cell
+
+    Parameters:
+        img            Image to be shrunk
+        rows,columns   Size of cell
+    '''
+    m,n   = img.shape
+    scale = min(rows/m,columns/n,1)
+    return resize(img,
+                  dsize         = (max(1,int(n*scale)), max(1,int(m*scale))),
+                  interpolation = INTER_AREA)
+
+def create_mosaic(images,labels,grid,
+                  cell         = (384,256),
+                  label_height = 14,
+                  background   = 255,
+                  title        = None):
+    '''
+    Tile images into a single canvas
+
+    Parameters:
+        images         Images to be tiled, uint8, e.g. crops from get_bounds
+        labels         Text to be displayed above each image
+        grid           Number of rows and columns of cells, e.g. from get_grid_size
+        cell           Number of rows and columns available for each image
+        label_height   Number of rows reserved for each label
+        background     Value for pixels that are not covered by an image
+        title          Optional text for top of canvas
+
+    Returns:
+        canvas containing images
+    '''
+    m,n           = grid
+    rows,columns  = cell
+    title_height  = label_height if title!=None else 0
+    canvas        = full((title_height + m*(rows+label_height), n*columns),background,dtype=uint8)
+    if title!=None:
+        putText(canvas,title,(2,label_height-3),FONT_HERSHEY_PLAIN,0.9,0)
+    for k,(img,label) in enumerate(zip(images,labels)):
+        i,j       = divmod(k,n)
+        top       = title_height + i*(rows+label_height)
+        left      = j*columns
+        tile      = fit(img,rows,columns)
+        p,q       = tile.shape
+        offset    = (columns - q)//2
+        canvas[top+label_height:top+label_height+p, left+offset:left+offset+q] = tile
+        putText(canvas,label,(left+2,top+label_height-3),FONT_HERSHEY_PLAIN,0.8,0)
+    return canvas
+
+def write_mosaic(canvas,output,quality=90):
+    '''
+    Save canvas: format is determined by extension of output, e.g. png or jpg. The canvas is
+    written to a temporary file first, so an interrupted run never leaves a truncated image.
+
+    Parameters:
+        canvas    Image to be saved
+        output    File name
+        quality   Used for JPEG only
+    '''
+    base,ext = splitext(output)
+    params   = [IMWRITE_JPEG_QUALITY,quality] if ext.lower() in ['.jpg','.jpeg'] else []
+    temp     = f'{base}.partial{ext}'             # Keep extension, so imwrite chooses format
+    try:
+        if not imwrite(temp,canvas,params):
+            raise RuntimeError(f'Could not write {output}')
+        replace(temp,output)
+    finally:
+        if exists(temp):
+            remove(temp)
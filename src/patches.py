@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Extract overlapping patches from a segmented image at full resolution, skipping patches
+    that are mostly background. Patches are views into the image, and are only copied into a
+    buffer that holds one batch, so memory does not depend on the number of patches.
+'''
+
+from argparse                import ArgumentParser
+from numpy                   import append, arange, concatenate, count_nonzero, cumsum, empty, flatnonzero, int64, \
+                                    searchsorted, unique, zeros
+from numpy.lib.stride_tricks import sliding_window_view
+from time                    import perf_counter
+
+PATH = r'D:\data\rsna-breast-cancer-detection'
+
+def get_threshold(pixels,epsilon=0.01):
+    '''
+    Separate foreground from background, using the same threshold as the segmenters:
+    background is white, so anything darker than the maximum is foreground
+    '''
+    return pixels.max() - epsilon
+
+def get_integral_rows(pixels,boundaries,threshold):
+    '''
+    Rows of the integral image of the foreground: element [k,j] is the number of foreground pixels in
+    pixels[:boundaries[k],:j], so the count for any patch can be found from its four corners. Only the rows
+    at the boundaries of patches are kept, and the image is scanned one strip at a time, so neither the
+    foreground mask nor the integral image is ever held in full.
+
+    Parameters:
+        pixels       Image
+        boundaries   Rows at top and bottom of patches, in ascending order
+        threshold    Pixels darker than this are foreground
+    '''
+    integral = zeros((len(boundaries),pixels.shape[1]+1),dtype=int64)
+    running  = zeros(pixels.shape[1],dtype=int64)
+    previous = 0
+    for k,boundary in enumerate(boundaries):
+        running += count_nonzero(pixels[previous:boundary]<threshold,axis=0)
+        previous = boundary
+        cumsum(running,out=integral[k,1:])
+    return integral
+
+def get_positions(length,size,stride):
+    '''
+    Starting positions of patches along one axis: every stride, plus one at the end,
+    so the whole axis is covered
+
+    Parameters:
+        length   Number of pixels along axis
+        size     Number of pixels in patch
+        stride   Distance between starts of consecutive patches
+    '''
+    if length<size:
+        return arange(0)
+    positions = arange(0,length-size+1,stride)
+    return positions if positions[-1]==length-size else append(positions,length-size)
+
+def extract_patches(pixels,
+                    size           = 256,
+                    stride         = 128,
+                    min_foreground = 0.5,
+                    batch_size     = 64,
+                    epsilon        = 0.01,
+                    out            = None):
+    '''
+    A generator for patches that are mostly foreground, a batch at a time.
+    There are none if image is smaller than a patch.
+    The fraction of foreground in each patch is found from rows of the integral image,
+    one row of patches at a time.
+
+    Parameters:
+        pixels           Image, e.g. from Segmenter.segment
+        size             Number of rows and columns in each patch
+        stride           Distance between patches; less than size for overlapping patches
+        min_foreground   Patches with a smaller fraction of foreground pixels are rejected
+        batch_size       Maximum number of patches in each batch
+        epsilon          Used to separate foreground from background
+        out              Buffer for batch, batch_size x size x size (default: allocate one)
+
+    Yields:
+        coordinates   n x 2: row and column of top left of each patch
+        patches       n x size x size: a view of out, which is reused for the next batch, so copy it if it is to be kept
+    '''
+    if pixels.shape[0]<size or pixels.shape[1]<size:
+        return
+    if out is None:
+        out = empty((batch_size,size,size),dtype=pixels.dtype)
+    windows     = sliding_window_view(pixels,(size,size))
+    rows        = get_positions(pixels.shape[0],size,stride)
+    columns     = get_positions(pixels.shape[1],size,stride)
+    boundaries  = unique(concatenate([rows,rows+size]))
+    integral    = get_integral_rows(pixels,boundaries,get_threshold(pixels,epsilon))
+    top         = searchsorted(boundaries,rows)
+    bottom      = searchsorted(boundaries,rows+size)
+    min_count   = min_foreground*size*size
+    coordinates = empty((batch_size,2),dtype=int64)
+    n           = 0
+    for i,p,q in zip(rows,top,bottom):
+        counts = integral[q,columns+size] - integral[p,columns+size] - integral[q,columns] + integral[p,columns]
+        for j in columns[flatnonzero(counts>=min_count)]:
+            out[n]         = windows[i,j]
+            coordinates[n] = i,j
+            n             += 1
+            if n==batch_size:
+                yield coordinates[:n],out[:n]
+                n = 0
+    if n>0:
+        yield coordinates[:n],out[:n]
+
+if __name__=='__main__':
+    from loader  import Loader, get_all_images
+    from segment import Segmenter
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('image_ids',        nargs='*', type=int,               help='Images to be processed (omit for all images)')
+    parser.add_argument('--path',           default=PATH,                      help='Location of data')
+    parser.add_argument('--size',           default=256,  type=int,            help='Number of rows and columns in each patch')
+    parser.add_argument('--stride',         default=128,  type=int,            help='Distance between patches')
+    parser.add_argument('--min-foreground', default=0.5,  type=float,          help='Minimum fraction of foreground in each patch')
+    parser.add_argument('--batch-size',     default=64,   type=int,            help='Maximum number of patches in each batch')
+    parser.add_argument('--output',         default=None,                      help='Write mosaic of first batch of each image to this folder')
+    args      = parser.parse_args()
+    loader    = Loader(path=args.path)
+    image_ids = args.image_ids if len(args.image_ids)>0 else get_all_images(path=args.path)
+    out       = empty((args.batch_size,args.size,args.size),dtype='uint8')
+    n_images  = 0
+    n_patches = 0
+    start     = perf_counter()
+    for image_id,pixels,laterality,view,_ in loader.get_images(image_ids):
+        segmenter = Segmenter.Create(view)
+        if segmenter!=None:
+            pixels = segmenter.segment(pixels)
+        for k,(coordinates,patches) in enumerate(extract_patches(pixels,
+                                                                 size           = args.size,
+                                                                 stride         = args.stride,
+                                                                 min_foreground = args.min_foreground,
+                                                                 batch_size     = args.batch_size,
+                                                                 out            = out)):
+            n_patches += len(patches)
+            if k==0 and args.output!=None:
+                from math    import ceil, sqrt
+                from mosaic  import create_mosaic, write_mosaic
+                from os.path import join
+                columns = ceil(sqrt(len(patches)))
+                write_mosaic(create_mosaic(patches,[f'{i},{j}' for i,j in coordinates],(ceil(len(patches)/columns),columns),
+                                           cell  = (args.size,args.size),
+                                           title = f'{image_id} {laterality} {view}'),
+                             join(args.output,f'patches-{image_id}.jpg'))
+        n_images += 1
+    elapsed = perf_counter() - start
+    print (f'{n_patches} patches from {n_images} images in {elapsed:.1f} sec')
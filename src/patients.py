@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Index master file by patient and breast, so patient level passes don't need to scan the whole table'''
+
+from numpy  import add, append, flatnonzero, maximum, ones
+from pandas import Index
+
+class PatientIndex:
+    '''
+    This class sorts the master file once by patient and laterality, so the rows for each
+    patient, and for each breast, are contiguous and can be returned as slices.
+
+    Attributes:
+        df                       Master file, sorted by patient_id and laterality
+        patient_ids              Each patient, in ascending order
+        patient_starts           Position in df of first row for each patient
+        patient_ends             Position in df after last row for each patient
+        breasts                  (patient_id, laterality) for each breast
+        breast_starts            Position in df of first row for each breast
+        breast_ends              Position in df after last row for each breast
+        cancer                   For each breast, True if any image shows cancer (training data only)
+        cancer_on_one_side_only  For each patient, True if some, but not all, images show cancer (training data only)
+    '''
+    def __init__(self,df):
+        self.df               = df.sort_values(['patient_id','laterality'],kind='stable').reset_index(drop=True)
+        patient_ids           = self.df['patient_id'].to_numpy()
+        lateralities          = self.df['laterality'].to_numpy()
+        n                     = len(self.df)
+
+        new_patient           = ones(n,dtype=bool)
+        new_patient[1:]       = patient_ids[1:]!=patient_ids[:-1]
+        self.patient_starts   = flatnonzero(new_patient)
+        self.patient_ends     = append(self.patient_starts[1:],n)
+        self.patient_ids      = patient_ids[self.patient_starts]
+        self.patient_position = {patient_id:i for i,patient_id in enumerate(self.patient_ids)}
+
+        new_breast            = new_patient.copy()
+        new_breast[1:]       |= lateralities[1:]!=lateralities[:-1]
+        self.breast_starts    = flatnonzero(new_breast)
+        self.breast_ends      = append(self.breast_starts[1:],n)
+        self.breasts          = list(zip(patient_ids[self.breast_starts],lateralities[self.breast_starts]))
+
+        self.image_ids        = Index(self.df['image_id'])
+
+        if 'cancer' in self.df.columns and n>0:
+            cancer                       = self.df['cancer'].to_numpy().astype(int)
+            self.cancer                  = maximum.reduceat(cancer,self.breast_starts)>0
+            n_cancers                    = add.reduceat(cancer,self.patient_starts)
+            self.cancer_on_one_side_only = (n_cancers>0) & (n_cancers<self.patient_ends-self.patient_starts)
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def get_patient(self,patient_id):
+        '''
+        Rows from master file for one patient
+        '''
+        i = self.patient_position[patient_id]
+        return self.df.iloc[self.patient_starts[i]:self.patient_ends[i]]
+
+    def get_patients(self,selected=None):
+        '''
+        A generator for iterating through patients
+
+        Parameters:
+            selected   Optional mask, e.g. cancer_on_one_side_only, used to choose patients
+
+        Yields:
+            patient_id, rows from master file for patient
+        '''
+        for i in range(len(self.patient_ids)) if selected is None else flatnonzero(selected):
+            yield self.patient_ids[i], self.df.iloc[self.patient_starts[i]:self.patient_ends[i]]
+
+    def get_breasts(self,selected=None):
+        '''
+        A generator for iterating through breasts
+
+        Parameters:
+            selected   Optional mask, e.g. cancer, used to choose breasts
+
+        Yields:
+            patient_id, laterality, rows from master file for breast
+        '''
+        for i in range(len(self.breasts)) if selected is None else flatnonzero(selected):
+            patient_id,laterality = self.breasts[i]
+            yield patient_id, laterality, self.df.iloc[self.breast_starts[i]:self.breast_ends[i]]
+
+    def get_row(self,image_id):
+        '''
+        Row from master file for one image
+        '''
+        return self.df.iloc[self.image_ids.get_loc(image_id)]
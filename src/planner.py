@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Plan downloads by comparing the list of files on Kaggle with what has already been
+    downloaded, split them into batches of similar size, and optionally fetch them.
+'''
+
+from abc                import ABC, abstractmethod
+from argparse           import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from heapq              import heapify, heappop, heapreplace
+from math               import ceil
+from os                 import makedirs, replace
+from os.path            import dirname, exists, getsize, join
+from re                 import compile
+from shutil             import copyfileobj
+from subprocess         import CalledProcessError, run
+from time               import perf_counter, sleep
+from urllib.error       import URLError
+from urllib.parse       import quote
+from urllib.request     import Request, urlopen
+
+PATH        = r'D:\data\rsna-breast-cancer-detection'
+COMPETITION = 'rsna-breast-cancer-detection'
+UNITS       = {'B':1, 'KB':1<<10, 'MB':1<<20, 'GB':1<<30, 'TB':1<<40}
+LISTING     = compile(r'^(\S+)\s+([\d.]+)\s*([KMGT]?B)\b')
+
+def parse_listing(file_name):
+    '''
+    Read list of remote files, as produced by kaggle competitions files
+
+    Yields:
+        name, approximate size in bytes
+    '''
+    with open(file_name) as listing:
+        for line in listing:
+            match = LISTING.match(line.strip())
+            if match:
+                name,size,unit = match.groups()
+                yield name, int(float(size)*UNITS[unit])
+
+def get_remote_from_master(master,dataset='train_images'):
+    '''
+    Construct names of remote files from metadata, for use when there is no listing.
+    Sizes are unknown, so every file is given size 1, and batches are balanced by number of files.
+
+    Yields:
+        name, size
+    '''
+    for patient_id,image_id in zip(master['patient_id'],master['image_id']):
+        yield f'{dataset}/{patient_id}/{image_id}.dcm', 1
+
+def parse_name(name):
+    '''
+    Extract patient_id and image_id from name of remote file, e.g. train_images/10006/462822612.dcm
+
+    Returns:
+        patient_id, image_id, or None if name does not refer to an image
+    '''
+    parts = name.split('/')
+    if len(parts)==3 and parts[0].endswith('_images') and parts[2].endswith('.dcm'):
+        return int(parts[1]),int(parts[2][:-4])
+
+def get_local_images(images_path):
+    '''
+    Find images that have already been downloaded, whether or not they have been restructured
+    '''
+    from restructure import scan
+    if not exists(images_path): return set()
+    found,_,_ = scan(images_path)
+    return set(found.keys())
+
+def select(remote,master,
+           cancer   = False,
+           partners = False,
+           sites    = None,
+           dataset  = 'train_images'):
+    '''
+    Choose images to be downloaded
+
+    Parameters:
+        remote     (name,size) for each remote file
+        master     Metadata from train.csv (only needed if images are selected by criteria)
+        cancer     Select images that show cancer
+        partners   Select all images for patients who have cancer on one side only
+        sites      Restrict selection to these sites
+        dataset    Restrict selection to files in this directory
+
+    Returns:
+        (name,size,image_id) for each selected image
+    '''
+    wanted   = None
+    if cancer or partners or sites!=None:
+        from patients import PatientIndex
+        index = PatientIndex(master)
+        if cancer or partners:
+            wanted = set()
+            if cancer:
+                wanted.update(index.df['image_id'][index.df['cancer']])
+            if partners:
+                for _,df_patient in index.get_patients(index.cancer_on_one_side_only):
+                    wanted.update(df_patient['image_id'])
+        if sites!=None:
+            at_sites = set(index.df['image_id'][index.df['site_id'].isin(sites)])
+            wanted   = at_sites if wanted==None else wanted & at_sites
+    selected = []
+    for name,size in remote:
+        ids = parse_name(name)
+        if ids!=None and name.startswith(dataset) and (wanted==None or ids[1] in wanted):
+            selected.append((name,size,ids[1]))
+    return selected
+
+def create_plan(remote,local):
+    '''
+    Remove images that have already been downloaded from selection
+
+    Parameters:
+        remote   (name,size,image_id) for each selected image
+        local    image_ids that have already been downloaded
+    '''
+    return [(name,size) for name,size,image_id in remote if image_id not in local]
+
+def balance(files,max_bytes=None,n_batches=None,max_files=None):
+    '''
+    Divide files into batches of similar total size: each file, largest first,
+    is assigned to the batch that currently has the fewest bytes, unless that batch is full.
+
+    Parameters:
+        files       (name,size) for each file
+        max_bytes   Target size for each batch: used to calculate number of batches
+        n_batches   Number of batches (used if max_bytes not specified)
+        max_files   Maximum number of files in each batch: adds batches if necessary
+
+    Returns:
+        A list of batches, each a list of names: empty if there are no files
+    '''
+    if len(files)==0: return []
+    total = sum(size for _,size in files)
+    if max_bytes!=None:
+        n_batches = max(1,ceil(total/max_bytes))
+    n_batches = max(1,min(n_batches if n_batches!=None else 1,len(files)))
+    if max_files!=None:
+        n_batches = max(n_batches,ceil(len(files)/max_files))
+    heap      = [(0,i) for i in range(n_batches)]
+    batches   = [[] for _ in range(n_batches)]
+    heapify(heap)
+    for name,size in sorted(files,key=lambda file:file[1],reverse=True):
+        total,i = heap[0]
+        batches[i].append(name)
+        if max_files!=None and len(batches[i])>=max_files:
+            heappop(heap)
+        else:
+            heapreplace(heap,(total+size,i))
+    return batches
+
+def write_batch(names,file_name,path=PATH):
+    '''
+    Write a batch file of kaggle commands to download files
+    '''
+    with open(file_name,'w') as out:
+        for name in names:
+            out.write(f'kaggle competitions download -f {name}  -p {path} {COMPETITION}\n')
+
+def write_batches(batches,prefix='download',path=PATH):
+    '''
+    Write one batch file for each batch
+
+    Returns:
+        Names of batch files
+    '''
+    file_names = []
+    for i,names in enumerate(batches):
+        file_name = f'{prefix}{i+1}.bat' if len(batches)>1 else f'{prefix}.bat'
+        write_batch(names,file_name,path=path)
+        file_names.append(file_name)
+    return file_names
+
+class Transport(ABC):
+    '''
+    This class represents the mechanism used to download a file
+    '''
+    @abstractmethod
+    def download(self,name,destination):
+        '''
+        Download remote file
+
+        Parameters:
+            name          Name of remote file, e.g. train_images/10006/462822612.dcm
+            destination   Where file is to be stored
+        '''
+        ...
+
+class KaggleTransport(Transport):
+    '''
+    Download using the kaggle command line tool, which cannot resume partial downloads
+    '''
+    def __init__(self,competition=COMPETITION):
+        self.competition = competition
+
+    def download(self,name,destination):
+        run(['kaggle', 'competitions', 'download', '-f', name, '-p', dirname(destination), self.competition],
+            check          = True,
+            capture_output = True)
+        if not exists(destination):            # e.g. saved as a zip file under another name
+            raise OSError(f'kaggle did not create {destination}')
+
+class HTTPTransport(Transport):
+    '''
+    Download from an HTTP server, resuming partial downloads if server supports Range requests
+    '''
+    def __init__(self,base_url,timeout=60,block=1<<20):
+        self.base_url = base_url.rstrip('/')
+        self.timeout  = timeout
+        self.block    = block
+
+    def download(self,name,destination):
+        partial = f'{destination}.partial'
+        offset  = getsize(partial) if exists(partial) else 0
+        headers = {'Range':f'bytes={offset}-'} if offset>0 else {}
+        with urlopen(Request(f'{self.base_url}/{quote(name)}',headers=headers),timeout=self.timeout) as response:
+            if response.status!=206:
+                offset = 0            # Server ignored Range, so start again
+            with open(partial,'ab' if offset>0 else 'wb') as out:
+                copyfileobj(response,out,self.block)
+        replace(partial,destination)
+
+def fetch_all(transport,names,
+              path    = PATH,
+              threads = 4,
+              retries = 3,
+              backoff = 1.0):
+    '''
+    Download files in a pool of threads, retrying failures with exponential backoff.
+    Files that already exist are skipped, so an interrupted run can simply be repeated.
+
+    Parameters:
+        transport   Used to download each file
+        names       Names of remote files
+        path        Files are stored in path/name
+        threads     Number of threads
+        retries     Number of attempts after first failure
+        backoff     Delay before first retry, doubled after each subsequent failure
+
+    Returns:
+        Names of files that could not be downloaded
+    '''
+    def fetch(name):
+        destination = join(path,name)
+        if exists(destination): return False
+        makedirs(dirname(destination),exist_ok=True)
+        delay = backoff
+        for attempt in range(retries+1):
+            try:
+                transport.download(name,destination)
+                return True
+            except (OSError,URLError,CalledProcessError) as e:
+                if attempt==retries: raise
+                print (f'{name}: {e}, retrying in {delay} sec')
+                sleep(delay)
+                delay *= 2
+
+    fetched = 0
+    failed  = []
+    start   = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(fetch,name):name for name in names}
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    fetched += 1
+            except (OSError,URLError,CalledProcessError) as e:
+                print (f'{futures[future]}: {e}')
+                failed.append(futures[future])
+    print (f'Fetched {fetched} files in {perf_counter()-start:.1f} sec, {len(failed)} failed')
+    return failed
+
+if __name__=='__main__':
+    from metadata import read_metadata
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',      default=PATH,                       help='Location of data')
+    parser.add_argument('--listing',   default='files.txt',                help='List of remote files, relative to path')
+    parser.add_argument('--cancer',    default=False, action='store_true', help='Select images that show cancer')
+    parser.add_argument('--partners',  default=False, action='store_true', help='Select all images for patients with cancer on one side only')
+    parser.add_argument('--sites',     default=None,  nargs='+', type=int, help='Select images from these sites')
+    parser.add_argument('--max-bytes', default=None,  type=float,          help='Target size of each batch (MB)')
+    parser.add_argument('--batches',   default=None,  type=int,            help='Number of batches')
+    parser.add_argument('--prefix',    default='download',                 help='Prefix for names of batch files')
+    parser.add_argument('--fetch',     default=False, action='store_true', help='Download files instead of writing batch files')
+    parser.add_argument('--url',       default=None,                       help='Download from this HTTP server instead of using kaggle')
+    parser.add_argument('--threads',   default=4,     type=int,            help='Number of threads used by --fetch')
+    parser.add_argument('--retries',   default=3,     type=int,            help='Number of retries used by --fetch')
+    args     = parser.parse_args()
+    selected = select(parse_listing(join(args.path,args.listing)),read_metadata(args.path),
+                      cancer   = args.cancer,
+                      partners = args.partners,
+                      sites    = args.sites)
+    plan     = create_plan(selected,get_local_images(join(args.path,'train_images')))
+    print (f'Selected {len(selected)} images, {len(plan)} to be downloaded, {sum(size for _,size in plan)/(1<<30):.1f} GB')
+    if args.fetch:
+        fetch_all(KaggleTransport() if args.url==None else HTTPTransport(args.url),
+                  [name for name,_ in plan],
+                  path    = args.path,
+                  threads = args.threads,
+                  retries = args.retries)
+    else:
+        batches = balance(plan,
+                          max_bytes = args.max_bytes*(1<<20) if args.max_bytes!=None else None,
+                          n_batches = args.batches)
+        for file_name in write_batches(batches,prefix=args.prefix,path=args.path):
+            print (file_name)
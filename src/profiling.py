@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Opt in profiling of named stages, such as decode, window, or bounds. When the environment variable
+    RSNA_PROFILE names a folder, or enable is called, each process records cProfile statistics and
+    tracemalloc memory use for each stage, and writes them to the folder when it exits. Run this
+    module to merge the results from all processes, and write collapsed stacks for flamegraph tools.
+    When profiling is off, stage returns a context manager that does nothing.
+'''
+
+from argparse             import ArgumentParser
+from atexit               import register
+from contextlib           import nullcontext
+from cProfile             import Profile
+from glob                 import glob
+from multiprocessing      import parent_process
+from multiprocessing.util import Finalize
+from os                   import environ, getpid, makedirs, replace
+from os.path              import basename, join
+from re                   import match
+from time                 import perf_counter
+from tracemalloc          import get_traced_memory, is_tracing, reset_peak, start
+
+ENVIRONMENT = 'RSNA_PROFILE'
+DISABLED    = nullcontext()
+
+class Profiler:
+    '''
+    Profiles and memory use for each stage in one process. Stages may be nested: time spent in the
+    inner stage is profiled there, not in the outer one, but elapsed time and peak memory of the
+    outer stage include the inner one. Stages should only be used from one thread in each process.
+
+    Attributes:
+        directory   Where results are written
+        pid         Process that owns profiler
+        profiles    cProfile.Profile for each stage
+        memory      For each stage: calls, elapsed time, peak memory above that at start, net memory allocated
+        active      Stages that have been entered, but not exited: name, start time, memory at start, peak so far
+    '''
+    def __init__(self,directory):
+        self.directory = directory
+        self.pid       = getpid()
+        self.profiles  = {}
+        self.memory    = {}
+        self.active    = []
+        if not is_tracing():
+            start()
+        if parent_process()==None:
+            register(self.dump)
+        else:
+            Finalize(None,self.dump,exitpriority=100)      # Worker processes exit without calling atexit handlers
+
+    def enter(self,name):
+        if len(self.active)>0:
+            outer    = self.active[-1]
+            self.profiles[outer[0]].disable()
+            outer[3] = max(outer[3],get_traced_memory()[1])
+        current,_ = get_traced_memory()
+        reset_peak()
+        self.active.append([name,perf_counter(),current,current])
+        self.profiles.setdefault(name,Profile()).enable()
+
+    def exit(self):
+        name,started,initial,peak = self.active.pop()
+        self.profiles[name].disable()
+        current,traced_peak = get_traced_memory()
+        peak                = max(peak,traced_peak)
+        statistics          = self.memory.setdefault(name,[0,0.0,0,0])
+        statistics[0]      += 1
+        statistics[1]      += perf_counter() - started
+        statistics[2]       = max(statistics[2],peak-initial)
+        statistics[3]      += current - initial
+        if len(self.active)>0:
+            outer    = self.active[-1]
+            outer[3] = max(outer[3],peak)
+            reset_peak()
+            self.profiles[outer[0]].enable()
+
+    def dump(self):
+        '''
+        Write a profile for each stage, and memory use for all stages, tagged with process id
+        '''
+        if len(self.memory)==0: return
+        for name,profile in self.profiles.items():
+            profile.dump_stats(join(self.directory,f'{name}-{self.pid}.prof'))
+        file_name = join(self.directory,f'memory-{self.pid}.csv')
+        with open(f'{file_name}.tmp','w') as out:
+            out.write('stage,pid,calls,elapsed,peak,net\n')
+            for name,(calls,elapsed,peak,net) in self.memory.items():
+                out.write(f'{name},{self.pid},{calls},{elapsed},{peak},{net}\n')
+        replace(f'{file_name}.tmp',file_name)
+
+class Stage:
+    '''Context manager for one stage'''
+    def __init__(self,profiler,name):
+        self.profiler = profiler
+        self.name     = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+
+    def __exit__(self,*args):
+        self.profiler.exit()
+
+profiler = None
+
+def enable(directory):
+    '''
+    Start profiling in this process, and in any processes that it starts
+
+    Parameters:
+        directory   Where results are to be written
+    '''
+    global profiler
+    makedirs(directory,exist_ok=True)
+    environ[ENVIRONMENT] = directory         # Inherited by worker processes
+    profiler             = Profiler(directory)
+
+def stage(name):
+    '''
+    Profile a stage, e.g. with stage('decode'): ...
+
+    Parameters:
+        name   Identifies stage: used in file names
+    '''
+    if profiler==None:
+        return DISABLED
+    if profiler.pid!=getpid():                # Forked worker: start afresh, rather than repeating parent's results
+        enable(profiler.directory)
+    return Stage(profiler,name)
+
+def get_collapsed(stats,prefix):
+    '''
+    Convert profile to collapsed stacks, frame;frame;... value, as used by flamegraph tools.
+    cProfile only records callers and callees, so time spent in a function is shared between its
+    callers in proportion to the time they spent calling it.
+
+    Parameters:
+        stats    pstats.Stats
+        prefix   Name of stage: used as root of every stack
+
+    Returns:
+        Dictionary: stack -> time in microseconds
+    '''
+    entries = stats.stats
+    callees = {}
+    for function,(_,_,_,_,callers) in entries.items():
+        for caller,edge in callers.items():
+            callees.setdefault(caller,{})[function] = edge[3]
+    stacks  = {}
+
+    def get_label(function):
+        file_name,line,name = function
+        return (f'{name} ({basename(file_name)}:{line})' if line>0 else name).replace(';',',')
+
+    def visit(function,path,visited,fraction,depth=0):
+        _,_,tt,ct,_ = entries[function]
+        path        = f'{path};{get_label(function)}'
+        stacks[path] = stacks.get(path,0) + tt*fraction*1e6
+        if depth>64: return
+        for callee,time in callees.get(function,{}).items():
+            if callee in visited or callee not in entries or entries[callee][3]<=0: continue
+            share = fraction*time/entries[callee][3]
+            if share*entries[callee][3]>1e-6:
+                visit(callee,path,visited|{callee},share,depth+1)
+
+    for function,(_,_,_,_,callers) in entries.items():
+        if basename(function[0])=='profiling.py': continue             # Profiler's own exit from stage
+        if not any(caller in entries for caller in callers):
+            visit(function,prefix,{function},1.0)
+    return {stack:int(value) for stack,value in stacks.items() if int(value)>0}
+
+def merge(directory):
+    '''
+    Combine results from all processes: write a merged profile and collapsed stacks for each stage,
+    and memory use for each stage and process
+
+    Returns:
+        For each stage: number of processes, calls, elapsed time, peak memory, net memory allocated
+    '''
+    from pstats import Stats
+    files = {}
+    for file_name in glob(join(directory,'*-*.prof')):
+        matched = match(r'^(.+)-(\d+)\.prof$',basename(file_name))
+        if matched:
+            files.setdefault(matched.group(1),[]).append(file_name)
+    for name,file_names in files.items():
+        stats = Stats(*file_names)
+        stats.dump_stats(join(directory,f'{name}.prof'))
+        with open(join(directory,f'{name}.collapsed'),'w') as out:
+            for stack,value in sorted(get_collapsed(stats,name).items()):
+                out.write(f'{stack} {value}\n')
+    summary = {}
+    with open(join(directory,'memory.csv'),'w') as out:
+        out.write('stage,pid,calls,elapsed,peak,net\n')
+        for file_name in sorted(glob(join(directory,'memory-*.csv'))):
+            with open(file_name) as f:
+                f.readline()
+                for line in f:
+                    out.write(line)
+                    name,_,calls,elapsed,peak,net = line.strip().split(',')
+                    totals    = summary.setdefault(name,[0,0,0.0,0,0])
+                    totals[0] += 1
+                    totals[1] += int(calls)
+                    totals[2] += float(elapsed)
+                    totals[3]  = max(totals[3],int(peak))
+                    totals[4] += int(net)
+    return summary
+
+if ENVIRONMENT in environ:
+    enable(environ[ENVIRONMENT])
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('directory',                          help='Folder containing results from profiled run')
+    parser.add_argument('--top',     default=10, type=int,    help='Number of functions to list for each stage')
+    args    = parser.parse_args()
+    summary = merge(args.directory)
+    print (f'{"stage":16s} {"processes":>9s} {"calls":>8s} {"elapsed":>10s} {"peak MB":>9s} {"net MB":>9s}')
+    for name,(processes,calls,elapsed,peak,net) in sorted(summary.items(),key=lambda item:-item[1][2]):
+        print (f'{name:16s} {processes:9d} {calls:8d} {elapsed:10.2f} {peak/(1<<20):9.1f} {net/(1<<20):9.1f}')
+    if args.top>0:
+        from pstats import Stats
+        for name in summary:
+            print (f'\n{name}')
+            Stats(join(args.directory,f'{name}.prof')).sort_stats('tottime').print_stats(args.top)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Render figures in parallel without a display, skipping any that are already up to date'''
+
+from collections        import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os                 import remove, replace
+from os.path            import exists, getmtime, splitext
+from profiling          import stage
+from time               import perf_counter
+
+Job = namedtuple('Job',['output','inputs','parameters'])
+Job.__doc__ = '''
+    A figure to be rendered
+
+    Fields:
+        output       Name of file where figure will be saved
+        inputs       Files (e.g. dcm) from which figure is created
+        parameters   Passed to render function as keyword arguments
+'''
+
+def use_headless():
+    '''Force the Agg backend, so figures can be created without a display, e.g. in worker processes'''
+    from matplotlib import use
+    use('Agg', force=True)
+
+def is_up_to_date(output,inputs):
+    '''
+    Verify that output exists and is newer than all inputs
+    '''
+    if not exists(output): return False
+    modified = getmtime(output)
+    return all(getmtime(file)<=modified for file in inputs if exists(file))
+
+def save_figure(fig,output):
+    '''
+    Save figure, then close it so memory does not build up. The figure is written to
+    a temporary file first, so an interrupted run never leaves a partial figure that
+    looks up to date.
+    '''
+    from matplotlib.pyplot import close
+    base,ext = splitext(output)
+    temp     = f'{base}.partial{ext}'
+    try:
+        with stage('render'):
+            fig.savefig(temp)
+        replace(temp,output)
+    finally:
+        close(fig)
+        if exists(temp):
+            remove(temp)
+
+def render_all(jobs,render,
+               processes   = None,
+               initializer = None,
+               initargs    = (),
+               force       = False):
+    '''
+    Render figures in a pool of processes
+
+    Parameters:
+        jobs          Figures to be rendered
+        render        Function that renders one figure: called with job, must be defined at module level
+        processes     Number of worker processes (default: one per CPU)
+        initializer   Called once in each worker, e.g. to create a Loader
+        initargs      Arguments for initializer
+        force         Render figures even if they are up to date
+
+    Returns:
+        Number of figures rendered, number skipped, and number that failed
+    '''
+    pending  = [job for job in jobs if force or not is_up_to_date(job.output,job.inputs)]
+    skipped  = len(jobs) - len(pending)
+    rendered = 0
+    failed   = 0
+    start    = perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, initializer=initializer, initargs=initargs) as executor:
+        futures = {executor.submit(render,job):job for job in pending}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                rendered += 1
+            except Exception as e:                 # One bad image should not abandon the batch
+                print (futures[future].output, e)
+                failed += 1
+    elapsed = perf_counter() - start
+    print (f'Rendered {rendered} figures in {elapsed:.1f} sec ({rendered/elapsed if elapsed>0 else 0:.2f} figures/sec), '
+           f'skipped {skipped} that were up to date, {failed} failed')
+    return rendered,skipped,failed
@@ -26,24 +26,259 @@
     Restructure downloaded training data so all patient directories exist and images are in in patient files.
     Does not download new data.
 '''
-from os.path import exists, join
-from pandas  import read_csv
-from pathlib import Path
-from shutil  import move
+from argparse           import ArgumentParser
+from collections        import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from json               import dumps, loads
+from metadata           import read_metadata
+from os                 import fsync, link, makedirs, remove, scandir
+from os.path            import dirname, exists, join, splitext
+from shutil             import move
+from threading          import Lock
+
 PATH     = r'D:\data\rsna-breast-cancer-detection'
-MASTER   = read_csv(join(PATH,'train.csv'))
 SUB_PATH =  join(PATH,'train_images')
 
-for index,row in MASTER.iterrows():
-    patient_id = row['patient_id']
-    image_id   = row['image_id']
-    patient_path = join(SUB_PATH,str(patient_id))
-    if not exists(patient_path):
-        Path(join(patient_path)).mkdir(parents=True, exist_ok=True)
-    assert exists(patient_path)
-    file_path = join(patient_path,f'{image_id}.dcm')
-    if not exists(file_path):
-        downloaded_path = join(SUB_PATH,f'{image_id}.dcm')
-        if exists(downloaded_path):
-            print (f'moving {downloaded_path} to {file_path}')
-            move(downloaded_path,file_path)
+Plan = namedtuple('Plan',['operations','directories','missing','misplaced','extra'])
+Plan.__doc__ = '''
+    What needs to be done to restructure images
+
+    Fields:
+        operations    (source,destination) for each file to be moved or linked
+        directories   Patient directories that need to be created
+        missing       (patient_id,image_id) for images that have not been downloaded
+        misplaced     Images that are in the wrong patient directory
+        extra         Files that are not in the master file, or are duplicates
+'''
+
+def get_image_id(name):
+    '''Convert file name to image_id, or None if it isn't a dcm file'''
+    stem,ext = splitext(name)
+    if ext=='.dcm' and stem.isdigit():
+        return int(stem)
+
+def scan(images_path):
+    '''
+    List images that have already been downloaded, visiting each directory just once
+
+    Returns:
+        found         Maps image_id to a list of (patient directory, path), where patient directory is None
+                      for images that have been downloaded, but not restructured
+        directories   Patient directories that exist
+        extra         Files that are not images
+    '''
+    found       = {}
+    directories = set()
+    extra       = []
+    with scandir(images_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                directories.add(entry.name)
+                with scandir(entry.path) as files:
+                    for file in files:
+                        image_id = get_image_id(file.name)
+                        if image_id==None:
+                            extra.append(file.path)
+                        else:
+                            found.setdefault(image_id,[]).append((entry.name,file.path))
+            else:
+                image_id = get_image_id(entry.name)
+                if image_id==None:
+                    extra.append(entry.path)
+                else:
+                    found.setdefault(image_id,[]).append((None,entry.path))
+    return found,directories,extra
+
+def create_plan(master,images_path):
+    '''
+    Compare images that have been downloaded with expected layout, train_images/patient_id/image_id.dcm
+
+    Parameters:
+        master        Metadata, from train.csv
+        images_path   Location of train_images
+    '''
+    found,directories,extra = scan(images_path)
+    expected                = dict(zip(master['image_id'],master['patient_id'].astype(str)))
+    operations              = []
+    missing                 = []
+    misplaced               = []
+    for image_id,patient_id in expected.items():
+        locations = found.get(image_id,[])
+        in_place  = [path for directory,path in locations if directory==patient_id]
+        if len(in_place)>0:
+            extra.extend(path for directory,path in locations if directory!=patient_id)
+            continue
+        if len(locations)==0:
+            missing.append((int(patient_id),image_id))
+            continue
+        locations.sort(key=lambda location:location[0]!=None)        # Prefer files that haven't been restructured
+        if locations[0][0]!=None:
+            misplaced.append(locations[0][1])
+        operations.append((locations[0][1],join(images_path,patient_id,f'{image_id}.dcm')))
+        extra.extend(path for _,path in locations[1:])
+    extra.extend(path for image_id,locations in found.items() if image_id not in expected for _,path in locations)
+    return Plan(operations  = operations,
+                directories = sorted(set(expected.values()) - directories),
+                missing     = missing,
+                misplaced   = misplaced,
+                extra       = extra)
+
+def report(plan,verbose=False):
+    '''
+    Describe plan, e.g. for a dry run
+    '''
+    print (f'{len(plan.operations)} images to be restructured, {len(plan.directories)} patient directories to be created')
+    for name,items in [('missing',plan.missing),('misplaced',plan.misplaced),('extra',plan.extra)]:
+        print (f'{len(items)} {name}')
+        if verbose:
+            for item in items:
+                print (f'    {item}')
+    if verbose:
+        for source,destination in plan.operations:
+            print (f'{source} -> {destination}')
+
+class Journal:
+    '''
+    A write ahead log: all operations are recorded before any are performed, and each is
+    marked as done once it has been performed, so an interrupted run can be resumed or rolled back.
+    '''
+    def __init__(self,file_name):
+        self.file_name = file_name
+        self.lock      = Lock()
+
+    def start(self,operations,use_links=False):
+        '''Record operations that are about to be performed'''
+        with open(self.file_name,'w') as journal:
+            journal.write(dumps({'link':use_links})+'\n')
+            for i,(source,destination) in enumerate(operations):
+                journal.write(dumps({'i':i,'source':source,'destination':destination})+'\n')
+            journal.flush()
+            fsync(journal.fileno())
+        self.out = open(self.file_name,'a')
+
+    def done(self,i):
+        '''Record an operation that has been performed'''
+        with self.lock:
+            self.out.write(dumps({'done':i})+'\n')
+            self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+    def read(self):
+        '''
+        Read journal
+
+        Returns:
+            use_links    Indicates whether files were linked instead of being moved
+            operations   (source,destination) for all operations
+            done         Indices of operations that have been performed
+        '''
+        operations = []
+        done       = set()
+        with open(self.file_name) as journal:
+            use_links = loads(journal.readline())['link']
+            for line in journal:
+                try:
+                    record = loads(line)
+                except ValueError:
+                    break          # Last line may have been truncated by a crash
+                if 'done' in record:
+                    done.add(record['done'])
+                else:
+                    operations.append((record['source'],record['destination']))
+        return use_links,operations,done
+
+def perform(source,destination,use_links=False):
+    '''Move or link one file into place'''
+    makedirs(dirname(destination),exist_ok=True)
+    if use_links:
+        link(source,destination)
+    else:
+        move(source,destination)
+
+def execute(operations,journal,use_links=False,threads=8,done=set()):
+    '''
+    Perform operations in a pool of threads, recording progress in journal
+
+    Parameters:
+        operations   (source,destination) for each file
+        journal      Used to record progress
+        use_links    Create hard links instead of moving files
+        threads      Number of threads
+        done         Indices of operations that have already been performed
+    '''
+    def perform_one(i):
+        source,destination = operations[i]
+        if not exists(destination):
+            perform(source,destination,use_links=use_links)
+        journal.done(i)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(perform_one,i) for i in range(len(operations)) if i not in done]:
+            future.result()
+
+def restructure(plan,journal,images_path=SUB_PATH,use_links=False,threads=8):
+    '''Create patient directories, then move or link images into them'''
+    for patient_id in plan.directories:
+        makedirs(join(images_path,patient_id),exist_ok=True)
+    journal.start(plan.operations,use_links=use_links)
+    try:
+        execute(plan.operations,journal,use_links=use_links,threads=threads)
+    finally:
+        journal.close()
+    remove(journal.file_name)
+
+def resume(journal,threads=8):
+    '''Complete operations from an interrupted run'''
+    use_links,operations,done = journal.read()
+    print (f'Resuming: {len(done)} of {len(operations)} already done')
+    journal.out = open(journal.file_name,'a')
+    try:
+        execute(operations,journal,use_links=use_links,threads=threads,done=done)
+    finally:
+        journal.close()
+    remove(journal.file_name)
+
+def rollback(journal):
+    '''
+    Undo operations from an interrupted run, in reverse order. Every operation is checked, not
+    just those marked as done, in case the run was interrupted before one could be marked.
+    Destinations did not exist when the plan was made, so any that exist now were created by the run.
+    '''
+    use_links,operations,done = journal.read()
+    undone = 0
+    for source,destination in operations[::-1]:
+        if use_links and exists(destination):
+            remove(destination)
+            undone += 1
+        elif exists(destination) and not exists(source):
+            move(destination,source)
+            undone += 1
+    print (f'Rolled back {undone} of {len(operations)}')
+    remove(journal.file_name)
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',     default=PATH,                        help='Location of data')
+    parser.add_argument('--dry-run',  default=False, action='store_true',  help='Report what needs to be done, without doing it')
+    parser.add_argument('--verbose',  default=False, action='store_true',  help='List files in report')
+    parser.add_argument('--link',     default=False, action='store_true',  help='Create hard links instead of moving files')
+    parser.add_argument('--threads',  default=8,     type=int,             help='Number of threads')
+    parser.add_argument('--resume',   default=False, action='store_true',  help='Complete an interrupted run')
+    parser.add_argument('--rollback', default=False, action='store_true',  help='Undo an interrupted run')
+    args        = parser.parse_args()
+    images_path = join(args.path,'train_images')
+    journal     = Journal(join(args.path,'restructure.journal'))
+
+    if args.resume:
+        resume(journal,threads=args.threads)
+    elif args.rollback:
+        rollback(journal)
+    else:
+        if exists(journal.file_name):
+            parser.error(f'{journal.file_name} exists: use --resume or --rollback')
+        plan = create_plan(read_metadata(args.path),images_path)
+        report(plan,verbose=args.verbose)
+        if not args.dry_run:
+            restructure(plan,journal,images_path=images_path,use_links=args.link,threads=args.threads)
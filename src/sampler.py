@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+    Draw class balanced samples of images, so the rare cancers are seen as often as the rest,
+    and divide patients into folds for cross validation.
+'''
+
+from argparse     import ArgumentParser
+from numpy        import arange, bincount, empty, int64, lexsort, ones, unique, where, zeros
+from numpy.random import default_rng
+from time         import perf_counter
+
+PATH    = r'D:\data\rsna-breast-cancer-detection'
+COLUMNS = ['patient_id', 'image_id', 'site_id', 'machine_id', 'cancer']
+
+class AliasTable:
+    '''
+    Walker's alias method, as described by Vose: after O(n) preparation,
+    each draw from a discrete distribution takes O(1) time, however many outcomes there are.
+
+    Attributes:
+        prob    Probability of keeping each column, rather than switching to its alias
+        alias   Alternative outcome for each column
+    '''
+    def __init__(self,weights):
+        n          = len(weights)
+        scaled     = weights*n/weights.sum()
+        self.prob  = ones(n)
+        self.alias = arange(n)
+        small      = [i for i in range(n) if scaled[i]<1]
+        large      = [i for i in range(n) if scaled[i]>=1]
+        while len(small)>0 and len(large)>0:
+            s             = small.pop()
+            l             = large[-1]
+            self.prob[s]  = scaled[s]
+            self.alias[s] = l
+            scaled[l]    -= 1 - scaled[s]
+            if scaled[l]<1:
+                small.append(large.pop())
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self,rng,size):
+        '''
+        Draw outcomes
+
+        Parameters:
+            rng    Random number generator
+            size   Number of outcomes to draw
+        '''
+        column = rng.integers(len(self.prob),size=size)
+        return where(rng.random(size)<self.prob[column],column,self.alias[column])
+
+def get_codes(values):
+    '''Replace each value by a small integer, e.g. for site_id or machine_id'''
+    _,codes = unique(values,return_inverse=True)
+    return codes.reshape(-1)
+
+def get_weights(df,positive_weight=1.0,strata=[]):
+    '''
+    Weight for each row, so that positives and negatives are drawn equally often, or in a specified ratio.
+    If strata are specified, each stratum is drawn as often as it appears in df, and balancing is
+    done within each stratum.
+
+    Parameters:
+        df                Metadata, must include cancer and strata columns
+        positive_weight   Ratio of positives to negatives (1 for balanced)
+        strata            Columns, e.g. site_id, machine_id
+    '''
+    cancer   = df['cancer'].to_numpy().astype(int64)
+    stratum  = zeros(len(df),dtype=int64)
+    for column in strata:
+        codes   = get_codes(df[column].to_numpy())
+        stratum = stratum*(codes.max()+1) + codes
+    stratum  = get_codes(stratum)
+    cell     = 2*stratum + cancer
+    n_cell   = bincount(cell,minlength=2*(stratum.max()+1))
+    n_strata = bincount(stratum)
+    has_both = (n_cell[0::2]>0) & (n_cell[1::2]>0)
+    share    = where(cancer==1,positive_weight,1.0)
+    share   /= where(has_both[stratum],1+positive_weight,share)
+    return share*n_strata[stratum]/n_cell[cell]
+
+def get_folds(df,n_folds=5,seed=None):
+    '''
+    Assign patients to folds, so that no patient is in more than one fold, and patients with cancer are
+    spread evenly between folds.
+
+    Returns:
+        Fold for each row of df
+    '''
+    patient     = get_codes(df['patient_id'].to_numpy())
+    n_patients  = patient.max()+1 if len(patient)>0 else 0
+    has_cancer  = bincount(patient,weights=df['cancer'].to_numpy().astype(float),minlength=n_patients)>0
+    order       = lexsort((default_rng(seed).random(n_patients),~has_cancer))     # Patients with cancer first, then random
+    fold        = empty(n_patients,dtype=int64)
+    fold[order] = arange(n_patients)%n_folds
+    return fold[patient]
+
+class BalancedSampler:
+    '''
+    Draw positions of rows in metadata, with replacement, using weights from get_weights.
+    Each epoch is generated a batch at a time, so it is never held in memory, and is
+    determined by seed and epoch, so runs can be repeated.
+    '''
+    def __init__(self,df,
+                 selected        = None,
+                 positive_weight = 1.0,
+                 strata          = [],
+                 seed            = None,
+                 epoch_size      = None):
+        '''
+        Parameters:
+            df                Metadata
+            selected          Mask for rows that can be drawn, e.g. from get_folds (default: all)
+            positive_weight   Ratio of positives to negatives (1 for balanced)
+            strata            Columns used to stratify, e.g. site_id, machine_id
+            seed              Used with epoch to initialize random number generator
+            epoch_size        Number of rows drawn in each epoch (default: number of selected rows)
+        '''
+        self.positions  = arange(len(df)) if selected is None else where(selected)[0]
+        self.table      = AliasTable(get_weights(df.iloc[self.positions],positive_weight=positive_weight,strata=strata))
+        self.seed       = seed
+        self.epoch      = 0
+        self.epoch_size = epoch_size if epoch_size!=None else len(self.positions)
+
+    def __len__(self):
+        return self.epoch_size
+
+    def set_epoch(self,epoch):
+        self.epoch = epoch
+
+    def get_batches(self,batch_size=1024):
+        '''
+        Generate one epoch
+
+        Yields:
+            Positions in df of rows that have been drawn, batch_size at a time
+        '''
+        rng       = default_rng(None if self.seed==None else (self.seed,self.epoch))
+        remaining = self.epoch_size
+        while remaining>0:
+            size       = min(batch_size,remaining)
+            remaining -= size
+            yield self.positions[self.table.draw(rng,size)]
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield from batch.tolist()
+
+if __name__=='__main__':
+    from metadata import read_metadata
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('--path',            default=PATH,                  help='Location of data')
+    parser.add_argument('--folds',           default=5,    type=int,        help='Number of folds')
+    parser.add_argument('--fold',            default=0,    type=int,        help='Fold held out for validation')
+    parser.add_argument('--positive-weight', default=1.0,  type=float,      help='Ratio of positives to negatives (1 for balanced)')
+    parser.add_argument('--strata',          default=[],   nargs='*',       help='Columns used to stratify, e.g. site_id machine_id')
+    parser.add_argument('--seed',            default=None, type=int,        help='Used to initialize random number generator')
+    parser.add_argument('--epochs',          default=1,    type=int,        help='Number of epochs')
+    args = parser.parse_args()
+    df   = read_metadata(args.path,columns=COLUMNS)
+    fold = get_folds(df,n_folds=args.folds,seed=args.seed)
+    for k in range(args.folds):
+        in_fold = fold==k
+        print (f'Fold {k}: {in_fold.sum()} images, {df["patient_id"][in_fold].nunique()} patients, {df["cancer"][in_fold].sum()} cancers')
+    start   = perf_counter()
+    sampler = BalancedSampler(df,
+                              selected        = fold!=args.fold,
+                              positive_weight = args.positive_weight,
+                              strata          = args.strata,
+                              seed            = args.seed)
+    print (f'Prepared sampler in {perf_counter()-start:.3f} sec')
+    cancer  = df['cancer'].to_numpy()
+    for epoch in range(args.epochs):
+        sampler.set_epoch(epoch)
+        start = perf_counter()
+        n     = 0
+        n_pos = 0
+        for batch in sampler.get_batches():
+            n     += len(batch)
+            n_pos += cancer[batch].sum()
+        print (f'Epoch {epoch}: {n} draws in {perf_counter()-start:.3f} sec, {n_pos/n:.3f} positive')
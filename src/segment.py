@@ -25,9 +25,8 @@
 
 from abc               import ABC, abstractmethod
 from argparse          import ArgumentParser
-from loader            import Loader, get_all_images
-from matplotlib.pyplot import close, figure, show
-from numpy             import all, any, argmax, argmin, count_nonzero, flip
+from numpy             import all, any, arange, argmax, argmin, count_nonzero, flip, int64
+from profiling         import stage
 from os.path           import join
 from os                import walk
 
@@ -49,13 +48,15 @@ class Segmenter(ABC):
 
     def segment(self,pixels):
         '''Method to get rid of irrelevant pixels and focus on tissue'''
-        pixels      = self._standardize_orientation(pixels,axis=1)
-        m0,n0,m1,n1 = segmenter._get_bounds(pixels)
+        pixels      = self._standardize_orientation(pixels)
+        with stage('bounds'):
+            m0,n0,m1,n1 = self._get_bounds(pixels)
         return pixels [m0:m1,n0:n1]
 
     def _standardize_orientation(self,pixels):
         m,n = pixels.shape
-        m0, n0 = self._get_centre_of_mass(pixels)
+        with stage('centre_of_mass'):
+            m0, n0 = self._get_centre_of_mass(pixels)
         if n0>n/2:
             pixels = flip(pixels,axis=1)
         return pixels
@@ -69,18 +70,13 @@ class Segmenter(ABC):
         '''
         Calculate average of coordinates within image, weighted by pixel intensity
         '''
-        x_total    = 0
-        y_total    = 0
-        mass_total = 0
-        m,n        = pixels.shape
-        background = pixels.max()
-        for i in range(0,m,step):
-            for j in range(0,n,step):
-                mass        = background - pixels[i,j]
-                x_total    += i*mass
-                y_total    += j*mass
-                mass_total += mass
-        return int(x_total/mass_total), int(y_total/mass_total)
+        sample     = pixels[::step,::step]
+        mass       = sample.max() - sample.astype(int64)
+        m,n        = sample.shape
+        mass_total = mass.sum()
+        if mass_total==0:
+            return pixels.shape[0]//2, pixels.shape[1]//2
+        return int(step*(arange(m) @ mass.sum(axis=1))/mass_total), int(step*(mass.sum(axis=0) @ arange(n))/mass_total)
 
 
 class CranioCaudalSegmenter(Segmenter):
@@ -127,16 +123,17 @@ class  MediolateralObliqueSegmenter(Segmenter):
         m1        = argmin(nfigure[n_max:-10]) + n_max
         return m0,n0,m1,n1
 
-
+Segmenter.Register(CranioCaudalSegmenter())
+Segmenter.Register(MediolateralObliqueSegmenter())
+Segmenter.Register(MediolateralObliqueSegmenter(key='AT'))
+Segmenter.Register(MediolateralObliqueSegmenter(key='LM'))
+Segmenter.Register(MediolateralObliqueSegmenter(key='ML'))
+Segmenter.Register(MediolateralObliqueSegmenter(key='LMO'))
 
 if __name__=='__main__':
+    from loader            import Loader, get_all_images
+    from matplotlib.pyplot import close, figure, show
     FIGS      = '../docs/figs'
-    Segmenter.Register(CranioCaudalSegmenter())
-    Segmenter.Register(MediolateralObliqueSegmenter())
-    Segmenter.Register(MediolateralObliqueSegmenter(key='AT'))
-    Segmenter.Register(MediolateralObliqueSegmenter(key='LM'))
-    Segmenter.Register(MediolateralObliqueSegmenter(key='ML'))
-    Segmenter.Register(MediolateralObliqueSegmenter(key='LMO'))
     parser = ArgumentParser(__doc__)
     parser.add_argument('image_ids', nargs='*', type=int)
     parser.add_argument('--views', nargs='*')
@@ -24,20 +24,27 @@
 '''
     Split download batch file to work around Kaggle limitations
     Otherwise we get chopped off after an unknown number of files have been downloaded,
-    maybe 100 or so.
+    maybe 100 or so. Batches are balanced by size if the listing of remote files is available.
 '''
 
-n   = 0
-out = None
-
-with open('download_partners.bat') as original:
-    for i,line in enumerate(original):
-        if i%100== 0:
-            n += 1
-            if out!=None:
-                out.close()
-            out = open(f'download{n}.bat','w')
-        out.write(line)
-
-if out!=None:
-    out.close()
+from argparse import ArgumentParser
+from os.path  import exists, join
+from planner  import PATH, balance, parse_listing
+from re       import search
+
+if __name__=='__main__':
+    parser = ArgumentParser(__doc__)
+    parser.add_argument('batch', nargs='?', default='download_partners.bat', help='Batch file to be split')
+    parser.add_argument('--max-files', default=100, type=int, help='Maximum number of files in each batch')
+    parser.add_argument('--listing', default=join(PATH,'files.txt'), help='List of remote files, used for sizes')
+    args  = parser.parse_args()
+    sizes = dict(parse_listing(args.listing)) if exists(args.listing) else {}
+    lines = {}
+    with open(args.batch) as original:
+        for line in original:
+            match = search(r'-f\s+(\S+)',line)
+            if match:
+                lines[match.group(1)] = line        # Keep original command, including its destination
+    for i,names in enumerate(balance([(name,sizes.get(name,1)) for name in lines],max_files=args.max_files)):
+        with open(f'download{i+1}.bat','w') as out:
+            out.writelines(lines[name] for name in names)
@@ -26,14 +26,15 @@
 '''
 
 from argparse          import ArgumentParser
-from dicomsdl          import open
-from matplotlib.pyplot import figure, show
-from numpy             import all, arange, flip, histogram, log,  where, zeros
+from numpy             import all, any, arange, argmax, asarray, bincount, concatenate, count_nonzero, cumsum, diff, empty, empty_like, \
+                              flatnonzero, flip, greater_equal, less_equal, lexsort, linspace, log, ones, where, \
+                              zeros, zeros_like
 
 def get_image(file,path='data'):
     '''
     Read image from specified file, verify keywords are consistent with image, and normalize so background is high
     '''
+    from dicomsdl import open
     dataset                   = open(f'../{path}/{file}.dcm')
     pixels                    = dataset.pixelData()
     PhotometricInterpretation = dataset.getDataElement('PhotometricInterpretation').value()
@@ -49,6 +50,30 @@ def get_image(file,path='data'):
         pixels = flip(pixels,axis=1)
     return pixels
 
+def get_background(pixel_array,bins=10):
+    '''
+    Decide whether background is at the low or high end of the histogram. Only the
+    first and last bins of the histogram are needed, so we count them directly,
+    using the same bin edges as numpy.histogram.
+
+    Returns:
+        background       Pixel value of background
+        background_low   True if background is darker than foreground
+    '''
+    first_edge = float(pixel_array.min())
+    last_edge  = float(pixel_array.max())
+    if first_edge==last_edge:
+        first_edge -= 0.5
+        last_edge  += 0.5
+    edges      = linspace(first_edge,last_edge,bins+1)
+    widths     = diff(edges)     # Not quite equal, and numpy.histogram(density=True) divides by them
+    density0   = count_nonzero(pixel_array<edges[1])/widths[0]/pixel_array.size
+    density1   = count_nonzero(pixel_array>=edges[-2])/widths[-1]/pixel_array.size
+    if density0>density1:
+        return edges[0],True
+    else:
+        return edges[-1],False
+
 def get_bounds(pixel_array):
     '''
         Reduce size of pixel array by trimming irrelevant pixels
@@ -57,35 +82,42 @@ def get_bounds(pixel_array):
            Bounding box: xmin,ymin,xmax,ymax
 
     '''
-    def is_background(strip):
-        '''Determine whether strip is part of background'''
-        if background_low:
-            return all(strip<=background)
-        else:
-            return all(strip>=background)
-
-    hist,bins    = histogram(pixel_array, density=True)
+    return get_bounds_batch(pixel_array.reshape((1,)+pixel_array.shape))[0]
 
-    if hist[0]>hist[-1]:
-        background = bins[0]
-        background_low = True
-    else:
-        background = bins[-1]
-        background_low = False
-
-    xmin,ymin = 0,0
-    xmax,ymax = pixel_array.shape
+def get_bounds_batch(pixel_arrays):
+    '''
+        Reduce size of each pixel array in a stack by trimming irrelevant pixels
 
-    while is_background(pixel_array[xmin,:]):
-        xmin+= 1
-    while is_background(pixel_array[:,ymin]):
-        ymin+= 1
-    while is_background(pixel_array[xmax-1,:]):
-        xmax-=1
-    while is_background(pixel_array[:,ymax-1]):
-        ymax-= 1
+        Parameters:
+            pixel_arrays   N x m x n stack of images, or a sequence of images having the same shape
 
-    return xmin,ymin,xmax,ymax, background
+        Returns:
+           A list containing a bounding box xmin,ymin,xmax,ymax, background for each image.
+           If an image is entirely background, its bounding box is the whole image.
+    '''
+    N              = len(pixel_arrays)
+    m,n            = pixel_arrays[0].shape
+    backgrounds    = [get_background(pixel_array) for pixel_array in pixel_arrays]
+    is_background  = empty((N,m,n),dtype=bool)
+    for k,(background,background_low) in enumerate(backgrounds):
+        if background_low:
+            less_equal(pixel_arrays[k],background,out=is_background[k])
+        else:
+            greater_equal(pixel_arrays[k],background,out=is_background[k])
+
+    rows    = ~all(is_background,axis=2)
+    columns = ~all(is_background,axis=1)
+    xmin    = argmax(rows,axis=1)
+    ymin    = argmax(columns,axis=1)
+    xmax    = m - argmax(rows[:,::-1],axis=1)
+    ymax    = n - argmax(columns[:,::-1],axis=1)
+    empty_images       = ~any(rows,axis=1)
+    xmin[empty_images] = 0
+    ymin[empty_images] = 0
+    xmax[empty_images] = m
+    ymax[empty_images] = n
+    return [(int(xmin[k]),int(ymin[k]),int(xmax[k]),int(ymax[k]),background)
+            for k,(background,_) in enumerate(backgrounds)]
 
 def get_centre_of_mass(pixels,step=16):
     '''
@@ -143,33 +175,63 @@ def get_path(p0,p1,scaled):
 
 def get_transitions(xs,ys,zs,pixels,background,epsilon=0.001):
     '''
-    Fined transitions between background and foreground
-    '''
-    seeking_background = True
-    transitions        = []
-    runs               = []
-    index              = len(zs) - 1
-    run_length         = 0
-    while index>0:
-        if seeking_background:
-            while index>0 and zs[index]>=background-epsilon:
-                index-=1
-                run_length+=1
-        else:
-            while index>0 and zs[index]<background-epsilon:
-                index-=1
-                run_length+=1
-        transitions.append(index)
-        runs.append(run_length)
-        run_length = 0
-        if index==0:
-            return transitions,runs
-        seeking_background = not seeking_background
-        index -= 1
-    return transitions,runs
+    Find transitions between background and foreground, working back from the end of the path
+
+    Returns:
+        transitions   Indices at which path switches between background and foreground, in descending order
+        runs          Lengths of runs that end at each transition
+    '''
+    _,transitions,runs = get_transitions_batch(asarray(zs).reshape(1,-1),background,epsilon=epsilon)
+    return transitions.tolist(),runs.tolist()
+
+def get_transitions_batch(profiles,background,epsilon=0.001):
+    '''
+    Find transitions between background and foreground for every profile in a K x L matrix
+
+    Parameters:
+        profiles     Pixel values along K paths, each of length L
+        background   Background level: either a scalar, or one value for each profile
+        epsilon      Tolerance for deciding that a pixel belongs to background
+
+    Returns:
+        rows          Index of profile for each transition
+        transitions   Indices at which profile switches between background and foreground,
+                      descending within each profile, as for get_transitions
+        runs          Lengths of runs that end at each transition
+    '''
+    K,L = profiles.shape
+    if L<2:
+        return zeros(0,dtype=int),zeros(0,dtype=int),zeros(0,dtype=int)
+
+    foreground = profiles < asarray(background).reshape(-1,1) - epsilon
+    beyond     = zeros((K,L-1),dtype=bool)    # Foreground at i+1, treating pixel L as background
+    beyond[:,:-1] = foreground[:,2:]
+    changes    = flatnonzero((foreground[:,1:]!=beyond)[:,::-1])
+    rows       = changes // (L-1)
+    indices    = L - 1 - changes % (L-1)
+
+    # Every walk ends at 0 unless the last transition was at 1
+    counts       = bincount(rows,minlength=K)
+    last         = zeros(K,dtype=int)
+    has_changes  = counts>0
+    last[has_changes] = indices[cumsum(counts)[has_changes]-1]
+    terminated   = flatnonzero(~has_changes | (last>1))
+    rows         = concatenate([rows,terminated])
+    indices      = concatenate([indices,zeros_like(terminated)])
+    order        = lexsort((-indices,rows))
+    rows         = rows[order]
+    indices      = indices[order]
+
+    previous     = empty_like(indices)
+    previous[1:] = indices[:-1]
+    first        = ones(len(rows),dtype=bool)
+    first[1:]    = rows[1:]!=rows[:-1]
+    previous[first] = L
+    return rows,indices,previous - indices - 1
 
 
 if __name__=='__main__':
+    from matplotlib.pyplot import figure, show
     XKCD_COLOURS = [
         'xkcd:purple',     'xkcd:green',
         'xkcd:blue',       'xkcd:pink',
@@ -179,6 +241,7 @@ if __name__=='__main__':
     parser.add_argument('--files', nargs='+')
     parser.add_argument('--show', default=False, action='store_true')
     parser.add_argument('--step', default=False, action='store_true')
+    parser.add_argument('--rays', type=int, default=None, help='Show contour found by casting this many rays')
     args  = parser.parse_args()
 
     for file in args.files:
@@ -198,6 +261,13 @@ if __name__=='__main__':
         fig  = figure(figsize=(12,8))
         ax1  = fig.add_subplot(3,4,1)
         ax1.imshow(scaled_pixels, cmap = 'gray')
+        if args.rays!=None:
+            from contour import get_contour
+            polygon,_ = get_contour(scaled_pixels,scaled_background,n_rays=args.rays)
+            ax1.fill(polygon[:,1],polygon[:,0],
+                     fill      = False,
+                     edgecolor = 'xkcd:yellow',
+                     linewidth = 1)
 
         for k,(x,y) in enumerate(ends):
             ax1.plot([y_c,y],[x_c,x],
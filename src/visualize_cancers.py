@@ -27,57 +27,84 @@
 '''
 
 from argparse          import ArgumentParser
-from dicomsdl          import open
 from loader            import Loader
-from matplotlib.pyplot import figure, show
-from os.path           import exists, join
-from pandas            import read_csv
+from matplotlib.pyplot import close, figure, show
+from os.path           import join
+from render            import Job, render_all, save_figure, use_headless
 from visualize         import get_bounds
 
 DATA                = 'D:/data/rsna-breast-cancer-detection'
-TRAIN               = join(DATA,'train.csv')
 FIGS                = '../docs/figs'
 
+loader = None
 
-parser = ArgumentParser('Visualize Data',__doc__)
-parser.add_argument('--show', default=False, action='store_true')
-args = parser.parse_args()
-
-loader = Loader()
-
-for _,row in read_csv(TRAIN).iterrows():
-    site_id                 = row['site_id']
-    patient_id              = row['patient_id']
-    image_id                = row['image_id']
-    laterality              = row['laterality']
-    view                    = row['view']
-    age                     = row['age']
-    cancer                  = row['cancer']
-    biopsy                  = row['biopsy']
-    invasive                = row['invasive']
-    BIRADS                  = row['BIRADS']
-    implant                 = row['implant']
-    density                 = row['density']
-    machine_id              = row['machine_id']
-    difficult_negative_case = row['difficult_negative_case']
-    if cancer==1:
-        dcm_file  = loader.get_image_file_name(patient_id,image_id)
-        if exists(dcm_file):
-            print (row['site_id'],row['patient_id'],row['image_id'],row['laterality'],dcm_file)
+def plot_cancer(loader,site_id,patient_id,image_id,age,biopsy):
+    '''
+    Plot image with cancer, both in full and trimmed to bounds
+    '''
+    img,laterality,view,cancer = loader.get_image(image_id=image_id)
+    xmin,ymin,xmax,ymax, _ = get_bounds(img)
+    fig = figure(figsize=(6,6))
+    fig.suptitle(f'Site={site_id}, Patient={patient_id}, Image={image_id}')
+    ax1 = fig.add_subplot(2,1,1)
+    ax1.imshow(img, cmap = 'gray')
+    ax2 = fig.add_subplot(2,1,2)
+    ax2.imshow(img[xmin:xmax,ymin:ymax], cmap = 'gray')
+    fig.suptitle(f'{laterality} {view} {age} {cancer} {biopsy}')
+    return fig
+
+def initialize():
+    '''Prepare worker process for rendering'''
+    global loader
+    use_headless()
+    loader = Loader()
+
+def render(job):
+    '''Render one figure in worker process'''
+    save_figure(plot_cancer(loader,**job.parameters),job.output)
+
+def create_jobs(loader):
+    '''Create a job for each image with cancer that has been downloaded'''
+    jobs = []
+    for _,_,df_breast in loader.index.get_breasts(loader.index.cancer):
+        for _,row in df_breast[df_breast['cancer']==1].iterrows():
+            dcm_file = loader.get_image_file_name(row['patient_id'],row['image_id'])
+            if loader.has_image(row['patient_id'],row['image_id']):
+                jobs.append(Job(output     = join(FIGS,f'{row["image_id"]}.png'),
+                                inputs     = [dcm_file],
+                                parameters = dict(site_id    = row['site_id'],
+                                                  patient_id = row['patient_id'],
+                                                  image_id   = row['image_id'],
+                                                  age        = row['age'],
+                                                  biopsy     = row['biopsy'])))
+    return jobs
+
+if __name__=='__main__':
+    parser = ArgumentParser('Visualize Data',__doc__)
+    parser.add_argument('--show', default=False, action='store_true')
+    parser.add_argument('--render', default=False, action='store_true', help='Render figures in parallel, without display')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes used by --render')
+    parser.add_argument('--force', default=False, action='store_true', help='Used with --render to replace figures that are up to date')
+    args = parser.parse_args()
+
+    loader = Loader()
+    jobs   = create_jobs(loader)
+
+    if args.render:
+        render_all(jobs,render,
+                   processes   = args.processes,
+                   initializer = initialize,
+                   force       = args.force)
+    else:
+        for job in jobs:
+            print (job.parameters['site_id'],job.parameters['patient_id'],job.parameters['image_id'],job.inputs[0])
             try:
-                img,laterality,view,cancer = loader.get_image(image_id=image_id)
-                xmin,ymin,xmax,ymax, _ = get_bounds(img)
-                fig = figure(figsize=(6,6))
-                fig.suptitle(f'Site={site_id}, Patient={patient_id}, Image={image_id}')
-                ax1 = fig.add_subplot(2,1,1)
-                ax1.imshow(img, cmap = 'gray')
-                ax2 = fig.add_subplot(2,1,2)
-                ax2.imshow(img[xmin:xmax,ymin:ymax], cmap = 'gray')
-                fig.suptitle(f'{laterality} {view} {age} {cancer} {biopsy}')
-                fig.savefig(join(FIGS,f'{image_id}'))
+                fig = plot_cancer(loader,**job.parameters)
+                fig.savefig(job.output)
+                if not args.show:
+                    close(fig)
             except RuntimeError as e:
                 print (e)
 
-if args.show:
-    show()
-
+        if args.show:
+            show()
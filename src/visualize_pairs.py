@@ -28,22 +28,17 @@
 
 from argparse          import ArgumentParser
 from loader            import Loader
-from matplotlib.pyplot import figure, show
+from matplotlib.pyplot import close, figure, show
 from math              import isqrt
-from os.path           import exists, join
-from pandas            import read_csv
+from mosaic            import create_mosaic, write_mosaic
+from planner           import write_batch
+from os.path           import join
+from render            import Job, render_all, save_figure, use_headless
 from visualize         import get_bounds
 
 DATA                = 'D:/data/rsna-breast-cancer-detection'
-TRAIN               = join(DATA,'train.csv')
 FIGS                = '../docs/figs'
 
-def cancer_on_one_side_only(df_patient):
-    '''
-    Used to find images where there is cancer on one side, but not the other
-    '''
-    return df_patient['cancer'].any() and not df_patient['cancer'].all()
-
 def get_grid_size(N):
     '''
     Used to establish a rectangular grid that has room for a specified number of subplots
@@ -81,48 +76,120 @@ def get_density(density):
 
 
 
+def plot_patient(loader,patient_id,df_patient):
+    '''
+    Plot all downloaded images for one patient, trimmed to bounds
+
+    Parameters:
+        loader       Used to read images
+        patient_id   Identifies patient
+        df_patient   Rows from master file for patient, in the order they are to be plotted
+    '''
+    m,n = get_grid_size(len(df_patient))
+    k   = 0
+    fig = figure(figsize=(10,10))
+    fig.suptitle(f'Patient={patient_id}')
+    for _,row in df_patient.iterrows():
+        image_id = row['image_id']
+        dcm_file = loader.get_image_file_name(patient_id,image_id)
+        if loader.has_image(patient_id,image_id):
+            k+= 1
+            print (row['site_id'],row['patient_id'],row['image_id'],row['laterality'],dcm_file)
+            try:
+                img,laterality,view,cancer = loader.get_image(image_id=image_id)
+                xmin,ymin,xmax,ymax, _     = get_bounds(img)
+                density                    = get_density(row['density'])
+                ax = fig.add_subplot(m,n,k)
+                ax.imshow(img[xmin:xmax,ymin:ymax], cmap = 'gray')
+                ax.set_title(f'{image_id} {laterality} {view} {density} {cancer}')
+            except RuntimeError as e:
+                print (e)
+    return fig
+
+def create_patient_mosaic(loader,patient_id,df_patient):
+    '''
+    Tile all downloaded images for one patient, trimmed to bounds, into a single image
+
+    Parameters:
+        loader       Used to read images
+        patient_id   Identifies patient
+        df_patient   Rows from master file for patient, in the order they are to be tiled
+    '''
+    images = []
+    labels = []
+    for _,row in df_patient.iterrows():
+        image_id = row['image_id']
+        if loader.has_image(patient_id,image_id):
+            try:
+                img,laterality,view,cancer = loader.get_image(image_id=image_id)
+                xmin,ymin,xmax,ymax, _     = get_bounds(img)
+                images.append(img[xmin:xmax,ymin:ymax])
+                labels.append(f'{image_id} {laterality} {view} {get_density(row["density"])} {cancer}')
+            except RuntimeError as e:
+                print (e)
+    return create_mosaic(images,labels,get_grid_size(len(df_patient)),title=f'Patient={patient_id}')
+
+loader = None
+
+def initialize():
+    '''Prepare worker process for rendering'''
+    global loader
+    use_headless()
+    loader = Loader()
+
+def render(job):
+    '''Render one figure in worker process'''
+    save_figure(plot_patient(loader,**job.parameters),job.output)
+
+def render_mosaic(job):
+    '''Create mosaic for one patient in worker process'''
+    write_mosaic(create_patient_mosaic(loader,**job.parameters),job.output)
+
 if __name__=='__main__':
     parser = ArgumentParser('Visualize Data',__doc__)
     parser.add_argument('--show', default=False, action='store_true')
+    parser.add_argument('--render', default=False, action='store_true', help='Render figures in parallel, without display')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes used by --render')
+    parser.add_argument('--force', default=False, action='store_true', help='Used with --render to replace figures that are up to date')
+    parser.add_argument('--mosaic', default=False, action='store_true', help='Tile images directly instead of using matplotlib')
+    parser.add_argument('--format', default='png', choices=['png','jpg'], help='Format used for --mosaic')
     args = parser.parse_args()
 
     loader    = Loader()
-    df        = read_csv(TRAIN)
-    processed = set()
-
-    with open('download_partners.bat','w') as out:
-        for _,row in df.iterrows():
-            patient_id = row['patient_id']
-            if patient_id in processed: continue
-            processed.add(patient_id)
-            df_patient = df[df['patient_id']==patient_id]
-            if cancer_on_one_side_only(df_patient):
-                df_patient = df_patient.sort_values(['cancer','view'])
-                m,n        = get_grid_size(len(df_patient))
-                k          = 0
-                for image_id in df_patient['image_id']:
-                    dcm_file  = loader.get_image_file_name(patient_id,image_id)
-                    if exists(dcm_file):
-                        if k==0:
-                            fig = figure(figsize=(10,10))
-                            fig.suptitle(f'Patient={patient_id}')
-                        k+= 1
-                        print (row['site_id'],row['patient_id'],row['image_id'],row['laterality'],dcm_file)
-                        try:
-                            img,laterality,view,cancer = loader.get_image(image_id=image_id)
-                            xmin,ymin,xmax,ymax, _     = get_bounds(img)
-                            density                    = get_density(row['density'])
-                            ax = fig.add_subplot(m,n,k)
-                            ax.imshow(img[xmin:xmax,ymin:ymax], cmap = 'gray')
-                            ax.set_title(f'{image_id} {laterality} {view} {density} {cancer}')
-                        except RuntimeError as e:
-                            print (e)
-                    else:
-                        out.write(f'kaggle competitions download -f train_images/{patient_id}/{image_id}.dcm  -p {DATA} rsna-breast-cancer-detection\n')
-                if k>0:
-                    fig.savefig(join(FIGS,f'{patient_id}'))
-
-
-    if args.show:
-        show()
-
+    index     = loader.index
+    jobs      = []
+
+    missing   = []
+    for patient_id,df_patient in index.get_patients(index.cancer_on_one_side_only):
+        df_patient = df_patient.sort_values(['cancer','view'])
+        dcm_files  = []
+        for image_id in df_patient['image_id']:
+            dcm_file  = loader.get_image_file_name(patient_id,image_id)
+            if loader.has_image(patient_id,image_id):
+                dcm_files.append(dcm_file)
+            else:
+                missing.append(f'train_images/{patient_id}/{image_id}.dcm')
+        if len(dcm_files)>0:
+            jobs.append(Job(output     = join(FIGS,f'{patient_id}.{args.format if args.mosaic else "png"}'),
+                            inputs     = dcm_files,
+                            parameters = dict(patient_id = patient_id,
+                                              df_patient = df_patient)))
+    write_batch(missing,'download_partners.bat',path=DATA)
+
+    if args.render:
+        render_all(jobs,render_mosaic if args.mosaic else render,
+                   processes   = args.processes,
+                   initializer = initialize,
+                   force       = args.force)
+    elif args.mosaic:
+        for job in jobs:
+            write_mosaic(create_patient_mosaic(loader,**job.parameters),job.output)
+    else:
+        for job in jobs:
+            fig = plot_patient(loader,**job.parameters)
+            fig.savefig(job.output)
+            if not args.show:
+                close(fig)
+
+        if args.show:
+            show()
@@ -30,11 +30,10 @@ from argparse          import ArgumentParser
 from dicomsdl          import open
 from matplotlib.pyplot import close, figure, show
 from os.path           import exists, join
-from pandas            import read_csv
+from metadata          import read_metadata
 from visualize         import get_bounds
 
 DATA                = '../data'
-TRAIN               = join(DATA,'train.csv')
 FIGS                = '../docs/figs'
 patient_id_previous = None
 fig                 = None
@@ -45,7 +44,7 @@ parser = ArgumentParser('Visualize Data',__doc__)
 parser.add_argument('--show', default=False, action='store_true')
 args = parser.parse_args()
 
-for _,row in read_csv(TRAIN).iterrows():
+for _,row in read_metadata(DATA).iterrows():
     site_id                 = row['site_id']
     patient_id              = row['patient_id']
     image_id                = row['image_id']
@@ -76,7 +75,7 @@ for _,row in read_csv(TRAIN).iterrows():
         dataset = open(dcm_file)
         try:
             pixels = dataset.pixelData()
-            xmin,ymin,xmax,ymax = get_bounds(pixels)
+            xmin,ymin,xmax,ymax,_ = get_bounds(pixels)
             ax.imshow(pixels[xmin:xmax,ymin:ymax])
             ax.set_title(f'{laterality} {view} {age} {cancer} {biopsy}')
             sub_fig += 1
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2023 Simon Crase
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Accumulate mean and covariance one chunk at a time, so data need not fit in memory'''
+
+from numpy import einsum, ones, sqrt, where, zeros
+
+class Moments:
+    '''
+    Mean and covariance, accumulated using the parallel form of Welford's algorithm
+    (Chan, Golub & LeVeque), so two Moments built from different chunks can be merged.
+
+    Several weighted replicates can be accumulated side by side, e.g. for a Poisson bootstrap,
+    where each row is given an independent Poisson(1) weight in each replicate.
+
+    Attributes:
+        n      Total weight for each replicate
+        mean   Mean of each column, for each replicate
+        M2     Sum of products of deviations from mean, for each replicate
+    '''
+    def __init__(self,p,replicates=1):
+        self.n    = zeros(replicates)
+        self.mean = zeros((replicates,p))
+        self.M2   = zeros((replicates,p,p))
+
+    def update(self,X,weights=None):
+        '''
+        Add a chunk of data
+
+        Parameters:
+            X         n x p array, one row per observation
+            weights   replicates x n array of weights (default: 1 for every row)
+        '''
+        if len(X)==0: return self
+        if weights is None:
+            weights = ones((len(self.n),len(X)))
+        centre = X.mean(axis=0)          # Shift before summing to avoid cancellation
+        X0     = X - centre
+        W      = weights.sum(axis=1)
+        S1     = weights @ X0
+        S2     = einsum('bi,ij,ik->bjk',weights,X0,X0,optimize=True)
+        safe   = where(W>0,W,1)
+        self._merge(W,
+                    centre + S1/safe[:,None],
+                    S2 - einsum('bj,bk->bjk',S1,S1)/safe[:,None,None])
+        return self
+
+    def merge(self,other):
+        '''
+        Combine with Moments accumulated from other data
+        '''
+        self._merge(other.n,other.mean,other.M2)
+        return self
+
+    def _merge(self,n,mean,M2):
+        total      = self.n + n
+        safe       = where(total>0,total,1)
+        delta      = mean - self.mean
+        self.mean  = self.mean + delta * (n/safe)[:,None]
+        self.M2    = self.M2 + M2 + einsum('bj,bk->bjk',delta,delta) * (self.n*n/safe)[:,None,None]
+        self.n     = total
+
+    def get_covariance(self,ddof=1):
+        '''
+        Covariance matrix for each replicate
+        '''
+        return self.M2/(self.n-ddof)[:,None,None]
+
+    def get_correlation(self):
+        '''
+        Correlation matrix for each replicate
+        '''
+        covariance = self.get_covariance()
+        sd         = sqrt(einsum('bii->bi',covariance))
+        return covariance/einsum('bj,bk->bjk',sd,sd)